@@ -0,0 +1,62 @@
+import math
+
+class BloomFilter(object):
+    '''Set of keys that can answer "definitely not present" cheaply
+    
+    Keys are hashed into a bit array sized for the expected number of keys
+    and the wanted false positive rate.  A key that was added is always
+    found.  A key that was not added is found at about the false positive
+    rate.  Keys can be anything hashable.
+    '''
+    
+    def __init__(self, capacity, false_positive_rate=0.01):
+        '''Init
+        
+        @param capacity: Number of keys expected to be added
+        @param false_positive_rate: Chance of a key that wasn't added being
+            found, once capacity keys have been added
+        '''
+        if not 0 < false_positive_rate < 1:
+            raise ValueError("false_positive_rate must be between 0 and 1")
+        capacity = max(capacity, 1)
+        
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        
+        ln2 = math.log(2)
+        bits = -capacity * math.log(false_positive_rate) / (ln2 * ln2)
+        self.bit_count = max(int(math.ceil(bits)), 8)
+        self.hash_count = max(int(round(self.bit_count * ln2 / capacity)), 1)
+        
+        self.__bits = bytearray((self.bit_count + 7) // 8)
+        self.__count = 0
+    
+    
+    def _bit_positions(self, key):
+        '''Positions of the bits for a key using double hashing'''
+        h1 = hash(key)
+        h2 = hash((key, 0x5bd1e995)) | 1
+        for i in xrange(self.hash_count):
+            yield (h1 + i * h2) % self.bit_count
+    
+    
+    def add(self, key):
+        '''Add a key to the filter'''
+        bits = self.__bits
+        for pos in self._bit_positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.__count += 1
+    
+    
+    def __contains__(self, key):
+        bits = self.__bits
+        for pos in self._bit_positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+    
+    
+    @property
+    def count(self):
+        '''Number of keys added'''
+        return self.__count
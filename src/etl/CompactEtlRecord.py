@@ -0,0 +1,226 @@
+import sys
+
+from EtlRecord import EtlRecordFrozen, next_record_serial, estimate_value_size
+
+class CompactEtlRecord(object):
+    '''Memory efficient container for values for a single record
+    
+    Provides the same interface as EtlRecord, but values are kept in a tuple
+    laid out in the field order of the schema rather than in a dict, and the
+    serial is a plain int.  The record always needs a schema that lists its
+    fields.  Any schema field not given a value is set to None.
+    
+    ETL Records are meant to not be mutable once they have been added to an
+    output set.
+    '''
+    
+    __slots__ = ('__schema', '__values', '__serial', '__frozen', '__source',
+                 '__from_records')
+    
+    def __init__(self, schema, values):
+        '''Init
+        
+        @param schema: The Schema this record is being created to match
+        @param values: Initial values as a dict
+        '''
+        positions = schema.field_positions()
+        slots = [None] * len(positions)
+        for name, value in values.iteritems():
+            try:
+                slots[positions[name]] = value
+            except KeyError:
+                raise KeyError("Field '%s' is not in schema %s" % (
+                    name, schema.__class__.__name__))
+        
+        self.__schema = schema
+        self.__values = slots       # list until frozen, then tuple
+        self.__serial = next_record_serial()
+        self.__frozen = False
+        self.__source = None        # (prc_name, output_port_name)
+        self.__from_records = None
+    
+    
+    @classmethod
+    def from_record(cls, record):
+        '''Create a compact copy of another record'''
+        compact = cls(record.schema, record.values)
+        if record.source_processor_name is not None:
+            compact.set_source(record.source_processor_name,
+                               record.source_processor_output_name)
+        return compact
+    
+    
+    def clone(self):
+        return CompactEtlRecord(self.__schema, self.values)
+    
+    
+    @property
+    def serial(self):
+        '''Unique identification of this record'''
+        return self.__serial
+    
+    
+    def field_names(self):
+        return self.__schema.list_field_names()
+    
+    
+    def value_names(self):
+        '''Set of the names of the fields this record has a value for'''
+        return self.__schema.field_name_set()
+    
+    
+    def note_src_record(self, rec):
+        '''Note another record that was processed to help create this record'''
+        self.note_src_serial(rec.serial)
+    
+    
+    def note_src_serial(self, serial):
+        '''Note the serial of a record that helped create this record'''
+        self.assert_not_frozen()
+        if self.__from_records is None:
+            self.__from_records = list()
+        if len(self.__from_records) < 100000:
+            self.__from_records.append(serial)
+    
+    
+    def get_src_record_serials(self):
+        '''Serial codes of records that helped generate this record'''
+        if self.__from_records is None:
+            return list()
+        return self.__from_records[:]
+    
+    
+    def set_source(self, prc_name, output_port_name):
+        self.assert_not_frozen()
+        self.__source = (prc_name, output_port_name)
+    
+    
+    @property
+    def source_processor_name(self):
+        if self.__source is None:
+            return None
+        return self.__source[0]
+    
+    
+    @property
+    def source_processor_output_name(self):
+        if self.__source is None:
+            return None
+        return self.__source[1]
+    
+    
+    def create_msg(self, msg):
+        '''Generate a message about this record'''
+        return "%s: %s: Record[[%s]]" % (msg, self.__serial, str(self.values))
+    
+    
+    @property
+    def values(self):
+        return dict(zip(self.__schema.list_field_names(), self.__values))
+    
+    
+    def value(self, name):
+        return self.__values[self.__schema.field_positions()[name]]
+    
+    
+    def __getitem__(self, name):
+        return self.value(name)
+    
+    
+    def __setitem__(self, name, value):
+        self.assert_not_frozen()
+        self.__values[self.__schema.field_positions()[name]] = value
+    
+    
+    def set(self, name, value):
+        self[name] = value
+    
+    
+    def get(self, name, default=None):
+        try:
+            return self.value(name)
+        except KeyError:
+            return default
+    
+    
+    def keys(self):
+        return self.field_names()
+    
+    
+    def items(self):
+        return zip(self.__schema.list_field_names(), self.__values)
+    
+    
+    def __iter__(self):
+        return iter(self.field_names())
+    
+    
+    def __contains__(self, name):
+        return name in self.__schema.field_positions()
+    
+    
+    def __len__(self):
+        return len(self.__values)
+    
+    
+    def freeze(self):
+        if not self.__frozen:
+            self.__values = tuple(self.__values)
+            self.__frozen = True
+    
+    @property
+    def is_frozen(self):
+        return self.__frozen
+    
+    def assert_not_frozen(self):
+        if self.__frozen:
+            raise EtlRecordFrozen()
+    
+    
+    @property
+    def size(self):
+        '''Estimate bytes of memory used by the record'''
+        size = sys.getsizeof(self) + sys.getsizeof(self.__values)
+        for v in self.__values:
+            size += estimate_value_size(v)
+        return size
+    
+    
+    @property
+    def schema(self):
+        return self.__schema
+    def set_schema(self, new_schema):
+        '''Replace schema
+        
+        The new schema must have the same field order, since values are stored
+        by position.
+        
+        Note: We allow the schema to be replaced to assist with storing to disk
+        '''
+        self.__schema = new_schema
+    
+    
+    def __eq__(self, record):
+        if record is None:
+            return False
+        
+        try:
+            my_fields = sorted(self.field_names())
+            rec_fields = sorted(record.field_names())
+            if my_fields != rec_fields:
+                return False
+            
+            for field_name in my_fields:
+                if self[field_name] != record[field_name]:
+                    return False
+            
+            return True
+        
+        except AttributeError:
+            return False
+        
+        return False
+    
+    
+    def __ne__(self, record):
+        return not self.__eq__(record)
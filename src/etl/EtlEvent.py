@@ -21,6 +21,15 @@ class InputRecordRecieved(EtlEvent):
     #       input record queue due to threading.
     
     
+class InputRecordBatchRecieved(EtlEvent):
+    '''A batch of input records was received'''
+    def __init__(self, input_name, conn_id, record_count):
+        super(InputRecordBatchRecieved, self).__init__('input_batch')
+        self.input_name = input_name
+        self.conn_id = conn_id
+        self.record_count = record_count
+    
+    
 # class PrcConnectedEvent(EtlEvent):
 #     '''Inform a processor that another processor has connected to it's input'''
 #     def __init__(self, input_name, src_prc_name, src_output_name, conn_id):
@@ -7,15 +7,67 @@ from abc import ABCMeta, abstractmethod
 
 
 from EtlProcessor import EtlProcessor
+from Sqlite3RecordSet import Sqlite3RecordSet
+from ExternalRecordSorter import ExternalRecordSorter
+from BloomFilter import BloomFilter
 
 
 class EtlJoinProcessor(EtlProcessor):
-    '''Join one set of records to another'''
+    '''Join one set of records to another
+    
+    These join strategies are available by setting join_strategy:
+    
+      LOOKUP_JOIN: (default) The match keys of all lookup records are kept
+                   in memory.  Define gen_<name>_output() to read the subject
+                   records and call lookup() to find the matching record.
+                   
+      HASH_JOIN:   Define join_record() instead, and it will be called with
+                   each subject record and its match.  Lookup records are
+                   held in memory up to build_memory_limit bytes.  Past that,
+                   both lookup and subject records are hash partitioned to
+                   disk on their match key, and joined one partition at a
+                   time (a grace hash join).  Subject records are then joined
+                   in partition order rather than input order.
+                   
+      SORT_MERGE_JOIN: Also uses join_record().  Both inputs are read in
+                   match key order, stepping through them together, so no
+                   lookup records are held in memory.  Intended for inputs
+                   that are already sorted on the match key (records are
+                   read from record sets in the order they were created).
+                   Each input is checked first, and sorted with an
+                   ExternalRecordSorter if it's out of order.
+                   
+    HASH_JOIN, once partitioned to disk, builds a BloomFilter of the lookup
+    match keys.  Subject records that definitely have no match are joined
+    to None right away rather than being written to a partition and read
+    back.  Set bloom_false_positive_rate to None to turn this off.  The
+    other strategies don't use a filter, since a miss there is already just
+    a dict or merge step that never reads a record.
+    Lookups by every strategy are counted in lookup_stats.
+    '''
+    
+    LOOKUP_JOIN = 'lookup'
+    HASH_JOIN = 'hash'
+    SORT_MERGE_JOIN = 'sort_merge'
+    
+    BUILD_MEMORY_LIMIT = 64 * 1024 * 1024
+    JOIN_PARTITIONS = 16
+    PARTITION_WRITE_CHUNK = 1000
+    BLOOM_FALSE_POSITIVE_RATE = 0.01
     
     def __init__(self):
         super(EtlJoinProcessor, self).__init__()
         self.__match_keys = dict()      # Match Key -> (input_set, Record Key)
-        self.__lookup_inputs_processed = False
+        self.__lookup_sets = None       # Record sets match keys are from
+        self.__lookup_filter = None
+        
+        self.join_strategy = self.LOOKUP_JOIN
+        self.build_memory_limit = self.BUILD_MEMORY_LIMIT
+        self.join_partitions = self.JOIN_PARTITIONS
+        self.bloom_false_positive_rate = self.BLOOM_FALSE_POSITIVE_RATE
+        
+        # Lookup counts.  'filtered' misses were turned away by the filter
+        self.lookup_stats = {'hits': 0, 'misses': 0, 'filtered': 0}
         
         
     def list_inputs(self):
@@ -49,6 +101,21 @@ class EtlJoinProcessor(EtlProcessor):
         '''Build a key to use to find a lookup record'''
         
         
+    def join_record(self, output_name, subject, match, record_set):
+        '''Hook to generate output for a subject record
+        
+        Used by the HASH_JOIN and SORT_MERGE_JOIN strategies
+        
+        @param output_name: Name of the output being generated
+        @param subject: Record from a subject input
+        @param match: Lookup record with the same match key, or None
+        @param record_set: Container to populate with records
+        '''
+        msg = "Define join_record() to use the %s join strategy"
+        msg = msg % (self.join_strategy)
+        raise Exception(msg)
+        
+        
     # -- Common join logic ----------------------------------------------------
         
     def gen_output(self, name, inputs, record_set):
@@ -60,25 +127,29 @@ class EtlJoinProcessor(EtlProcessor):
         @param inputs: Dictionary of connected input datasets
         @param record_set: Container to populate with records
         '''
-        if not self.__lookup_inputs_processed:
+        if self.join_strategy == self.HASH_JOIN:
+            self._hash_join(name, inputs, record_set)
+            return
+        if self.join_strategy == self.SORT_MERGE_JOIN:
+            self._sort_merge_join(name, inputs, record_set)
+            return
+        
+        # Match keys refer to the lookup record sets they were read from, so
+        # they're built again if the workflow has released those sets and
+        # generated new ones
+        lookup_sets = list()
+        for data_port in self.list_lookup_inputs():
+            lookup_sets.extend(inputs[data_port.name])
+        if self._lookup_sets_changed(lookup_sets):
             # Generate keys for lookup records
+            self.__match_keys = dict()
+            self.__lookup_sets = lookup_sets
             for data_port in self.list_lookup_inputs():
                 for input_set in inputs[data_port.name]:
                     for record in input_set.all_records():
                         
                         # Build a Match key for this lookup record
-                        match_key = self.build_lookup_record_key(record)
-                        if match_key is None:
-                            msg = "Did not build a match key for this record"
-                            msg = record.create_msg(msg)
-                            raise Exception(msg)
-                            
-                        # Determine associated index
-                        rec_index = record.index
-                        if rec_index is None:
-                            msg = "Record in lookup input has no index."
-                            msg = record.create_msg(msg)
-                            raise Exception(msg)
+                        match_key = self._build_lookup_record_key(record)
                         
                         # Make sure match key is unique
                         if self.__match_keys.has_key(match_key):
@@ -88,13 +159,216 @@ class EtlJoinProcessor(EtlProcessor):
                         # Store
                         else:
                             store_rec = self._store_lookup_record
-                            store_rec(match_key, input_set, rec_index)
-            self.__lookup_inputs_processed = True
+                            store_rec(match_key, input_set, record.serial)
                     
         # Call Parent to process subject records
         super(EtlJoinProcessor, self).gen_output(name, inputs, record_set)
         
         
+    def _lookup_sets_changed(self, lookup_sets):
+        '''Check if the lookup inputs differ from those match keys are from
+        
+        @param lookup_sets: Record sets connected to the lookup inputs
+        '''
+        if self.__lookup_sets is None:
+            return True
+        if len(lookup_sets) != len(self.__lookup_sets):
+            return True
+        for i, lookup_set in enumerate(lookup_sets):
+            if lookup_set is not self.__lookup_sets[i]:
+                return True
+        return False
+        
+        
+    def _build_lookup_record_key(self, record):
+        '''Build the match key for a lookup record, making sure there is one'''
+        match_key = self.build_lookup_record_key(record)
+        if match_key is None:
+            msg = "Did not build a match key for this record"
+            msg = record.create_msg(msg)
+            raise Exception(msg)
+        return match_key
+    
+    
+    def _create_lookup_filter(self, inputs):
+        '''Create a BloomFilter sized for the lookup records
+        
+        @return: BloomFilter, or None if turned off
+        '''
+        if self.bloom_false_positive_rate is None:
+            return None
+        
+        capacity = 0
+        for data_port in self.list_lookup_inputs():
+            for input_set in inputs[data_port.name]:
+                capacity += input_set.count
+        return BloomFilter(capacity, self.bloom_false_positive_rate)
+    
+    
+    def _note_lookup(self, match):
+        '''Count a lookup in lookup_stats and return the match'''
+        if match is None:
+            self.lookup_stats['misses'] += 1
+        else:
+            self.lookup_stats['hits'] += 1
+        return match
+    
+    
+    def _filtered_out(self, match_key):
+        '''Check if a match key is definitely not among the lookup keys'''
+        if self.__lookup_filter is None:
+            return False
+        if match_key in self.__lookup_filter:
+            return False
+        self.lookup_stats['filtered'] += 1
+        self.lookup_stats['misses'] += 1
+        return True
+    
+    
+    def _list_input_records(self, inputs, data_ports):
+        '''Read all records from the input sets for the given ports'''
+        for data_port in data_ports:
+            for input_set in inputs[data_port.name]:
+                for record in input_set.all_records():
+                    yield record
+                    
+                    
+    # -- Hash join ------------------------------------------------------------
+    
+    def _hash_join(self, name, inputs, record_set):
+        '''Join subject records to lookup records using a hash table
+        
+        Switches to partitioning on disk if the lookup records don't fit
+        within build_memory_limit.
+        '''
+        lookup_records = self._list_input_records(inputs,
+                                                  self.list_lookup_inputs())
+        subject_records = self._list_input_records(inputs,
+                                                   self.list_subject_inputs())
+        
+        # Build hash table from lookup records
+        table = dict()
+        table_size = 0
+        for record in lookup_records:
+            self._add_to_hash_table(table, record)
+            table_size += record.size
+            if table_size > self.build_memory_limit:
+                self.__lookup_filter = self._create_lookup_filter(inputs)
+                self._grace_hash_join(name, table, lookup_records,
+                                      subject_records, record_set)
+                return
+            
+        # Probe with subject records
+        for subject in subject_records:
+            match = table.get(self.build_lookup_key(subject))
+            self.join_record(name, subject, self._note_lookup(match),
+                             record_set)
+            
+            
+    def _add_to_hash_table(self, table, record):
+        '''Add a lookup record to a hash join table'''
+        match_key = self._build_lookup_record_key(record)
+        if table.has_key(match_key):
+            self._handle_duplicate_lookup_match_key(match_key, record)
+        else:
+            table[match_key] = record
+            
+            
+    def _grace_hash_join(self, name, table, lookup_records, subject_records,
+                         record_set):
+        '''Join by partitioning both inputs to disk on their match keys
+        
+        Records with the same match key always land in the same partition,
+        so each partition can be joined on its own with only its lookup
+        records in memory.
+        
+        @param table: Lookup records already read into memory
+        @param lookup_records: The rest of the lookup records
+        @param subject_records: All subject records
+        '''
+        # Partition lookup records
+        lookup_parts = self._partition_records(
+            self._key_lookup_records(self._chain_table(table, lookup_records)))
+        table.clear()
+        
+        # Partition subject records, joining definite misses right away
+        subject_parts = self._partition_records(
+            self._key_subject_records(name, subject_records, record_set))
+        
+        # Join each partition
+        for i in range(self.join_partitions):
+            table = dict()
+            for record in lookup_parts[i].all_records():
+                self._add_to_hash_table(table, record)
+            lookup_parts[i] = None
+                
+            for subject in subject_parts[i].all_records():
+                match = table.get(self.build_lookup_key(subject))
+                self.join_record(name, subject, self._note_lookup(match),
+                                 record_set)
+            subject_parts[i] = None
+            
+            
+    def _key_lookup_records(self, records):
+        '''Build match keys for lookup records, adding them to the filter
+        
+        @return: Generator of (match key, record)
+        '''
+        for record in records:
+            match_key = self._build_lookup_record_key(record)
+            if self.__lookup_filter is not None:
+                self.__lookup_filter.add(match_key)
+            yield match_key, record
+            
+            
+    def _key_subject_records(self, name, records, record_set):
+        '''Build match keys for subject records that may have a match
+        
+        Subject records filtered out are joined to None right away.
+        
+        @return: Generator of (match key, record)
+        '''
+        for record in records:
+            match_key = self.build_lookup_key(record)
+            if self._filtered_out(match_key):
+                self.join_record(name, record, None, record_set)
+            else:
+                yield match_key, record
+            
+            
+    def _chain_table(self, table, records):
+        '''List records already in a hash table followed by others'''
+        for record in table.itervalues():
+            yield record
+        for record in records:
+            yield record
+            
+            
+    def _partition_records(self, keyed_records):
+        '''Write records to disk partitions by the hash of their match key
+        
+        @param keyed_records: (match key, record) to partition
+        @return: List of join_partitions Sqlite3RecordSet objects
+        '''
+        partitions = list()
+        pending = list()
+        for i in range(self.join_partitions):
+            partitions.append(Sqlite3RecordSet())
+            pending.append(list())
+            
+        for match_key, record in keyed_records:
+            i = hash(match_key) % self.join_partitions
+            pending[i].append(record)
+            if len(pending[i]) >= self.PARTITION_WRITE_CHUNK:
+                partitions[i].add_records(pending[i])
+                pending[i] = list()
+                
+        for i in range(self.join_partitions):
+            partitions[i].add_records(pending[i])
+            
+        return partitions
+        
+        
     #def gen_invoices_output(self, inputs, output_set):
     #        for record_set in inputs['invoices']:
     #            for record in record_set.all_records():
@@ -124,9 +398,9 @@ class EtlJoinProcessor(EtlProcessor):
         # Find match
         if self.__match_keys.has_key(match_key):
             input_set, lookup_index = self.__match_keys[match_key]
-            return input_set.get_record(lookup_index)
+            return self._note_lookup(input_set.get_record(lookup_index))
             
-        return None
+        return self._note_lookup(None)
             
             
     def _handle_duplicate_lookup_match_key(self, match_key, record):
@@ -136,4 +410,77 @@ class EtlJoinProcessor(EtlProcessor):
 
             
     def _store_lookup_record(self, match_key, lookup_set, index):
-        self.__match_keys[match_key] = (lookup_set, index)
\ No newline at end of file
+        self.__match_keys[match_key] = (lookup_set, index)
+        
+        
+    # -- Sort-merge join ------------------------------------------------------
+    
+    def _sort_merge_join(self, name, inputs, record_set):
+        '''Join subject records to lookup records by stepping through both
+        in match key order
+        '''
+        lookup_records = self._sorted_input(inputs, self.list_lookup_inputs(),
+                                            self._build_lookup_record_key)
+        subject_records = self._sorted_input(inputs,
+                                             self.list_subject_inputs(),
+                                             self.build_lookup_key)
+        
+        current = next(lookup_records, None)
+        for subject_key, subject in subject_records:
+            
+            # Step lookup records up to the subject record's key
+            while current is not None and current[0] < subject_key:
+                current = self._next_merge_lookup(current, lookup_records)
+                
+            match = None
+            if current is not None and current[0] == subject_key:
+                match = current[1]
+            self.join_record(name, subject, self._note_lookup(match),
+                             record_set)
+            
+        # Finish checking for duplicated lookup keys
+        while current is not None:
+            current = self._next_merge_lookup(current, lookup_records)
+            
+            
+    def _next_merge_lookup(self, current, lookup_records):
+        '''Step to the next lookup record with a different key
+        
+        @param current: (match key, record) of the current lookup record
+        @param lookup_records: Generator of sorted (match key, record)
+        '''
+        while True:
+            following = next(lookup_records, None)
+            if following is None or following[0] != current[0]:
+                return following
+            self._handle_duplicate_lookup_match_key(following[0],
+                                                    following[1])
+            
+            
+    def _sorted_input(self, inputs, data_ports, build_key):
+        '''Read records from inputs in match key order
+        
+        @param build_key: Function to build the match key for a record
+        @return: Generator of (match key, record)
+        '''
+        # Check if already sorted
+        in_order = True
+        last_key = None
+        for i, record in enumerate(self._list_input_records(inputs,
+                                                            data_ports)):
+            key = build_key(record)
+            if i > 0 and key < last_key:
+                in_order = False
+                break
+            last_key = key
+            
+        if in_order:
+            records = self._list_input_records(inputs, data_ports)
+        else:
+            sorter = ExternalRecordSorter(build_key)
+            for record in self._list_input_records(inputs, data_ports):
+                sorter.add(record)
+            records = sorter.sorted_records()
+            
+        for record in records:
+            yield build_key(record), record
@@ -0,0 +1,155 @@
+import traceback
+from multiprocessing import Process, Pipe
+
+from EtlProcessorEventManager import EtlProcessorEventManager
+
+
+def run_processor_worker(conn, processor, batch_size):
+    '''Main loop of the worker process started by EtlProcessEventManager
+    
+    Receives (hook_name, args) requests and calls the processor hook.  The
+    records the hook dispatches are sent back as ('records', output_name,
+    records) messages of up to batch_size records, followed by ('done',
+    return value) or ('error', traceback text).  Stops when None is received.
+    '''
+    pending = dict()    # [output_name] = list of records not yet sent
+    
+    def send_pending(output_name):
+        records = pending.pop(output_name, None)
+        if records:
+            conn.send(('records', output_name, records))
+            
+    def dispatch_batch(output_name, records):
+        pending.setdefault(output_name, list()).extend(records)
+        if len(pending[output_name]) >= batch_size:
+            send_pending(output_name)
+            
+    def dispatch_record(output_name, record):
+        dispatch_batch(output_name, [record, ])
+        
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        hook_name, args = request
+        
+        dispatcher = dispatch_record
+        if hook_name == 'process_input_batch':
+            dispatcher = dispatch_batch
+            
+        try:
+            hook = getattr(processor, hook_name)
+            result = hook(*(args + (dispatcher, )))
+            for output_name in pending.keys():
+                send_pending(output_name)
+            conn.send(('done', result))
+        except Exception:
+            pending.clear()
+            conn.send(('error', traceback.format_exc()))
+            
+    conn.close()
+    
+    
+class EtlProcessEventManager(EtlProcessorEventManager):
+    '''Runs a CPU bound processor's hooks in a worker process
+    
+    Threads take turns running Python code, so processors that spend their
+    time computing gain nothing from running in threads alongside each
+    other.  This manager keeps the event loop in its thread, but calls the
+    processor hooks in a worker process started with multiprocessing.
+    Batches of records are pickled over a pipe in both directions.  Serials
+    of records created in the worker stay unique since each process uses its
+    own producer id (see EtlRecord.set_serial_producer_id()).
+    
+    The worker is started when the manager is created, so create managers
+    before starting any of them (forking while other threads are running
+    could copy locks they hold).  Call stop_workers() if the manager won't
+    be started after all.  The worker works on a copy of the processor, so
+    state the processor builds up isn't seen by the original object.
+    Records are always passed to process_input_batch(), so they can be held
+    by returning them but post-record actions can't be used.
+    '''
+    
+    def __init__(self, prc_name, processor, batch_size=None, batch_linger=None):
+        '''Init
+        
+        @param processor: EtlProcessor to be executed by this manager
+        @param batch_size: Max number of records to send per batch
+        @param batch_linger: Max seconds to wait for a batch to fill
+        '''
+        super(EtlProcessEventManager, self).__init__(prc_name, processor,
+                                                     batch_size, batch_linger)
+        
+        self.__conn, worker_conn = Pipe()
+        self.__worker = Process(target=run_processor_worker,
+                                name="%s worker" % (prc_name),
+                                args=(worker_conn, processor, self.batch_size))
+        self.__worker.daemon = True
+        self.__worker.start()
+        worker_conn.close()
+        
+        
+    def _uses_batch_hook(self):
+        return True
+    
+    
+    def run(self):  # Thread start hook
+        try:
+            super(EtlProcessEventManager, self).run()
+        finally:
+            self.stop_workers()
+            
+            
+    def stop_workers(self):
+        '''Stop the worker process (done when the event loop finishes)'''
+        if self.__worker is None:
+            return
+        try:
+            self.__conn.send(None)
+        except (IOError, EOFError):
+            pass
+        if self.error is not None:
+            self.__worker.terminate()   # May be blocked sending records
+        self.__worker.join()
+        self.__conn.close()
+        self.__worker = None
+        
+        
+    @property
+    def worker_pid(self):
+        if self.__worker is None:
+            return None
+        return self.__worker.pid
+    
+    
+    def _call_worker(self, hook_name, *args):
+        '''Call a processor hook in the worker process
+        
+        Records dispatched by the hook are dispatched from this manager as
+        they arrive.
+        
+        @return: Value returned by the hook
+        '''
+        self.__conn.send((hook_name, args))
+        while True:
+            msg = self.__conn.recv()
+            if msg[0] == 'records':
+                self.dispatch_output_batch(msg[1], msg[2])
+            elif msg[0] == 'done':
+                return msg[1]
+            else:
+                error = "Processor %s failed in worker process:\n%s"
+                raise Exception(error % (self.prc_name, msg[1]))
+            
+            
+    def _extract(self):
+        self._call_worker('extract_records')
+        
+        
+    def _process_batch(self, input_name, records):
+        return self._call_worker('process_input_batch', records)
+    
+    
+    def _notify_input_disconnected(self, input_name):
+        self._call_worker('handle_input_disconnected', input_name)
+        
@@ -29,13 +29,41 @@ class EtlProcessor(object):
            -) Call dispatch_output() to send generated records out
       4) (optionally) Define process_input_record() to consume incoming records
            -) Call dispatch_output() to send processed records out
+           -) Or define process_input_batch() to consume many records per call
       5) Define handle_input_disconnected() to respond to a processor that has
          disconnected from an input.  All processors must disconnect by calling
          output_is_finished() when no more records will be generated for that
          output.
+    
+    Set cpu_bound to True for processors that spend their time computing
+    rather than waiting on files or databases.  They are run in a worker
+    process (see EtlProcessEventManager) so they don't compete with other
+    processors for the interpreter.  Every record is pickled to the worker
+    and back, so only do this when the processor does much more work per
+    record than that.
+    
+    Set stateless to True if the records the processor dispatches for an
+    input record don't depend on any other records.  Copies of it can then
+    each handle part of the input (see Workflow.set_replicas()).
+    
+    Set coerce_output_types to True to have the records the processor
+    dispatches converted to the types of their output schema's fields (see
+    EtlSchema.coerce_record()) before they are frozen.  This lets an
+    extractor dispatch text as read.  Records that fail to convert aren't
+    sent.
+    
+    Set allow_fusion to False if the processor must have its own event
+    manager, for example to hold records with post-record actions.
+    Otherwise Workflow.execute_streaming() may call it directly from the
+    processor before it (see FusedProcessorChain).
     '''
     __metaclass__ = ABCMeta
     
+    cpu_bound = False
+    stateless = False
+    coerce_output_types = False
+    allow_fusion = True
+    
     def __init__(self):
         self.data_dir_path = None
         self.tmp_dir_path = None
@@ -75,7 +103,7 @@ class EtlProcessor(object):
         return list()
     
     
-    def extract_records(self):
+    def extract_records(self, dispatcher):
         '''Hook for processor to extract/generate records
         
         These are records that are *not* created from processing input records,
@@ -84,27 +112,97 @@ class EtlProcessor(object):
         
         If you need to generate records after all input records are processed,
         use the handle_input_disconnected() hook.
+        
+        @param dispatcher: Call dispatcher(output_name, record) to send
+            generated records out
+        '''
+        pass
+    
+    
+    def process_input_record(self, record, dispatcher):
+        '''Hook for processor to consume a record received on an input
+        
+        @param record: EtlRecord received
+        @param dispatcher: Call dispatcher(output_name, record) to send
+            generated records out
+        @return: PostRecordProcessingAction, or None for RecordConsumed
+        '''
+        pass
+    
+    
+    def process_input_batch(self, records, dispatcher):
+        '''Hook for processor to consume many records received on an input
+        
+        Override this instead of process_input_record() to work on a whole
+        batch of records at once.  The default passes each record on to
+        process_input_record().
+        
+        Records returned are held and passed in again ahead of the next batch
+        received on the same input.  GetNextInputRecord cannot be used to
+        release them.
+        
+        @param records: List of EtlRecord received on the same input
+        @param dispatcher: Call dispatcher(output_name, records) to send a
+            list of generated records out
+        @return: None if all records were consumed, or the list of records
+            starting with the first one to hold
+        '''
+        def record_dispatcher(output_name, record):
+            dispatcher(output_name, [record, ])
+            
+        for i, record in enumerate(records):
+            action = self.process_input_record(record, record_dispatcher)
+            if action is not None and action.code == 'hold_record':
+                return records[i:]
+        return None
+    
+    
+    def handle_input_disconnected(self, input_name, dispatcher):
+        '''Hook called once all processors connected to an input are finished
+        
+        @param input_name: Name of the input that will receive no more records
+        @param dispatcher: Call dispatcher(output_name, record) to send
+            generated records out
         '''
         pass
     
-#         
-#         Dynamically calls 'gen_<name>_output' method
-#         
-#         @param name: Name of the output to generate
-#         @param inputs: Dictionary of connected input datasets
-#         @param record_set: Container to populate with records
-#         '''
-#         # Get method to generate records
-#         gen_name = 'gen_%s_output' % (name)
-#         try:
-#             gen = getattr(self, gen_name)
-#         except AttributeError:
-#             msg = 'Missing output generator: %s' % (gen_name)
-#             raise Exception(msg)
-#         
-#         # Call method to generate records
-#         gen(inputs, record_set)
-#         
+    
+    def get_cache_fingerprint(self):
+        '''Describe the processor's configuration for the output cache
+        
+        When Workflow.enable_output_cache() has been called, outputs are saved
+        to disk and reused by later runs as long as this returns the same value
+        and the outputs connected to the inputs are unchanged.  Return a string
+        or a tuple of simple values that changes whenever the outputs would.
+        Processors that extract records should include something that changes
+        with the source, such as a file's modification time.
+        
+        @return: Fingerprint, or None to never reuse outputs (default)
+        '''
+        return None
+    
+    
+    def gen_output(self, name, inputs, record_set):
+        '''Generate named output data.
+        
+        Dynamically calls 'gen_<name>_output' method
+        
+        @param name: Name of the output to generate
+        @param inputs: Dictionary of connected input datasets
+        @param record_set: Container to populate with records
+        '''
+        # Get method to generate records
+        gen_name = 'gen_%s_output' % (name)
+        try:
+            gen = getattr(self, gen_name)
+        except AttributeError:
+            msg = 'Missing output generator: %s' % (gen_name)
+            raise Exception(msg)
+        
+        # Call method to generate records
+        gen(inputs, record_set)
+        
+        
     #def gen_<name>_output(self, inputs, output_set):
     #    for record_set in inputs['main_input_name']:
     #        for record in record_set.all_records():
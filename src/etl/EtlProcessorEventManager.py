@@ -1,10 +1,15 @@
+import sys
+import traceback
 from threading import Thread, Lock
 from Queue import Queue, Empty
+from collections import deque
+from time import time
 
-from EtlEvent import InputRecordRecieved
+from EtlEvent import InputRecordBatchRecieved, PrcDisconnectedEvent
 from PostRecordProcessingAction import RecordConsumed
 
 from EtlBuildError import EtlBuildError
+from EtlProcessor import EtlProcessor
 
 class EtlOutputConnection(object):
     '''Holds details about a connected output manager'''
@@ -13,11 +18,15 @@ class EtlOutputConnection(object):
         self.status = None
         self.prc_name = None
         self.port_name = None
+        self.input_name = None
         
         self.prc_manager = None
         self.schema = None
         self.event_queue = None
         self.record_queue = None
+        
+        self.pending = list()       # Records waiting to be sent as a batch
+        self.pending_since = None   # When first pending record was added
 
 
 class EtlInputConnection(object):
@@ -35,35 +44,65 @@ class EtlProcessorEventManager(Thread):
     
     This object manages the event loop and input queues for a processor.
     
+    Output records are sent to connected processors in batches.  A batch is
+    sent once it holds batch_size records, or once its oldest record has
+    waited batch_linger seconds.  One InputRecordBatchRecieved event is sent
+    per batch.
+    
+    If the processor raises an exception, it's kept in error and the
+    connected processors are disconnected so they can still finish.
+    
+    Use for_processor() to create the right manager for a processor.
+    Processors marked cpu_bound get an EtlProcessEventManager, which runs
+    them in a worker process.
+    
     @see EtlProcessor
     '''
     
     MAX_EVENT_Q_SIZE = 1000
-    MAX_RECORD_Q_SZIE = 100
+    MAX_RECORD_Q_SZIE = 100     # Batches, not records
+    
+    RECORD_BATCH_SIZE = 500
+    RECORD_BATCH_LINGER = 0.1   # Seconds
     
     # The states of input connections
     CONN_CONNECTED = 0     # Initial state
     CONN_CLOSSED   = 1     # State after PrcDisconnectedEvent
     
-    def __init__(self, prc_name, processor):
+    def __init__(self, prc_name, processor, batch_size=None, batch_linger=None):
         '''Init
         
         @param processor: EtlProcessor to be executed by this manager
-        @param output_connections: List of WorkflowDataPath for output connections
+        @param batch_size: Max number of records to send per batch
+        @param batch_linger: Max seconds to wait for a batch to fill
         '''
+        super(EtlProcessorEventManager, self).__init__(name=prc_name)
+        
         self.prc = processor
         self.prc_name = prc_name
+        self.error = None       # sys.exc_info() if the processor failed
+        
+        self.batch_size = batch_size
+        if self.batch_size is None:
+            self.batch_size = self.RECORD_BATCH_SIZE
+        self.batch_linger = batch_linger
+        if self.batch_linger is None:
+            self.batch_linger = self.RECORD_BATCH_LINGER
+        
         self.__event_queue = Queue(maxsize=self.MAX_EVENT_Q_SIZE)
         self.__input_queues = dict()    # [input_name] = Queue
+        self.__input_buffers = dict()   # [input_name] = deque of EtlRecord
         self.__held_records = dict()     # [input_name] = EtlRecord
         
         self.__inputs = dict()  # [input_name] = list of EtlInputConnection
-        self.__outpus = dict()  # [output_name] = list of EtlOutputConnection
+        self.__outputs = dict() # [output_name] = list of EtlOutputConnection
         self.__conn_by_id = dict()  # [conn_id] = EtlInputConnection
         
         self.__input_ports = dict()     # [input_name] = EtlProcessorDataPort
         self.__output_ports = dict()    # [output_name] = EtlProcessorDataPort
         
+        self.__use_batch_hook = self._uses_batch_hook()
+        
         
         # Record all input ports
         for port in self.prc.list_inputs():
@@ -83,11 +122,12 @@ class EtlProcessorEventManager(Thread):
                     prc_class_name = self.prc,
                     error_msg = "output %s defined twice" % (port.name))
             self.__output_ports[port.name] = port
-            self.__outpus[port.name] = list()
+            self.__outputs[port.name] = list()
          
         # Setup record input queues
         for name in self.__inputs.keys():
             self.__input_queues[name] = Queue(maxsize=self.MAX_RECORD_Q_SZIE)
+            self.__input_buffers[name] = deque()
             self.__held_records[name] = None
 
              
@@ -97,6 +137,41 @@ class EtlProcessorEventManager(Thread):
 #                 self.__connected_outputs[conn.output_name] = list()
 #             self.__connected_outputs[conn.output_name].append(conn)
         
+    @classmethod
+    def for_processor(cls, prc_name, processor, **kwargs):
+        '''Create the manager to use for a processor
+        
+        @param prc_name: Name of the processor
+        @param processor: EtlProcessor to be executed
+        @param kwargs: Passed on to __init__()
+        @return: EtlProcessEventManager if processor.cpu_bound is set,
+            otherwise EtlProcessorEventManager
+        '''
+        if getattr(processor, 'cpu_bound', False):
+            from EtlProcessEventManager import EtlProcessEventManager
+            return EtlProcessEventManager(prc_name, processor, **kwargs)
+        return EtlProcessorEventManager(prc_name, processor, **kwargs)
+    
+    
+    def _uses_batch_hook(self):
+        '''Check if records should be passed to process_input_batch()
+        
+        Only use the batch hook if the processor provides one.  Otherwise
+        records are passed one at a time so post-record actions can be used.
+        '''
+        default_hook = EtlProcessor.process_input_batch.__func__
+        prc_hook = self.prc.process_input_batch.__func__
+        return prc_hook is not default_hook
+    
+    
+    def stop_workers(self):
+        '''Stop any worker processes started to run the processor
+        
+        Subclasses that start workers when created do this when the event
+        loop finishes.  Call it for a manager that won't be started.
+        '''
+        
+        
     # -- Methods to be called before thread starts (NOT THREAD SAFE) ----------
     
     def register_input(self, input_name, prc_manger, conn_id):
@@ -113,7 +188,7 @@ class EtlProcessorEventManager(Thread):
         # Save Connection Detail        
         conn = EtlInputConnection()
         
-        conn.id = conn_id
+        conn.conn_id = conn_id
         conn.status = self.CONN_CONNECTED
         conn.prc_name = prc_manger.prc_name
         conn.port_name = input_name
@@ -143,16 +218,22 @@ class EtlProcessorEventManager(Thread):
         conn.prc_manager = prc_manger
         conn.prc_name = prc_manger.prc_name
         conn.port_name = output_name
+        conn.input_name = input_name
         conn.schema = self.__output_ports[output_name].schema
         conn.event_queue = prc_manger.get_event_queue()
         conn.record_queue = prc_manger.get_record_queue(input_name)
 
-        self.__outputs[input_name].append(conn)
+        self.__outputs[output_name].append(conn)
         self.__conn_by_id[conn_id] = conn
         
         
     def run(self):  # Thread start hook
-        self.run_event_loop()
+        try:
+            self.run_event_loop()
+        except Exception:
+            self.error = sys.exc_info()
+            self.notify_error(traceback.format_exc())
+            self._abandon()
         
                             
     # -- Methods to be called from this thread (NOT THREAD SAFE) --------------
@@ -161,16 +242,17 @@ class EtlProcessorEventManager(Thread):
         '''This is the "main" loop of this thread'''
         
         # Let processor extract records
-        self.prc.extract_records(self.dispatch_output_record)
+        self._extract()
+        self.flush_outputs()
         
         # Receive events from other processors
         while self.waiting_on_more_input():
-            event = self.__event_queue.get()
+            event = self._get_next_event()
+            if event is None:
+                continue
              
-            if event.type == 'input_record':
-                get_next = True
-                while get_next:
-                    get_next = self._handle_input_record_event(event)
+            if event.type == 'input_batch':
+                self._handle_input_batch_event(event)
                     
             elif event.type == 'input_disconnected':
                 self._handle_disconnect_event(event)
@@ -178,59 +260,172 @@ class EtlProcessorEventManager(Thread):
             else:
                 raise Exception("Unknown event type: " + event.type)
             
+        # Inform connected processors that no more records are coming
+        self.flush_outputs()
+        self._disconnect_outputs()
+            
+            
+    def _get_next_event(self):
+        '''Wait for the next event, sending lingering output batches
+        
+        @return: Next event, or None if a batch linger time expired first
+        '''
+        oldest = None
+        for conns in self.__outputs.values():
+            for conn in conns:
+                if conn.pending_since is not None:
+                    if oldest is None or conn.pending_since < oldest:
+                        oldest = conn.pending_since
+        
+        # Nothing waiting to be sent
+        if oldest is None:
+            return self.__event_queue.get()
+        
+        try:
+            timeout = max(0, oldest + self.batch_linger - time())
+            return self.__event_queue.get(timeout=timeout)
+        except Empty:
+            self._send_lingering_batches()
+            return None
+            
             
+    def _abandon(self):
+        '''Let connected processors finish after this one has failed
+        
+        Tells the processors on the outputs that no more records are coming,
+        and discards input until all inputs disconnect so that the processors
+        sending it don't block on full queues.
+        '''
+        self._disconnect_outputs()
+        while self.waiting_on_more_input():
+            event = self.__event_queue.get()
+            if event.type == 'input_batch':
+                try:
+                    self.__input_queues[event.input_name].get_nowait()
+                except (Empty, KeyError):
+                    pass
+            elif event.type == 'input_disconnected':
+                if self.__conn_by_id.has_key(event.conn_id):
+                    self.__conn_by_id[event.conn_id].status = self.CONN_CLOSSED
+                    
+                    
     def waiting_on_more_input(self):
-        for input_name in self.__inputs:
-            if self.__inputs[input_name].status != self.CONN_CLOSSED:
-                return True
+        for conns in self.__inputs.values():
+            for conn in conns:
+                if conn.status != self.CONN_CLOSSED:
+                    return True
         return False
                     
                             
-    def _handle_input_record_event(self, event):
-        '''Handle an incoming record
-        
-        @return: True if GetNextInputRecord returned
-        '''
+    def _handle_input_batch_event(self, event):
+        '''Handle an incoming batch of records'''
         msg = "Received message"
         if not self._validate_input_name(msg, event.input_name, event.conn_id):
-            return False
+            return
         
         # Validate input state
         if self.__conn_by_id[event.conn_id].status == self.CONN_CLOSSED:
             msg = "Received message for a closed input %s" % (event.input_name)
             self.notify_error(msg)
-            return False
+            return
         
-        # If a record is held on that port, then ignore event
+        # Get records to be processed.  Batches from different connections
+        # to the same input share a queue, so this may not be the batch that
+        # generated the event, but there is one batch queued per event.
         input_name = event.input_name
-        if self.__held_records[input_name] is not None:
-            return False
-            
-        # Get record to be processed
-        record = None
         try:
-            record = self.__input_queues[input_name].get_nowait()
+            batch = self.__input_queues[input_name].get_nowait()
         except Empty:
-            return False
+            return
+        self.__input_buffers[input_name].extend(batch)
+        
+        self._process_input_buffer(input_name)
+        
         
-        # Pass to processor
+    def _process_input_buffer(self, input_name):
+        '''Pass buffered records for an input to the processor
+        
+        Stops if the processor holds a record.  Held records stay at the front
+        of the buffer until released by GetNextInputRecord.
+        '''
+        buffered = self.__input_buffers[input_name]
         dispatcher = self.dispatch_output_record
-        action = self.prc.process_input_record(record, dispatcher)
         
-        # Handle processor requested action
-        if action is None:
-            action = RecordConsumed()
+        if self.__use_batch_hook:
+            self._process_input_buffer_as_batch(input_name)
+            return
         
-        if action.code == 'record_consumed':
-            return False
-        elif action.code == 'hold_record':
-            self.__held_records[input_name] = record
-            return False
-        elif action.code == 'get_next_record':
-            return True
-        else:
-            msg = "Invalid post-record action code: %s"
-            raise Exception(msg % (action.code))
+        while len(buffered) > 0:
+            if self.__held_records[input_name] is not None:
+                return
+            
+            # Pass to processor
+            record = buffered[0]
+            action = self.prc.process_input_record(record, dispatcher)
+            
+            # Handle processor requested action
+            if action is None:
+                action = RecordConsumed()
+            
+            if action.code == 'hold_record':
+                self.__held_records[input_name] = record
+                return
+            
+            buffered.popleft()
+            
+            if action.code == 'record_consumed':
+                pass
+            elif action.code == 'get_next_record':
+                self._release_held_record(action.input_name)
+            else:
+                msg = "Invalid post-record action code: %s"
+                raise Exception(msg % (action.code))
+            
+            
+    def _process_input_buffer_as_batch(self, input_name):
+        '''Pass all buffered records for an input to process_input_batch()'''
+        buffered = self.__input_buffers[input_name]
+        if len(buffered) == 0:
+            return
+        
+        records = list(buffered)
+        buffered.clear()
+        
+        held = self._process_batch(input_name, records)
+        if held is not None:
+            buffered.extend(held)
+            
+            
+    # Calls to the processor hooks.  Overridden to run them somewhere else.
+    
+    def _extract(self):
+        self.prc.extract_records(self.dispatch_output_record)
+        
+        
+    def _process_batch(self, input_name, records):
+        '''Pass a batch of records to process_input_batch()
+        
+        @return: Records held by the processor, or None
+        '''
+        return self.prc.process_input_batch(records,
+                                            self.dispatch_output_batch)
+    
+    
+    def _notify_input_disconnected(self, input_name):
+        self.prc.handle_input_disconnected(input_name,
+                                           self.dispatch_output_record)
+            
+            
+
+    def _release_held_record(self, input_name):
+        '''Resume processing records on an input with a held record'''
+        if not self.__held_records.has_key(input_name):
+            self.notify_error("Cannot get next record on unknown input '%s'"
+                              % (input_name))
+            return
+        if self.__held_records[input_name] is not None:
+            self.__held_records[input_name] = None
+            self._process_input_buffer(input_name)
         
         
     def _validate_input_name(self, context, input_name, conn_id):
@@ -266,7 +461,7 @@ class EtlProcessorEventManager(Thread):
         if self._validate_input_name(msg, input_name, conn_id):
             
             # Close Connection
-            self.__inputs[input_name].status = self.CONN_CLOSSED
+            self.__conn_by_id[conn_id].status = self.CONN_CLOSSED
             
             # Check to see if all connections to this input are clossed
             any_open = False
@@ -275,8 +470,17 @@ class EtlProcessorEventManager(Thread):
                     any_open = True
                     
             if not any_open:
-                dispatcher = self.dispatch_output_record
-                self.prc.handle_input_disconnected(input_name, dispatcher)
+                
+                # Give batch processors a last chance at held records
+                buffered = self.__input_buffers[input_name]
+                if self.__use_batch_hook:
+                    self._process_input_buffer_as_batch(input_name)
+                if len(buffered) > 0:
+                    msg = "Dropping %d held records on disconnected input %s"
+                    self.notify_error(msg % (len(buffered), input_name))
+                    buffered.clear()
+                
+                self._notify_input_disconnected(input_name)
     
     
     def dispatch_output_record(self, output_name, record):
@@ -284,37 +488,143 @@ class EtlProcessorEventManager(Thread):
         
         # Validate output name
         if not self.__output_ports.has_key(output_name):
-            msg = "Output named '%s' does not exist.  " % (output_name)
-            msg += "Use one of the following: "
-            msg += ", ".join(self.__output_ports.keys())
-            self.notify_dispatch_error(record, msg)
+            self._notify_invalid_output_name(output_name, record)
             return
             
-        # Validate record matches output schema
+        # Validate record and finish setting attributes on it
         schema = self.__output_ports[output_name].schema
+        if not self._prepare_output_record(output_name, schema, record):
+            return
+            
+        # Add to batches for connected processor managers
+        for conn in self.__outputs[output_name]:
+            conn.pending.append(record)
+            if conn.pending_since is None:
+                conn.pending_since = time()
+            if len(conn.pending) >= self.batch_size:
+                self._send_batch(conn)
+            elif time() - conn.pending_since >= self.batch_linger:
+                self._send_batch(conn)
+                
+                
+    def dispatch_output_batch(self, output_name, records):
+        '''Called by EtlProcessor to send a list of generated records out'''
+        
+        # Validate output name
+        if not self.__output_ports.has_key(output_name):
+            for record in records:
+                self._notify_invalid_output_name(output_name, record)
+            return
+        
+        # Validate records and finish setting attributes on them
+        schema = self.__output_ports[output_name].schema
+        prepare = self._prepare_output_record
+        records = [r for r in records if prepare(output_name, schema, r)]
+        if len(records) == 0:
+            return
+        
+        # Add to batches for connected processor managers
+        for conn in self.__outputs[output_name]:
+            if conn.pending_since is None:
+                conn.pending_since = time()
+            conn.pending.extend(records)
+            while len(conn.pending) >= self.batch_size:
+                overflow = conn.pending[self.batch_size:]
+                conn.pending = conn.pending[:self.batch_size]
+                self._send_batch(conn)
+                if len(overflow) > 0:
+                    conn.pending = overflow
+                    conn.pending_since = time()
+            if conn.pending_since is not None:
+                if time() - conn.pending_since >= self.batch_linger:
+                    self._send_batch(conn)
+                    
+                    
+    def _prepare_output_record(self, output_name, schema, record):
+        '''Validate and freeze a record being dispatched
+        
+        @return: True if the record can be sent
+        '''
+        # Validate record matches output schema
         errors = schema.check_record_struct(record)
-        if len(errors) > 0:
+        if errors is not None:
             for error in errors:
                 msg = "Record fails validation: " + error
                 self.notify_dispatch_error(record, msg)
-            return
+            return False
+        
+        # Convert values to the field types
+        if self.prc.coerce_output_types and not record.is_frozen:
+            errors = schema.coerce_record(record)
+            if errors is not None:
+                for name in sorted(errors.keys()):
+                    msg = "Record fails type conversion: " + errors[name]
+                    self.notify_dispatch_error(record, msg)
+                return False
         
         # Finish setting attributes on the record
         if not record.is_frozen:
             record.set_source(self.prc_name, output_name)
             record.freeze()
             
-        # Send to connected processor managers
-        for conn in self.__connected_outputs[output_name]:
-            
-            # Send Record
-            queue = conn.dst_prc_manager.get_input_record_queue(conn.input_name)
-            queue.put(record)
+        return True
     
-            # Send Event
-            queue = conn.dst_prc_manager.get_event_queue()
-            event = InputRecordRecieved(conn.input_name)
-            queue.put(event)
+    
+    def _notify_invalid_output_name(self, output_name, record):
+        msg = "Output named '%s' does not exist.  " % (output_name)
+        msg += "Use one of the following: "
+        msg += ", ".join(self.__output_ports.keys())
+        self.notify_dispatch_error(record, msg)
+                
+                
+    def _send_batch(self, conn):
+        '''Send pending records on an output connection as one batch'''
+        if len(conn.pending) == 0:
+            return
+        
+        batch = conn.pending
+        conn.pending = list()
+        conn.pending_since = None
+        
+        # Send Records
+        conn.record_queue.put(batch)
+        
+        # Send Event
+        event = InputRecordBatchRecieved(conn.input_name, conn.conn_id,
+                                         len(batch))
+        conn.event_queue.put(event)
+        
+        
+    def _send_lingering_batches(self):
+        '''Send batches that have waited longer than batch_linger'''
+        now = time()
+        for conns in self.__outputs.values():
+            for conn in conns:
+                if conn.pending_since is not None:
+                    if now - conn.pending_since >= self.batch_linger:
+                        self._send_batch(conn)
+        
+        
+    def flush_outputs(self):
+        '''Send all pending output batches regardless of size'''
+        for conns in self.__outputs.values():
+            for conn in conns:
+                self._send_batch(conn)
+                
+                
+    def _disconnect_outputs(self):
+        '''Tell all connected processors that no more records will be sent'''
+        for output_name, conns in self.__outputs.items():
+            for conn in conns:
+                if conn.status == self.CONN_CLOSSED:
+                    continue
+                conn.status = self.CONN_CLOSSED
+                event = PrcDisconnectedEvent(
+                    input_name = conn.input_name,
+                    src_prc_name = self.prc_name,
+                    src_output_name = output_name,
+                    conn_id = conn.conn_id)
+                conn.event_queue.put(event)
             
     
     def notify_dispatch_error(self, record, error_msg):
@@ -4,31 +4,114 @@ Created on Dec 27, 2012
 @author: nshearer
 '''
 from UserDict import DictMixin
-from threading import Lock
+from array import array
+from itertools import count, islice
+import sys
 
-NEXT_ETL_RECORD_SERIAL = 0L
-NEXT_ETL_RECORD_LOCK = Lock()
+from multiprocessing import current_process
+from multiprocessing.util import register_after_fork
 
-class EtlRecordSerial(object):
-    '''Unique identification for EtlRecords'''
+# Serials are plain ints made of a producer id (the process) in the high bits
+# and a per-process sequence number in the low bits.  Drawing from
+# itertools.count is atomic under the GIL, so no lock is needed.
+SERIAL_SEQUENCE_BITS = 40
+SERIAL_PRODUCER_MASK = 0x7FFFFF
+SERIAL_NESTED_PRODUCER_BITS = 11    # Bits for processes started by a worker
+
+NEXT_ETL_RECORD_SEQ = count().next
+ETL_RECORD_SERIAL_PREFIX = 0
+
+
+# Serials need 64 bits.  Python 2's array has no 'Q' type, and 'L' is only
+# 32 bits where a C long is (such as Windows)
+SERIALS_FIT_ARRAY = array('L').itemsize >= 8
+
+
+def serial_array(serials=()):
+    '''Create a compact sequence to hold record serials
     
-    def __init__(self):
-        global NEXT_ETL_RECORD_SERIAL, NEXT_ETL_RECORD_LOCK
-        with NEXT_ETL_RECORD_LOCK:
-            self.__value = NEXT_ETL_RECORD_SERIAL
-            NEXT_ETL_RECORD_SERIAL += 1L
+    @param serials: Serials to start with
+    @return: An array of unsigned longs where they hold 64 bits, else a list
+    '''
+    if SERIALS_FIT_ARRAY:
+        return array('L', serials)
+    return list(serials)
+
+
+def next_record_serial():
+    '''Allocate the next record serial number'''
+    return ETL_RECORD_SERIAL_PREFIX | NEXT_ETL_RECORD_SEQ()
 
-    def __str__(self):
-        return str(self.__value)
+
+def set_serial_producer_id(producer_id):
+    '''Set the producer id used in serials generated by this process
     
-    def __eq__(self, serial):
-        return self.__value == serial.__value
+    Worker processes started with multiprocessing are given an id
+    automatically.  Call this in any other process that creates records
+    alongside other processes.
     
-    def __hash__(self):
-        return hash(self.__value) # May change to string in the future
-        
+    @param producer_id: Integer unique to this process among the workers
+    '''
+    global NEXT_ETL_RECORD_SEQ, ETL_RECORD_SERIAL_PREFIX
+    producer_id = producer_id & SERIAL_PRODUCER_MASK
+    ETL_RECORD_SERIAL_PREFIX = producer_id << SERIAL_SEQUENCE_BITS
+    NEXT_ETL_RECORD_SEQ = count().next
+    
+    
+def process_producer_id(identity):
+    '''Get the producer id for a process started by multiprocessing
+    
+    multiprocessing numbers the processes each parent starts from a counter
+    that's never reused (the N in the name Process-N), unlike pids, which
+    the OS hands out again once a worker exits.  A process started by a
+    worker is numbered within that worker, so its number is added to its
+    parent's id shifted by SERIAL_NESTED_PRODUCER_BITS.
+    
+    @param identity: Tuple of process numbers from the main process down
+    '''
+    producer_id = 0
+    for number in identity:
+        producer_id = (producer_id << SERIAL_NESTED_PRODUCER_BITS) + number
+    return producer_id
+    
+    
+class _SerialForkHandler(object):
+    '''Reset serial allocation in processes started by multiprocessing'''
+    def after_fork(self):
+        set_serial_producer_id(process_producer_id(
+            current_process()._identity))
+
+ETL_RECORD_FORK_HANDLER = _SerialForkHandler()
+register_after_fork(ETL_RECORD_FORK_HANDLER, _SerialForkHandler.after_fork)
+
+
+# Containers with more items than this are sized from a sample of their items
+SIZE_SAMPLE_ITEMS = 8
 
 
+def estimate_value_size(value):
+    '''Estimate the bytes of memory used by a record value
+    
+    Uses sys.getsizeof().  The items of lists, tuples, sets and dicts are
+    included by sizing the first SIZE_SAMPLE_ITEMS of them and scaling up.
+    '''
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple, set, frozenset, dict)):
+        item_count = len(value)
+        if item_count > 0:
+            sample_size = 0
+            if isinstance(value, dict):
+                for k, v in islice(value.iteritems(), SIZE_SAMPLE_ITEMS):
+                    sample_size += estimate_value_size(k)
+                    sample_size += estimate_value_size(v)
+            else:
+                for v in islice(value, SIZE_SAMPLE_ITEMS):
+                    sample_size += estimate_value_size(v)
+            size += sample_size * item_count / min(item_count,
+                                                   SIZE_SAMPLE_ITEMS)
+    return size
+    
+    
 class EtlRecordFrozen(Exception):
     def __init__(self):
         msg = "Attempting to modify a frozen EtlRecord"
@@ -42,15 +125,19 @@ class EtlRecord(DictMixin):
     output set.
     '''
     
-    def __init__(self, schema, values):
+    def __init__(self, schema, values, serial=None):
         '''Init
         
         @param schema: The Schema this record is being created to match
         @param values: Initial values
+        @param serial: Serial of an existing record being rebuilt.  A new
+            serial is allocated if None.
         '''
         self.__values = values.copy()
         self.__schema = schema
-        self.__serial = EtlRecordSerial()
+        self.__serial = serial
+        if self.__serial is None:
+            self.__serial = next_record_serial()
         self.__frozen = False
         self.__src_processor = None
         self.__src_port = None
@@ -64,7 +151,7 @@ class EtlRecord(DictMixin):
     
     @property
     def serial(self):
-        '''Unique identification of this record'''
+        '''Unique identification of this record (an int)'''
         return self.__serial
     
         
@@ -74,11 +161,21 @@ class EtlRecord(DictMixin):
         return self.values.keys()
     
     
+    def value_names(self):
+        '''Set-like view of the names of the fields set on this record'''
+        return self.__values.viewkeys()
+    
+    
     def note_src_record(self, rec):
         '''Note another record that was processed to help create this record'''
+        self.note_src_serial(rec.serial)
+        
+        
+    def note_src_serial(self, serial):
+        '''Note the serial of a record that helped create this record'''
         self.assert_not_frozen()
         if len(self.__from_records) < 100000:
-            self.__from_records.append(rec.serial)
+            self.__from_records.append(serial)
             
             
     def get_src_record_serials(self):
@@ -147,7 +244,7 @@ class EtlRecord(DictMixin):
         
     @property
     def size(self):
-        '''Estimate records size'''
+        '''Estimate bytes of memory used by the record'''
         if self.__frozen:
             if self.__size_cache is None:
                 self.__size_cache = self._calc_size()
@@ -157,14 +254,14 @@ class EtlRecord(DictMixin):
 
 
     def _calc_size(self):
-        '''Estimate records size'''
-        size = 0
-        for k, v in self.__values.items():
-            size += len(k)
-            if type(v) is str:
-                size += len(v)
-            else:
-                size += 1
+        '''Estimate bytes of memory used by the record
+        
+        Field names are not counted, since they're shared with the schema.
+        '''
+        size = sys.getsizeof(self) + sys.getsizeof(self.__dict__)
+        size += sys.getsizeof(self.__values)
+        for v in self.__values.itervalues():
+            size += estimate_value_size(v)
         return size
 
 
@@ -1,5 +1,36 @@
+import os
+import sys
+import atexit
+import heapq
+import weakref
+from bisect import bisect_left
+from tempfile import NamedTemporaryFile
+from threading import Thread, Lock
+
 from MemoryRecordSet import MemoryRecordSet
 from Sqlite3RecordSet import Sqlite3RecordSet
+from RecordSetMemoryBudget import DEFAULT_RECORD_SET_BUDGET
+from RecordCache import RecordCache
+from EtlRecord import serial_array
+
+# Record sets that have started writing to disk in the background
+FLUSHING_RECORD_SETS = weakref.WeakSet()
+
+
+def wait_for_flushes():
+    '''Wait for record sets to finish writing to disk
+    
+    The flush threads are daemons so they don't keep a finished script
+    running, so this is called at exit to let them finish first.
+    '''
+    for record_set in list(FLUSHING_RECORD_SETS):
+        try:
+            record_set.wait_for_flush()
+        except Exception:
+            pass
+        
+atexit.register(wait_for_flushes)
+
 
 # class EtlRecordSubSet(object):
 #     '''Used to group records'''
@@ -112,17 +143,87 @@ class EtlRecordSet(object):
     This object can be used to store multiple records.  If the volume stays
     small (under a configurable limit) the records will be stored in memory.
     If, however, the number of records based on estimated record size, then
-    the records will be moved off to disk.
+    the records will be moved off to disk.  Records are also moved to disk
+    when the record sets sharing a RecordSetMemoryBudget go over its limit.
+    
+    Records are kept in tiers.  New records go into an active memory segment.
+    When it grows past the limit, the segment is sealed and a background
+    thread writes it to a Sqlite3RecordSet while a new active segment takes
+    new records.  Reads look across all of the tiers.  If the disk falls
+    behind by more than max_pending_segments, add_record() waits for it.
+    The serials of the records written to disk are kept in a sorted array
+    (see EtlRecord.serial_array()), so add_record() can reject a duplicate
+    without reading the disk while a segment is being written.
+    
+    Records read from disk by get_record() are kept in a RecordCache, so
+    records looked up over and over aren't read from disk each time.
     
     Additionally, indexes can be added for retrieving records by values other
     than the record serial
     '''
     
-    def __init__(self, size_until_disk=10000):
+    SIZE_UNTIL_DISK = 32 * 1024 * 1024
+    MAX_PENDING_SEGMENTS = 2
+    READ_CACHE_RECORDS = 1000
+    READ_CACHE_BYTES = 8 * 1024 * 1024
+    
+    def __init__(self, size_until_disk=None, disk_commit_interval=None,
+                 disk_pragmas=None, disk_storage=None, memory_budget=None,
+                 read_cache_records=None, read_cache_bytes=None,
+                 disk_directory=None):
+        '''Init
+        
+        @param size_until_disk: Estimated bytes of records to hold in memory
+            before moving to disk.  Defaults to SIZE_UNTIL_DISK
+        @param disk_commit_interval: Changes between commits once on disk
+        @param disk_pragmas: sqlite PRAGMA settings to use once on disk.
+            See Sqlite3RecordSet.SPILL_PRAGMAS
+        @param disk_storage: How records are stored once on disk.
+            Sqlite3RecordSet.PICKLED (default) or Sqlite3RecordSet.COLUMNAR
+        @param memory_budget: RecordSetMemoryBudget shared with other record
+            sets.  Defaults to DEFAULT_RECORD_SET_BUDGET
+        @param read_cache_records: Max records read from disk to cache.
+            Defaults to READ_CACHE_RECORDS.  Use 0 to not cache.
+        @param read_cache_bytes: Max estimated bytes of records read from disk
+            to cache.  Defaults to READ_CACHE_BYTES.
+        @param disk_directory: Directory to create the disk file in.
+            Defaults to the system temp directory.
+        '''
         self.max_size_until_disk = size_until_disk
+        if self.max_size_until_disk is None:
+            self.max_size_until_disk = self.SIZE_UNTIL_DISK
+        self.disk_commit_interval = disk_commit_interval
+        self.disk_pragmas = disk_pragmas
+        self.disk_storage = disk_storage
+        self.disk_directory = disk_directory
+        self.max_pending_segments = self.MAX_PENDING_SEGMENTS
+        
+        self.__active = MemoryRecordSet()
+        self.__sealed = list()      # Segments waiting to be written to disk
+        self.__disk = None
+        self.__disk_serials = serial_array()    # Sorted disk record serials
+        self.__size = 0
+        self.__count = 0
         
-        self.__store = MemoryRecordSet()
-        self.__on_disk = False
+        self.__tier_lock = Lock()   # Guards the tier lists and counters
+        self.__flush_lock = Lock()  # Held while a segment is written to disk
+        self.__disk_lock = Lock()   # Only one thread may use sqlite at a time
+        self.__flusher = None
+        self.__flush_error = None
+        
+        self.__budget = memory_budget
+        if self.__budget is None:
+            self.__budget = DEFAULT_RECORD_SET_BUDGET
+        self.__budget.register(self)
+        
+        if read_cache_records is None:
+            read_cache_records = self.READ_CACHE_RECORDS
+        if read_cache_bytes is None:
+            read_cache_bytes = self.READ_CACHE_BYTES
+        self.__read_cache = None
+        if read_cache_records > 0:
+            self.__read_cache = RecordCache(read_cache_records,
+                                            read_cache_bytes)
     
     
     def add_record(self, etl_rec, tags=None):
@@ -134,30 +235,291 @@ class EtlRecordSet(object):
         @param tags: List of optional additional tags to be used for retrieving
             this record.  Record must be convertible to a string with str()
         '''
-        # Consider switching to disk storage
-        if not self.__on_disk:
-            if self.__store.size > self.max_size_until_disk:
-                self.convert_to_disk_storage()
-                
+        self._check_flush_error()
+        
         # Add record
         try:
-            self.__store.add_record(etl_rec, tags)
+            with self.__tier_lock:
+                duplicate = self._disk_has_serial(etl_rec.serial)
+                for segment in self.__sealed:
+                    if segment.has_record(etl_rec.serial):
+                        duplicate = True
+                if duplicate:
+                    msg = "Record already in record set"
+                    raise IndexError(etl_rec.create_msg(msg))
+                self.__active.add_record(etl_rec, tags)
+                self.__size += etl_rec.size
+                self.__count += 1
         except Exception, e:
             msg = etl_rec.create_msg("Failed to store record: " + str(e))
             raise Exception(msg)
         
+        self.__budget.note_change(etl_rec.size)
         
-    def convert_to_disk_storage(self):
-        if not self.__on_disk:
+        # Consider moving records to disk
+        if self.__active.size > self.max_size_until_disk:
+            self._seal_active_segment()
+            
+        # Records waiting to be written still count against the budget, so
+        # let the disk catch up while over it
+        if self.__budget.over_limit and len(self.__sealed) > 0:
+            self.wait_for_flush()
+            
             
-            new_store = Sqlite3RecordSet()
+    def spill_to_disk(self):
+        '''Start moving the records held in memory to disk
+        
+        Unlike convert_to_disk_storage(), this doesn't wait for the records to
+        be written.
+        '''
+        self._check_flush_error()
+        self._seal_active_segment()
+            
+            
+    def _seal_active_segment(self):
+        '''Start writing the active segment to disk in the background'''
+        with self.__tier_lock:
+            if self.__active.count == 0:
+                return
+            
+            sealed = self.__active
+            self.__sealed.append(sealed)
+            self.__active = MemoryRecordSet()
+            self._create_disk_store()
+            
+            if self.__flusher is None:
+                self.__flusher = Thread(target=self._flush_sealed_segments,
+                                        name="EtlRecordSet flush")
+                self.__flusher.daemon = True
+                self.__flusher.start()
+                FLUSHING_RECORD_SETS.add(self)
+                
+            disk_behind = len(self.__sealed) > self.max_pending_segments
             
-            for record, tags in self.__store.dump_records():
-                new_store.add_record(record, tags)
+        # Don't get too far ahead of the disk
+        if disk_behind:
+            self.wait_for_flush()
             
-            self.__store = new_store
             
-        self.__on_disk = True
+    def _create_disk_store(self):
+        '''Create the disk tier if needed (call with the tier lock held)'''
+        if self.__disk is None:
+            self.__disk = Sqlite3RecordSet(self.disk_commit_interval,
+                                           self.disk_pragmas,
+                                           self.disk_storage,
+                                           check_same_thread=False,
+                                           directory=self.disk_directory)
+            
+            
+    def _flush_sealed_segments(self):
+        '''Write sealed segments to disk until there are none left
+        
+        Runs in the flush thread
+        '''
+        try:
+            while True:
+                with self.__tier_lock:
+                    if len(self.__sealed) == 0:
+                        self.__flusher = None
+                        return
+                    segment = self.__sealed[0]
+                    
+                with self.__flush_lock:
+                    with self.__disk_lock:
+                        self.__disk.add_records(segment.dump_records())
+                    serials = sorted([record.serial for record, tags
+                                      in segment.dump_records()])
+                    with self.__tier_lock:
+                        self._add_disk_serials(serials)
+                        self.__sealed.remove(segment)
+                self.__budget.note_change(-segment.size)
+        except:
+            with self.__tier_lock:
+                self.__flush_error = sys.exc_info()
+                self.__flusher = None
+                
+                
+    def _add_disk_serials(self, serials):
+        '''Note sorted serials written to disk (call with tier lock held)'''
+        if len(serials) == 0:
+            return
+        disk_serials = self.__disk_serials
+        if len(disk_serials) == 0 or disk_serials[-1] < serials[0]:
+            disk_serials.extend(serials)
+        else:
+            self.__disk_serials = serial_array(heapq.merge(disk_serials,
+                                                           serials))
+            
+            
+    def _disk_has_serial(self, serial):
+        '''Check the serials on disk (call with tier lock held)'''
+        disk_serials = self.__disk_serials
+        i = bisect_left(disk_serials, serial)
+        return i < len(disk_serials) and disk_serials[i] == serial
+    
+    
+    def _check_flush_error(self):
+        '''Re-raise any error hit while writing records to disk'''
+        if self.__flush_error is not None:
+            exc_type, exc_value, exc_tb = self.__flush_error
+            raise exc_type, exc_value, exc_tb
+        
+        
+    def wait_for_flush(self):
+        '''Block until all sealed segments have been written to disk'''
+        while True:
+            with self.__tier_lock:
+                flusher = self.__flusher
+            if flusher is None:
+                break
+            flusher.join()
+        self._check_flush_error()
+        
+        
+    def convert_to_disk_storage(self):
+        '''Write all records to disk now'''
+        self._check_flush_error()
+        self._seal_active_segment()
+        with self.__tier_lock:
+            self._create_disk_store()
+        self.wait_for_flush()
+        
+        
+    def save_copy(self, path, link=False):
+        '''Copy all records to a file
+        
+        The copy can be loaded again with open_file().  Records held in
+        memory stay there: they are written to a new database along with a
+        copy of the disk tier, and the record set itself is left as it was.
+        Don't add or remove records while the copy is being made.
+        
+        @param path: Path of the file to write
+        @param link: Hard link the file written instead of copying it where
+            possible.  If all of the records are already on disk, this links
+            the disk file itself (see Sqlite3RecordSet.save_copy()).
+        '''
+        self._check_flush_error()
+        
+        # Segments only move to disk with the flush lock held, so while it's
+        # held each record is either in a listed segment or on disk
+        with self.__flush_lock:
+            segments, disk = self._list_tiers()
+            records = list()
+            for segment in segments:
+                records.extend(segment.dump_records())
+            if disk is not None and len(records) == 0:
+                with self.__disk_lock:
+                    disk.save_copy(path, link)
+                return
+            
+            snapshot = None
+            if disk is not None:
+                snapshot = NamedTemporaryFile(dir=self.disk_directory,
+                                              delete=False).name
+                with self.__disk_lock:
+                    disk.save_copy(snapshot)
+                    
+        try:
+            copy = Sqlite3RecordSet(self.disk_commit_interval,
+                                    self.disk_pragmas,
+                                    self.disk_storage,
+                                    copy_from=snapshot,
+                                    directory=self.disk_directory,
+                                    link_copy=True)
+        finally:
+            if snapshot is not None:
+                os.unlink(snapshot)
+        try:
+            copy.add_records(records)
+            copy.save_copy(path, link)
+        finally:
+            copy.close()
+            
+            
+    @classmethod
+    def open_file(cls, path, link=False, **kwargs):
+        '''Create a record set holding a copy of a file from save_copy()
+        
+        @param path: Path of the file written by save_copy()
+        @param link: Hard link the file instead of copying it where possible.
+            Changes made to the record set then change the file too.
+        @param kwargs: Passed on to __init__()
+        '''
+        record_set = cls(**kwargs)
+        disk = Sqlite3RecordSet.open_file(path,
+                                          record_set.disk_commit_interval,
+                                          record_set.disk_pragmas,
+                                          check_same_thread=False,
+                                          directory=record_set.disk_directory,
+                                          link=link)
+        with record_set.__tier_lock:
+            record_set.__disk = disk
+            record_set.__disk_serials = serial_array(disk.list_serials())
+            record_set.__count = disk.count
+            record_set.__size = disk.size
+        return record_set
+        
+        
+    def close(self):
+        '''Release all records and delete the file on disk
+        
+        The record set is left empty and shouldn't be used after this.
+        '''
+        try:
+            self.wait_for_flush()
+        finally:
+            self.__budget.unregister(self)
+            with self.__tier_lock:
+                self.__active = MemoryRecordSet()
+                self.__sealed = list()
+                disk = self.__disk
+                self.__disk = None
+                self.__disk_serials = serial_array()
+                self.__size = 0
+                self.__count = 0
+            if self.__read_cache is not None:
+                self.__read_cache.clear()
+            if disk is not None:
+                with self.__disk_lock:
+                    disk.close()
+        
+        
+    def _list_tiers(self):
+        '''Get the memory segments (oldest first) and the disk store'''
+        with self.__tier_lock:
+            segments = self.__sealed[:]
+            segments.append(self.__active)
+            return segments, self.__disk
+        
+        
+    def _scan_tiers(self, read):
+        '''Read records from every tier
+        
+        A segment being flushed is on disk and in memory at the same time, so
+        records read from disk are skipped if they're also in a segment.
+        
+        @param read: Function to call with each store to read its records
+        @return: Generator of records
+        '''
+        self._check_flush_error()
+        segments, disk = self._list_tiers()
+        
+        if disk is not None:
+            records = read(disk)
+            while True:
+                with self.__disk_lock:
+                    record = next(records, None)
+                if record is None:
+                    break
+                for segment in segments:
+                    if segment.has_record(record.serial):
+                        break
+                else:
+                    yield record
+                    
+        for segment in segments:
+            for record in read(segment):
+                yield record
         
         
     def get_record(self, serial):
@@ -167,42 +529,188 @@ class EtlRecordSet(object):
             Record identifier
         @return EtlRecord
         '''
-        return self.__store.get_record(serial)
+        self._check_flush_error()
+        segments, disk = self._list_tiers()
+        for segment in segments:
+            if segment.has_record(serial):
+                return segment.get_record(serial)
+        if disk is None:
+            raise KeyError(serial)
+        
+        if self.__read_cache is None:
+            with self.__disk_lock:
+                return disk.get_record(serial)
+            
+        record = self.__read_cache.get(serial)
+        if record is None:
+            with self.__disk_lock:
+                record = disk.get_record(serial)
+                self.__read_cache.put(record)
+        return record
     
         
     def has_record(self, serial):
-        return self.__store.has_record(serial)
+        segments, disk = self._list_tiers()
+        for segment in segments:
+            if segment.has_record(serial):
+                return True
+        if disk is None:
+            return False
+        with self.__disk_lock:
+            return disk.has_record(serial)
+    
+    
+    def all_records(self):
+        '''Iterate over every record in the set
+        
+        Records on disk are read a batch at a time rather than loaded at once.
+        
+        @return: Generator of records
+        '''
+        return self._scan_tiers(lambda store: store.all_records())
+            
+            
+    def iter_records(self, batch_size=None):
+        '''Iterate over every record in the set in batches
+        
+        @param batch_size: Max number of records to include in each batch
+        @return: Generator of lists of records
+        '''
+        if batch_size is None:
+            batch_size = Sqlite3RecordSet.ITER_BATCH_SIZE
+            
+        def read(store):
+            for records in store.iter_records(batch_size):
+                for record in records:
+                    yield record
+                    
+        batch = list()
+        for record in self._scan_tiers(read):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = list()
+        if len(batch) > 0:
+            yield batch
     
     
     def find_records_with_tag(self, tag):
         '''Find records that have a given tag'''
-        for record in self.__store.find_records_with_tag(tag):
-            yield record
+        return self._scan_tiers(lambda store: store.find_records_with_tag(tag))
                 
                 
+    def find_records_with_tags(self, tags, match_all=True):
+        '''Find records that have several tags
+        
+        @param tags: List of tags to search for
+        @param match_all: If True, find records that have all of the tags.
+            Otherwise, find records that have any of them.
+        '''
+        return self._scan_tiers(
+            lambda store: store.find_records_with_tags(tags, match_all))
+    
+    
+    def find_records_with_tag_prefix(self, prefix):
+        '''Find records with a tag that starts with prefix'''
+        return self._scan_tiers(
+            lambda store: store.find_records_with_tag_prefix(prefix))
+    
+    
+    def find_records_with_tag_range(self, low=None, high=None):
+        '''Find records with a tag where low <= tag < high
+        
+        Tags are compared as strings.
+        
+        @param low: Lowest tag to include, or None for no lower limit
+        @param high: Tag to stop before, or None for no upper limit
+        '''
+        return self._scan_tiers(
+            lambda store: store.find_records_with_tag_range(low, high))
+    
+    
+    def get_records(self, serials):
+        '''Retrieve several records
+        
+        Serials not in the set are skipped.  Records are read from disk in
+        batches rather than one query per record.
+        
+        @param serials: Record identifiers
+        '''
+        serials = list(serials)
+        return self._scan_tiers(lambda store: store.get_records(serials))
+    
+    
     def has_record_with_tag(self, tag):
-        return self.__store.has_record_with_tag(tag)
+        segments, disk = self._list_tiers()
+        for segment in segments:
+            if segment.has_record_with_tag(tag):
+                return True
+        if disk is None:
+            return False
+        with self.__disk_lock:
+            return disk.has_record_with_tag(tag)
                 
                 
     def remove_record(self, serial):
         '''Drop a record from the collection'''
-        return self.__store.remove_record(serial)
+        self._check_flush_error()
+        
+        # Don't remove records out from under a segment being flushed
+        with self.__flush_lock:
+            segments, disk = self._list_tiers()
+            for segment in segments:
+                if segment.has_record(serial):
+                    record = segment.get_record(serial)
+                    segment.remove_record(serial)
+                    self.__budget.note_change(-record.size)
+                    break
+            else:
+                if disk is None:
+                    raise KeyError(serial)
+                with self.__disk_lock:
+                    record = disk.get_record(serial)
+                    disk.remove_record(serial)
+                    if self.__read_cache is not None:
+                        self.__read_cache.discard(serial)
+                with self.__tier_lock:
+                    i = bisect_left(self.__disk_serials, serial)
+                    del self.__disk_serials[i]
+                    
+            with self.__tier_lock:
+                self.__size -= record.size
+                self.__count -= 1
             
         
     @property
     def size(self):
         '''Estimated size of the record set'''
-        return self.__store.size
+        return self.__size
+    
+    
+    @property
+    def memory_size(self):
+        '''Estimated bytes of records held in memory
+        
+        Includes sealed segments until they have been written to disk.
+        '''
+        segments, disk = self._list_tiers()
+        return sum([segment.size for segment in segments])
     
     
     @property
     def count(self):
-        return self.__store.count
+        return self.__count
     
     
     @property
     def on_disk(self):
-        return self.__on_disk
+        return self.__disk is not None
+    
+    
+    @property
+    def read_cache(self):
+        '''RecordCache of records read from disk (None if not caching)'''
+        return self.__read_cache
         
 #         # -- Check Record -----------------------------------------------------
 #         
@@ -0,0 +1,206 @@
+import os
+import select
+from multiprocessing import Process, Pipe
+
+from EtlProcessorEventManager import EtlProcessorEventManager
+from EtlProcessEventManager import run_processor_worker
+
+
+class EtlReplicatedEventManager(EtlProcessorEventManager):
+    '''Runs copies of a stateless processor in several worker processes
+    
+    Each batch of input records is split between the replicas, which
+    process their parts at the same time.  Their output records are merged
+    back into the outputs of this manager.
+    
+    Partitioning:
+      ROUND_ROBIN - Each batch is cut into one run of records per replica,
+                    starting with the next replica in turn
+      HASH        - Records go to the replica picked by the hash of the
+                    partition_key field, so equal keys always go to the same
+                    replica
+    
+    With preserve_order (ROUND_ROBIN only), output records are dispatched in
+    the order of the input records they came from.  Otherwise each replica's
+    output is dispatched as soon as it's ready (except on Windows, where
+    pipes can't be waited on together).
+    
+    extract_records() is only called on the first replica.  Records held by
+    replicas are passed in again with the next batch, but possibly to a
+    different replica.  See EtlProcessEventManager for the other
+    restrictions of running processors in worker processes.
+    '''
+    
+    ROUND_ROBIN = 'round_robin'
+    HASH = 'hash'
+    
+    def __init__(self, prc_name, processor, replicas, partition=None,
+                 partition_key=None, preserve_order=False, batch_size=None,
+                 batch_linger=None):
+        '''Init
+        
+        @param processor: Stateless EtlProcessor to run copies of
+        @param replicas: Number of copies to run
+        @param partition: ROUND_ROBIN (default) or HASH
+        @param partition_key: Name of the field to hash for HASH
+        @param preserve_order: Keep output records in input order
+        @param batch_size: Max number of records to send per batch
+        @param batch_linger: Max seconds to wait for a batch to fill
+        '''
+        if partition is None:
+            partition = self.ROUND_ROBIN
+        self.check_options(replicas, partition, partition_key,
+                           preserve_order)
+        
+        super(EtlReplicatedEventManager, self).__init__(
+            prc_name, processor, batch_size, batch_linger)
+        
+        self.partition = partition
+        self.partition_key = partition_key
+        self.preserve_order = preserve_order
+        self.__next_replica = 0
+        
+        self.__workers = list()     # (Connection, Process)
+        for i in range(replicas):
+            conn, worker_conn = Pipe()
+            worker = Process(target=run_processor_worker,
+                             name="%s worker %d" % (prc_name, i),
+                             args=(worker_conn, processor, self.batch_size))
+            worker.daemon = True
+            worker.start()
+            worker_conn.close()
+            self.__workers.append((conn, worker))
+    
+    
+    @classmethod
+    def check_options(cls, replicas, partition, partition_key,
+                      preserve_order):
+        '''Raise ValueError if the replication options don't make sense'''
+        if replicas < 1:
+            raise ValueError("Need at least one replica")
+        if partition not in (cls.ROUND_ROBIN, cls.HASH):
+            raise ValueError("Invalid partitioning: %s" % (partition))
+        if partition == cls.HASH and partition_key is None:
+            raise ValueError("HASH partitioning needs a partition_key")
+        if partition == cls.HASH and preserve_order:
+            raise ValueError("Order can only be preserved with ROUND_ROBIN")
+    
+    
+    def _uses_batch_hook(self):
+        return True
+    
+    
+    @property
+    def replicas(self):
+        return len(self.__workers)
+    
+    
+    def run(self):  # Thread start hook
+        try:
+            super(EtlReplicatedEventManager, self).run()
+        finally:
+            self.stop_workers()
+    
+    
+    def stop_workers(self):
+        '''Stop the worker processes (done when the event loop finishes)'''
+        for conn, worker in self.__workers:
+            try:
+                conn.send(None)
+            except (IOError, EOFError):
+                pass
+        for conn, worker in self.__workers:
+            if self.error is not None:
+                worker.terminate()  # May be blocked sending records
+            worker.join()
+            conn.close()
+        self.__workers = list()
+    
+    
+    def _partition(self, records):
+        '''Split records between the replicas
+        
+        @return: List of (replica index, records) in input order
+        '''
+        replicas = len(self.__workers)
+        
+        if self.partition == self.HASH:
+            parts = [list() for i in range(replicas)]
+            for record in records:
+                parts[hash(record[self.partition_key]) % replicas].append(
+                    record)
+            return [(i, part) for i, part in enumerate(parts)
+                    if len(part) > 0]
+        
+        # Round robin runs of records
+        run_size = max(1, -(-len(records) // replicas))
+        parts = list()
+        for start in range(0, len(records), run_size):
+            parts.append((self.__next_replica,
+                          records[start:start+run_size]))
+            self.__next_replica = (self.__next_replica + 1) % replicas
+        return parts
+    
+    
+    def _call_workers(self, calls):
+        '''Call a processor hook in several of the worker processes at once
+        
+        @param calls: List of (replica index, hook name, args)
+        @return: List of the values returned by the hooks, in calls order
+        '''
+        for i, hook_name, args in calls:
+            self.__workers[i][0].send((hook_name, args))
+        
+        results = [None] * len(calls)
+        waiting = range(len(calls))
+        while len(waiting) > 0:
+            
+            # Read replies in call order, or whichever replica is ready
+            ready = waiting[:1]
+            if not self.preserve_order and os.name != 'nt':
+                conns = [self.__workers[calls[c][0]][0] for c in waiting]
+                readable, w, x = select.select(conns, [], [])
+                ready = [c for c in waiting
+                         if self.__workers[calls[c][0]][0] in readable]
+            
+            for c in ready:
+                conn = self.__workers[calls[c][0]][0]
+                while True:
+                    msg = conn.recv()
+                    if msg[0] == 'records':
+                        self.dispatch_output_batch(msg[1], msg[2])
+                        if not self.preserve_order and not conn.poll():
+                            break   # Check other replicas while this works
+                    elif msg[0] == 'done':
+                        results[c] = msg[1]
+                        waiting.remove(c)
+                        break
+                    else:
+                        error = "Processor %s failed in worker process:\n%s"
+                        raise Exception(error % (self.prc_name, msg[1]))
+        
+        return results
+    
+    
+    def _extract(self):
+        self._call_workers([(0, 'extract_records', ()), ])
+    
+    
+    def _process_batch(self, input_name, records):
+        parts = self._partition(records)
+        calls = [(i, 'process_input_batch', (part, )) for i, part in parts]
+        
+        held = list()
+        for result in self._call_workers(calls):
+            if result is not None:
+                held.extend(result)
+        if len(held) == 0:
+            return None
+        return held
+    
+    
+    def _notify_input_disconnected(self, input_name):
+        calls = [(i, 'handle_input_disconnected', (input_name, ))
+                 for i in range(len(self.__workers))]
+        self._call_workers(calls)
+
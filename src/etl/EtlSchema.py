@@ -3,19 +3,100 @@ Created on Dec 27, 2012
 
 @author: nshearer
 '''
+from datetime import date, datetime
+
+
+TRUE_STRINGS = frozenset(['true', 't', 'yes', 'y', '1'])
+FALSE_STRINGS = frozenset(['false', 'f', 'no', 'n', '0'])
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f',
+                '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f')
+
+
+def coerce_int(value):
+    '''Convert a value to an int, accepting whole floats such as "3.0"'''
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, basestring):
+        value = value.strip()
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    number = float(value)
+    if number != int(number):
+        raise ValueError("%r is not a whole number" % (value))
+    return int(number)
+
+
+def coerce_float(value):
+    if isinstance(value, float):
+        return value
+    if isinstance(value, basestring):
+        value = value.strip()
+    return float(value)
+
+
+def coerce_date(value):
+    '''Convert ISO formatted text to a date, or datetime if it has a time'''
+    if isinstance(value, date):
+        return value
+    if isinstance(value, basestring):
+        value = value.strip()
+        for fmt in DATE_FORMATS:
+            try:
+                parsed = datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+            if fmt == '%Y-%m-%d':
+                return parsed.date()
+            return parsed
+    raise ValueError("%r is not an ISO date" % (value))
+
+
+def coerce_bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, long)) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, basestring):
+        text = value.strip().lower()
+        if text in TRUE_STRINGS:
+            return True
+        if text in FALSE_STRINGS:
+            return False
+    raise ValueError("%r is not a boolean" % (value))
+
 
 class EtlSchema(object):
-    '''Describes the structure of a record'''
+    '''Describes the structure of a record
+    
+    Each field has a type_hint.  Extractors usually produce text, so
+    coerce_record() and coerce_columns() convert values to the type named by
+    the hint using the functions in COERCERS.  Fields with a hint not in
+    COERCERS (such as STRING) are left as they are.
+    '''
     
     STRING = 'str'
     INT = 'int'
-    FLOAT = 'int'
+    FLOAT = 'float'
     DATE = 'date'
     BOOL = 'bool'
     
+    # Conversion functions by type_hint.  Each raises ValueError, TypeError or
+    # OverflowError if it can't convert the value.
+    COERCERS = {
+        INT:    coerce_int,
+        FLOAT:  coerce_float,
+        DATE:   coerce_date,
+        BOOL:   coerce_bool,
+        }
+    
     def __init__(self):
         self.__fields = dict()
         self.__field_order = list()
+        self.__field_positions = None
+        self.__field_set = None
+        self.__coercers = None
         
         
     def add_field(self, name, desc=None, header=None, type_hint='str'):
@@ -31,6 +112,9 @@ class EtlSchema(object):
             raise IndexError("Field %s already exists in schema" % (name))
         self.__fields[name] = (header, desc, type_hint)
         self.__field_order.append(name)
+        self.__field_positions = None
+        self.__field_set = None
+        self.__coercers = None
         
         
     def remove_field(self, name):
@@ -39,29 +123,55 @@ class EtlSchema(object):
             raise IndexError("Field %s not in schema" % (name))
         del self.__fields[name]
         self.__field_order.remove(name)
+        self.__field_positions = None
+        self.__field_set = None
+        self.__coercers = None
         
         
     def check_record_struct(self, record):
-        '''Check to see if the record matches this schema'''
+        '''Check to see if the record matches this schema
+        
+        Called for every record dispatched, so records built with this schema
+        object and holding a value for each field pass without building any
+        new sets.  Otherwise the fields listed by record.field_names() are
+        compared (for a record with a schema, these are its schema's fields).
+        
+        @return: None if the record matches, else a list of error messages
+        '''
+        expected_fields = self.field_name_set()
+        if getattr(record, 'schema', None) is self:
+            if len(record.value_names()) == len(expected_fields):
+                return None
+            
+        rec_fields = frozenset(record.field_names())
+        if rec_fields == expected_fields:
+            return None
+        
         errors = list()
-        expected_fields = set(self.__fields.keys())
-        rec_fields = set(record.field_names())
         
         # Check for missing fields
-        for name in expected_fields - rec_fields:
-            msg = "Missing required field '%s'" % (name)
-            errors.append(record.create_msg(msg))
-
+        for name in self.__field_order:
+            if name not in rec_fields:
+                errors.append("Missing required field '%s'" % (name))
+                
         # Check for extra fields
-        for name in rec_fields - expected_fields:
-            msg = "Unknown field '%s'" % (name)
-            errors.append(record.create_msg(msg))
-        
-        if len(errors) == 0:
-            return None
+        for name in sorted(rec_fields):
+            if name not in expected_fields:
+                errors.append("Unknown field '%s'" % (name))
+                
         return errors
     
     
+    def field_name_set(self):
+        '''Get the names of the fields as a frozenset
+        
+        The set is kept until fields are added or removed.
+        '''
+        if self.__field_set is None:
+            self.__field_set = frozenset(self.__field_order)
+        return self.__field_set
+    
+    
     def copy_field(self, from_schema, name):
         '''Copy a field from another schema to this schema'''
         # Get field from schema
@@ -82,8 +192,120 @@ class EtlSchema(object):
         
     def list_field_names(self):
         return self.__field_order[:]
+    
+    
+    def field_positions(self):
+        '''Position of each field in the field order
+        
+        The returned dict is shared, so don't modify it.
+        
+        @return: dict of [field_name] = index
+        '''
+        if self.__field_positions is None:
+            positions = dict()
+            for i, name in enumerate(self.__field_order):
+                positions[name] = i
+            self.__field_positions = positions
+        return self.__field_positions
         
         
+    def field_coercers(self):
+        '''Conversion function for each field in the field order
+        
+        The returned list is shared, so don't modify it.
+        
+        @return: list of (field_name, function), function None if the
+            field's values aren't converted
+        '''
+        if self.__coercers is None:
+            coercers = list()
+            for name in self.__field_order:
+                type_hint = self.__fields[name][2]
+                coercers.append((name, self.COERCERS.get(type_hint)))
+            self.__coercers = coercers
+        return self.__coercers
+    
+    
+    def coerce_value(self, name, value):
+        '''Convert a value to the type of a field
+        
+        None and empty strings become None.
+        
+        @raise ValueError: If the value can't be converted
+        '''
+        func = self.COERCERS.get(self.__fields[name][2])
+        if func is None:
+            return value
+        return self.__convert(name, func, value)
+    
+    
+    def __convert(self, name, func, value):
+        if value is None:
+            return None
+        if isinstance(value, basestring) and value.strip() == '':
+            return None
+        try:
+            return func(value)
+        except (ValueError, TypeError, OverflowError), e:
+            raise ValueError("Can't convert %r to %s for field %s: %s" % (
+                value, self.__fields[name][2], name, str(e)))
+        
+        
+    def coerce_record(self, record):
+        '''Convert the values of a record to the types of its fields
+        
+        Values are replaced in place, so the record must not be frozen.
+        Values that fail to convert are left as they are.
+        
+        @param record: EtlRecord or CompactEtlRecord using this schema
+        @return: None if all values converted, else dict of
+            [field_name] = error message
+        '''
+        errors = None
+        for name, func in self.field_coercers():
+            if func is None:
+                continue
+            value = record.get(name)
+            if value is None:
+                continue
+            try:
+                converted = self.__convert(name, func, value)
+            except ValueError, e:
+                if errors is None:
+                    errors = dict()
+                errors[name] = str(e)
+                continue
+            if converted is not value:
+                record[name] = converted
+        return errors
+    
+    
+    def coerce_columns(self, columns):
+        '''Convert a batch of values held a column per field
+        
+        @param columns: dict of [field_name] = list of values.  Fields not
+            in this schema are returned unchanged.
+        @return: (columns, errors): columns is a new dict of [field_name] =
+            list of converted values with None where conversion failed, and
+            errors is dict of [field_name] = list of (row index, message)
+            for the fields that had failures
+        '''
+        converted = dict(columns)
+        errors = dict()
+        for name, func in self.field_coercers():
+            if func is None or not columns.has_key(name):
+                continue
+            values = list()
+            for i, value in enumerate(columns[name]):
+                try:
+                    values.append(self.__convert(name, func, value))
+                except ValueError, e:
+                    values.append(None)
+                    errors.setdefault(name, list()).append((i, str(e)))
+            converted[name] = values
+        return converted, errors
+    
+    
     def list_fields(self):
         rtn = list()
         for name in self.__field_order:
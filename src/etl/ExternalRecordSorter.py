@@ -0,0 +1,108 @@
+from tempfile import TemporaryFile
+import heapq
+import cPickle
+
+class ExternalRecordSorter(object):
+    '''Sort records that may not fit in memory
+    
+    Records are added one at a time and collected into runs of run_size.
+    Each full run is sorted and written to a temporary file.  Once all
+    records are added, the runs are merged back together, so only one
+    record per run is in memory at a time.
+    
+    The sort is stable: records with equal keys come out in the order added.
+    '''
+    
+    RUN_SIZE = 10000
+    
+    def __init__(self, build_key, run_size=None):
+        '''Init
+        
+        @param build_key: Function to get the key to sort a record by
+        @param run_size: Number of records to sort in memory at a time.
+            Defaults to RUN_SIZE
+        '''
+        self.build_key = build_key
+        self.run_size = run_size
+        if self.run_size is None:
+            self.run_size = self.RUN_SIZE
+        
+        self.__run = list()
+        self.__run_files = list()
+        self.__added = 0
+        self.__schemas = list()
+        self.__schema_ids = dict()
+    
+    
+    def add(self, record):
+        '''Add a record to be sorted'''
+        # Entries include the order added to keep the sort stable
+        self.__run.append((self.build_key(record), self.__added, record))
+        self.__added += 1
+        if len(self.__run) >= self.run_size:
+            self._write_run()
+    
+    
+    def _write_run(self):
+        '''Sort the records in memory and write them to a run file'''
+        self.__run.sort(key=lambda entry: entry[:2])
+        
+        run_file = TemporaryFile()
+        pickler = cPickle.Pickler(run_file, cPickle.HIGHEST_PROTOCOL)
+        for key, added, record in self.__run:
+            # Store the schema once, rather than with every record
+            schema = record.schema
+            record.set_schema(None)
+            try:
+                pickler.dump((key, added, self._schema_id(schema), record))
+            finally:
+                record.set_schema(schema)
+            pickler.clear_memo()
+        
+        run_file.seek(0)
+        self.__run_files.append(run_file)
+        self.__run = list()
+    
+    
+    def _schema_id(self, schema):
+        key = id(schema)
+        if not self.__schema_ids.has_key(key):
+            self.__schema_ids[key] = len(self.__schemas)
+            self.__schemas.append(schema)
+        return self.__schema_ids[key]
+    
+    
+    def _read_run(self, run_file):
+        '''Read back the records in a run file'''
+        unpickler = cPickle.Unpickler(run_file)
+        while True:
+            try:
+                key, added, schema_id, record = unpickler.load()
+            except EOFError:
+                run_file.close()
+                return
+            record.set_schema(self.__schemas[schema_id])
+            yield key, added, record
+    
+    
+    def sorted_records(self):
+        '''Get all of the records added in key order
+        
+        Can only be called once.
+        
+        @return: Generator of records
+        '''
+        if len(self.__run_files) == 0:
+            # Everything fits in memory
+            self.__run.sort(key=lambda entry: entry[:2])
+            runs = [iter(self.__run), ]
+        else:
+            if len(self.__run) > 0:
+                self._write_run()
+            runs = [self._read_run(f) for f in self.__run_files]
+        
+        for key, added, record in heapq.merge(*runs):
+            yield record
+        
+        self.__run = list()
+        self.__run_files = list()
@@ -0,0 +1,143 @@
+from EtlProcessor import EtlProcessor
+
+class FusedProcessorChain(EtlProcessor):
+    '''Runs a chain of one-in/one-out processors as a single processor
+    
+    Each processor's only output feeds the next processor's only input, and
+    the first processor has one input too, so that its disconnect is the
+    end of input for the whole chain.
+    Records dispatched by a processor in the chain are passed straight to
+    the next one, rather than through an event manager, its queues and a
+    thread hand-off.  Only the inputs of the first processor and the
+    outputs of the last are seen from outside.
+    
+    Records passed between processors in the chain are not checked against
+    the schema or frozen unless validate_hops is set.  Processors after the
+    first can't hold records.
+    '''
+    
+    def __init__(self, names, processors, validate_hops=False):
+        '''Init
+        
+        @param names: Names of the processors in chain order
+        @param processors: EtlProcessor objects in chain order
+        @param validate_hops: Check and freeze records passed between
+            processors in the chain, as an event manager would
+        '''
+        super(FusedProcessorChain, self).__init__()
+        self.names = names
+        self.processors = processors
+        self.validate_hops = validate_hops
+        
+        # Only the last processor may convert its output types (see
+        # Workflow._find_fusable_chains()), which the manager does
+        self.coerce_output_types = processors[-1].coerce_output_types
+        
+        # Port passing records to the next processor in the chain
+        self.__hop_ports = [prc.list_outputs()[0] for prc in processors[:-1]]
+        
+        default_hook = EtlProcessor.process_input_batch.__func__
+        self.__batch_hooks = [prc.process_input_batch.__func__ is not
+                              default_hook for prc in processors]
+        self.__emit = None      # Sends records out of the last processor
+    
+    
+    def list_inputs(self):
+        return self.processors[0].list_inputs()
+    
+    
+    def list_outputs(self):
+        return self.processors[-1].list_outputs()
+    
+    
+    # -- Processor hooks ------------------------------------------------------
+    
+    def extract_records(self, dispatcher):
+        self.__emit = self._record_emitter(dispatcher)
+        for i, prc in enumerate(self.processors):
+            prc.extract_records(self._record_dispatcher(i))
+    
+    
+    def process_input_batch(self, records, dispatcher):
+        self.__emit = dispatcher
+        return self._call_processor(0, records)
+    
+    
+    def handle_input_disconnected(self, input_name, dispatcher):
+        '''Pass the disconnect down the chain
+        
+        Once the first processor's input is finished, it has nothing more to
+        send on its output, so the next processor's input is finished too.
+        '''
+        self.__emit = self._record_emitter(dispatcher)
+        self.processors[0].handle_input_disconnected(
+            input_name, self._record_dispatcher(0))
+        for i in range(1, len(self.processors)):
+            input_name = self.processors[i].list_inputs()[0].name
+            self.processors[i].handle_input_disconnected(
+                input_name, self._record_dispatcher(i))
+    
+    
+    # -- Passing records along the chain --------------------------------------
+    
+    def _record_emitter(self, dispatcher):
+        '''Wrap a record dispatcher to take lists of records'''
+        def emit(output_name, records):
+            for record in records:
+                dispatcher(output_name, record)
+        return emit
+    
+    
+    def _record_dispatcher(self, i):
+        '''Dispatcher given to processor i to send single records'''
+        return lambda output_name, record: self._hop(i, output_name,
+                                                     [record, ])
+    
+    
+    def _batch_dispatcher(self, i):
+        '''Dispatcher given to processor i to send lists of records'''
+        return lambda output_name, records: self._hop(i, output_name,
+                                                      records)
+    
+    
+    def _hop(self, i, output_name, records):
+        '''Pass records dispatched by processor i on to the next one'''
+        if i == len(self.processors) - 1:
+            self.__emit(output_name, records)
+            return
+        
+        port = self.__hop_ports[i]
+        if output_name != port.name:
+            msg = "Processor %s dispatched to unknown output '%s'"
+            raise Exception(msg % (self.names[i], output_name))
+        
+        if self.validate_hops:
+            for record in records:
+                errors = port.schema.check_record_struct(record)
+                if errors is not None:
+                    raise Exception("Record fails validation: " + errors[0])
+                if not record.is_frozen:
+                    record.set_source(self.names[i], output_name)
+                    record.freeze()
+        
+        self._call_processor(i + 1, records)
+    
+    
+    def _call_processor(self, i, records):
+        '''Pass records to processor i
+        
+        @return: Records held by the processor (only allowed for the first)
+        '''
+        prc = self.processors[i]
+        if self.__batch_hooks[i]:
+            held = prc.process_input_batch(records, self._batch_dispatcher(i))
+        else:
+            held = EtlProcessor.process_input_batch(prc, records,
+                                                    self._batch_dispatcher(i))
+        
+        if held and i > 0:
+            msg = "Processor %s cannot hold records in a fused chain"
+            raise Exception(msg % (self.names[i]))
+        return held
+
+
@@ -1,14 +1,39 @@
 
+from bisect import bisect_left
+import heapq
+
+from tag_ranges import prefix_upper_bound
+from EtlRecord import serial_array
+
 class MemoryRecordSet(object):
     '''Stores records in memory.
     
     Don't use this class directly, but use EtlRecordSet instead
+    
+    Tags are compared by their str() value, and each distinct tag is given an
+    integer id.  The serials of the records with a tag are kept in an array
+    (a posting list), so a tag costs 8 bytes per record rather than a set
+    entry, and postings for several tags can be intersected or merged in
+    order.
+    
+    Serials are appended to these arrays, and to the array of all serials,
+    as records are added.  Records usually arrive in serial order, but not
+    always (such as the merged output of replicas), so an array that gets a
+    serial out of order, or has a record removed, is marked and then sorted
+    and cleaned up the next time it's read.
     '''
     
     def __init__(self):
         self.__records = dict()
-        self.__tags = dict()
-        self.__record_tags = dict()
+        self.__serials = serial_array() # serials of all records
+        self.__serials_sorted = True    # False until __serials is rebuilt
+        self.__tag_ids = dict()         # str(tag) -> tag id
+        self.__tag_names = list()       # tag id -> str(tag)
+        self.__sorted_tags = list()     # str(tag) in order for range queries
+        self.__tags_sorted = True       # False until new tags are sorted
+        self.__postings = list()        # tag id -> array of serials
+        self.__unsorted_postings = set()    # tag ids of postings to rebuild
+        self.__record_tags = dict()     # serial -> tuple of tag ids
         self.__size = 0
         
     
@@ -21,11 +46,37 @@ class MemoryRecordSet(object):
             record = self.__records[serial]
             tags = list()
             if self.__record_tags.has_key(serial):
-                tags = list(self.__record_tags[serial])
+                tags = [self.__tag_names[i] for i in self.__record_tags[serial]]
             
             yield record, tags
     
     
+    def all_records(self):
+        '''Iterate over every record in the set, in serial order
+        
+        @return: Generator of records
+        '''
+        for serial in self._sorted_serials():
+            if self.__records.has_key(serial):
+                yield self.__records[serial]
+    
+    
+    def iter_records(self, batch_size=1000):
+        '''Iterate over every record in the set in batches
+        
+        @param batch_size: Max number of records to include in each batch
+        @return: Generator of lists of records
+        '''
+        batch = list()
+        for record in self.all_records():
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = list()
+        if len(batch) > 0:
+            yield batch
+    
+    
     def add_record(self, etl_rec, tags=None):
         '''Add a record to the collection
         
@@ -45,21 +96,94 @@ class MemoryRecordSet(object):
         
         # Add Record
         self.__records[etl_rec.serial] = etl_rec
+        if not self._append_serial(self.__serials, etl_rec.serial):
+            self.__serials_sorted = False
         
         # Save Tag Values
         if type(tags) is str:
             tags = [tags, ]
         if tags is not None:
-            self.__record_tags[etl_rec.serial] = set(tags)
-            for tag in tags:
-                if not self.__tags.has_key(tag):
-                    self.__tags[tag] = set()
-                self.__tags[tag].add(etl_rec.serial)
+            tag_ids = set([self._intern_tag(tag) for tag in tags])
+            if len(tag_ids) > 0:
+                self.__record_tags[etl_rec.serial] = tuple(tag_ids)
+                for tag_id in tag_ids:
+                    self._add_posting(tag_id, etl_rec.serial)
                 
         # Update Size
         self.__size += etl_rec.size
         
         
+    def _intern_tag(self, tag):
+        '''Get the id for a tag, assigning one if it's new'''
+        tag = str(tag)
+        tag_id = self.__tag_ids.get(tag)
+        if tag_id is None:
+            tag_id = len(self.__tag_names)
+            self.__tag_ids[tag] = tag_id
+            self.__tag_names.append(tag)
+            self.__postings.append(serial_array())
+            self.__sorted_tags.append(tag)
+            self.__tags_sorted = False
+        return tag_id
+    
+    
+    def _list_sorted_tags(self):
+        '''Get every tag in order, sorting any added since the last query
+        
+        Sorted on demand rather than as tags are added, since inserting each
+        new tag into the list would cost O(n) a tag.
+        '''
+        if not self.__tags_sorted:
+            self.__sorted_tags.sort()
+            self.__tags_sorted = True
+        return self.__sorted_tags
+    
+    
+    def _add_posting(self, tag_id, serial):
+        '''Add a serial to a tag's posting list'''
+        if not self._append_serial(self.__postings[tag_id], serial):
+            self.__unsorted_postings.add(tag_id)
+        
+        
+    def _append_serial(self, serials, serial):
+        '''Append a serial to an array of serials
+        
+        @return: False if the array is no longer in order
+        '''
+        in_order = len(serials) == 0 or serials[-1] < serial
+        serials.append(serial)
+        return in_order
+    
+    
+    def _sorted_serials(self):
+        '''Get the serials of all records in order'''
+        if not self.__serials_sorted:
+            self.__serials = serial_array(sorted(self.__records))
+            self.__serials_sorted = True
+        return self.__serials
+    
+    
+    def _sorted_posting(self, tag_id):
+        '''Get the serials of the records with a tag in order'''
+        if tag_id in self.__unsorted_postings:
+            # Drop the serials of removed records, which may have been added
+            # again without this tag, and sort the rest
+            serials = set()
+            for serial in self.__postings[tag_id]:
+                if tag_id in self.__record_tags.get(serial, ()):
+                    serials.add(serial)
+            self.__postings[tag_id] = serial_array(sorted(serials))
+            self.__unsorted_postings.discard(tag_id)
+        return self.__postings[tag_id]
+            
+            
+    def _get_posting(self, tag):
+        '''Get the sorted serials of the records with a tag'''
+        tag_id = self.__tag_ids.get(str(tag))
+        if tag_id is None:
+            return serial_array()
+        return self._sorted_posting(tag_id)
+        
         
     def get_record(self, serial):
         '''Retrieve a record
@@ -77,16 +201,97 @@ class MemoryRecordSet(object):
     
     def find_records_with_tag(self, tag):
         '''Find records that have a given tag'''
-        if self.__tags.has_key(tag):
-            for serial in self.__tags[tag]:
+        for serial in self._get_posting(tag)[:]:
+            yield self.get_record(serial)
+            
+            
+    def find_records_with_tags(self, tags, match_all=True):
+        '''Find records that have several tags
+        
+        @param tags: List of tags to search for
+        @param match_all: If True, find records that have all of the tags.
+            Otherwise, find records that have any of them.
+        @return: Generator of records in serial order
+        '''
+        postings = [self._get_posting(tag)[:] for tag in tags]
+        if len(postings) == 0:
+            return
+        
+        if match_all:
+            # Check each serial in the shortest list against the others
+            postings.sort(key=len)
+            shortest = postings[0]
+            others = postings[1:]
+            for serial in shortest:
+                for posting in others:
+                    i = bisect_left(posting, serial)
+                    if i == len(posting) or posting[i] != serial:
+                        break
+                else:
+                    yield self.get_record(serial)
+                    
+        else:
+            for record in self._merge_postings(postings):
+                yield record
+                
+                
+    def _merge_postings(self, postings):
+        '''Get the records in any of the posting lists, in serial order'''
+        last = None
+        for serial in heapq.merge(*postings):
+            if serial != last:
                 yield self.get_record(serial)
+                last = serial
+                
+                
+    def find_records_with_tag_prefix(self, prefix):
+        '''Find records with a tag that starts with prefix
+        
+        @return: Generator of records in serial order
+        '''
+        prefix = str(prefix)
+        return self.find_records_with_tag_range(prefix,
+                                                prefix_upper_bound(prefix))
+    
+    
+    def find_records_with_tag_range(self, low=None, high=None):
+        '''Find records with a tag where low <= tag < high
+        
+        Tags are compared as strings.
+        
+        @param low: Lowest tag to include, or None for no lower limit
+        @param high: Tag to stop before, or None for no upper limit
+        @return: Generator of records in serial order
+        '''
+        sorted_tags = self._list_sorted_tags()
+        start = 0
+        if low is not None:
+            start = bisect_left(sorted_tags, str(low))
+        end = len(sorted_tags)
+        if high is not None:
+            end = bisect_left(sorted_tags, str(high))
+            
+        postings = list()
+        for tag in sorted_tags[start:end]:
+            postings.append(self._sorted_posting(self.__tag_ids[tag])[:])
+        return self._merge_postings(postings)
+    
+    
+    def get_records(self, serials):
+        '''Retrieve several records
+        
+        Serials not in the set are skipped.
+        
+        @param serials: Record identifiers
+        @return: Generator of records in serial order
+        '''
+        for serial in sorted(set(serials)):
+            if self.__records.has_key(serial):
+                yield self.__records[serial]
                 
                 
     def has_record_with_tag(self, tag):
-        if self.__tags.has_key(tag):
-            if len(self.__tags[tag]) > 0:
-                return True
-        return False
+        return len(self._get_posting(tag)) > 0
                 
                 
     def remove_record(self, serial):
@@ -94,15 +299,13 @@ class MemoryRecordSet(object):
         # Deduct size
         self.__size -= self.__records[serial].size
         
-        # Remove record
+        # Remove record.  Its serial is left in the arrays until they're read
         del self.__records[serial]
+        self.__serials_sorted = False
         
         # Clean up tags
         if self.__record_tags.has_key(serial):
-            for tag in self.__record_tags[serial]:
-                self.__tags[tag].remove(serial)
-                if len(self.__tags[tag]) == 0:
-                    del self.__tags[tag]
+            self.__unsorted_postings.update(self.__record_tags[serial])
             del self.__record_tags[serial]
             
         
@@ -50,6 +50,6 @@ class GetNextInputRecord(PostRecordProcessingAction):
     prc_input_record() will be popped off the incoming queue.
     '''
     def __init__(self, input_name):
-        super(HoldRecord, self).__init__('get_next_record')
+        super(GetNextInputRecord, self).__init__('get_next_record')
         self.input_name = input_name
                 
\ No newline at end of file
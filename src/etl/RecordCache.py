@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from threading import Lock
+
+class RecordCache(object):
+    '''Least recently used cache of records by serial
+    
+    Holds up to max_records records and max_bytes of record size.  When
+    either limit is passed, the least recently used records are dropped.
+    Counts of hits and misses are kept to show how well it's working.
+    '''
+    
+    def __init__(self, max_records, max_bytes=None):
+        '''Init
+        
+        @param max_records: Max number of records to cache
+        @param max_bytes: Max total estimated size of records to cache, or
+            None for no limit
+        '''
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        
+        self.__records = OrderedDict()
+        self.__size = 0
+        self.__lock = Lock()
+    
+    
+    def get(self, serial):
+        '''Get a record from the cache
+        
+        @return: The record, or None if not cached
+        '''
+        with self.__lock:
+            record = self.__records.pop(serial, None)
+            if record is None:
+                self.misses += 1
+                return None
+            
+            # Move to most recently used
+            self.__records[serial] = record
+            self.hits += 1
+            return record
+    
+    
+    def put(self, record):
+        '''Add a record to the cache'''
+        size = record.size
+        with self.__lock:
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            
+            old = self.__records.pop(record.serial, None)
+            if old is not None:
+                self.__size -= old.size
+            self.__records[record.serial] = record
+            self.__size += size
+            
+            # Drop least recently used
+            while len(self.__records) > self.max_records or (
+                    self.max_bytes is not None and self.__size > self.max_bytes):
+                serial, dropped = self.__records.popitem(last=False)
+                self.__size -= dropped.size
+    
+    
+    def discard(self, serial):
+        '''Remove a record from the cache if it's there'''
+        with self.__lock:
+            record = self.__records.pop(serial, None)
+            if record is not None:
+                self.__size -= record.size
+    
+    
+    def clear(self):
+        with self.__lock:
+            self.__records.clear()
+            self.__size = 0
+    
+    
+    @property
+    def count(self):
+        return len(self.__records)
+    
+    
+    @property
+    def size(self):
+        '''Estimated size of the cached records'''
+        return self.__size
+    
+    
+    @property
+    def hit_rate(self):
+        '''Fraction of gets that were found in the cache'''
+        gets = self.hits + self.misses
+        if gets == 0:
+            return 0.0
+        return float(self.hits) / gets
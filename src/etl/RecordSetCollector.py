@@ -0,0 +1,34 @@
+from EtlProcessor import EtlProcessor, EtlProcessorDataPort
+
+class RecordSetCollector(EtlProcessor):
+    '''Stores the records it receives into a record set
+    
+    Used by Workflow.execute_streaming() to collect the outputs of the
+    processor being executed.
+    '''
+    
+    def __init__(self, schema, record_set, input_name='records'):
+        '''Init
+        
+        @param schema: Schema of the records to be received
+        @param record_set: EtlRecordSet to add records to
+        @param input_name: Name of the input to receive records on
+        '''
+        super(RecordSetCollector, self).__init__()
+        self.schema = schema
+        self.record_set = record_set
+        self.input_name = input_name
+    
+    
+    def list_inputs(self):
+        return [EtlProcessorDataPort(self.input_name, self.schema), ]
+    
+    
+    def list_outputs(self):
+        return []
+    
+    
+    def process_input_batch(self, records, dispatcher):
+        for record in records:
+            self.record_set.add_record(record)
+
@@ -0,0 +1,103 @@
+import weakref
+from threading import Lock
+
+class RecordSetMemoryBudget(object):
+    '''Limit on the memory used by records held by a group of record sets
+    
+    Each EtlRecordSet reports the bytes of records it holds in memory,
+    including records waiting to be written to disk.  When the total goes
+    over the limit, the largest record sets are spilled to disk until the
+    total is back under SPILL_TARGET of the limit.
+    
+    EtlRecordSet objects share DEFAULT_RECORD_SET_BUDGET unless given another
+    budget.  It has no limit until one is set:
+        
+        DEFAULT_RECORD_SET_BUDGET.limit = 512 * 1024 * 1024
+    '''
+    
+    SPILL_TARGET = 0.8
+    
+    def __init__(self, limit=None):
+        '''Init
+        
+        @param limit: Max bytes of records to hold in memory, or None for no
+            limit
+        '''
+        self.limit = limit
+        self.__record_sets = weakref.WeakSet()
+        self.__used = 0
+        self.__lock = Lock()
+    
+    
+    def register(self, record_set):
+        '''Add a record set to the group sharing this budget'''
+        with self.__lock:
+            self.__record_sets.add(record_set)
+            self.__used += record_set.memory_size
+    
+    
+    def unregister(self, record_set):
+        '''Remove a record set from the group'''
+        with self.__lock:
+            if record_set in self.__record_sets:
+                self.__record_sets.discard(record_set)
+                self.__used -= record_set.memory_size
+    
+    
+    @property
+    def used(self):
+        '''Bytes of records held in memory by the record sets'''
+        return sum([rs.memory_size for rs in list(self.__record_sets)])
+    
+    
+    @property
+    def over_limit(self):
+        '''Check if the running estimate of memory use is over the limit'''
+        with self.__lock:
+            return self.limit is not None and self.__used > self.limit
+    
+    
+    def note_change(self, delta):
+        '''Note that a record set's memory use has grown or shrunk
+        
+        This is only a running estimate.  The real total is measured once
+        the estimate goes over the limit.
+        
+        @param delta: Change in bytes
+        '''
+        with self.__lock:
+            self.__used += delta
+            over = self.limit is not None and self.__used > self.limit
+        
+        # Only growth is enforced.  Shrinking is noted by the flush thread,
+        # which mustn't end up waiting on itself.
+        if over and delta > 0:
+            self.enforce()
+    
+    
+    def enforce(self):
+        '''Spill the largest record sets until back under budget'''
+        with self.__lock:
+            if self.limit is None:
+                return
+            
+            sizes = [(rs.memory_size, rs) for rs in list(self.__record_sets)]
+            self.__used = sum([size for size, rs in sizes])
+            
+            spill = list()
+            if self.__used > self.limit:
+                remaining = self.__used
+                target = self.limit * self.SPILL_TARGET
+                sizes.sort(key=lambda s: s[0], reverse=True)
+                for size, record_set in sizes:
+                    if remaining <= target:
+                        break
+                    spill.append(record_set)
+                    remaining -= size
+        
+        # Record sets report their own change in memory as they spill
+        for record_set in spill:
+            record_set.spill_to_disk()
+
+
+DEFAULT_RECORD_SET_BUDGET = RecordSetMemoryBudget()
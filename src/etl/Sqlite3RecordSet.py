@@ -1,53 +1,282 @@
 import os
+import re
+import shutil
+from datetime import date, datetime
 from tempfile import NamedTemporaryFile
 import sqlite3
 import cPickle
 
+from EtlRecord import EtlRecord
+from tag_ranges import prefix_upper_bound
+
+
+def decode_text(value):
+    '''Text factory returning ASCII text as str and other text as unicode
+    
+    sqlite keeps text as UTF-8.  Plain str values, tags and names come back
+    as str as they were given, while non-ASCII text is decoded rather than
+    returned as UTF-8 bytes.
+    '''
+    try:
+        value.decode('ascii')
+        return value
+    except UnicodeDecodeError:
+        return value.decode('utf-8')
+
+
+def link_or_copy(src, dst):
+    '''Hard link a file to a new path, or copy it if it can't be linked
+    
+    Linking is only possible on the same file system, and not at all on some
+    platforms.  Any existing file at dst is replaced.
+    '''
+    if os.path.exists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        shutil.copyfile(src, dst)
+
+
 class Sqlite3RecordSet(object):
     '''Stores records into an sqlite3 database.
     
     Don't use this class directly, but use EtlRecordSet instead
+    
+    Changes are committed every commit_interval changes rather than after
+    each one.  Uncommitted changes are still visible to this object.
+    Transactions are started here rather than by the sqlite3 module, which
+    would commit on its own before creating a COLUMNAR schema table.
+    
+    The database is a throw away temporary file, so it is opened with the
+    SPILL_PRAGMAS performance profile: no durability, an in memory journal
+    and temp store, a large page cache and memory mapped I/O.
+    
+    Records can be stored two ways:
+      PICKLED:  The whole record object is pickled into the records table.
+                Any record type and any picklable values can be stored.
+      COLUMNAR: Each schema gets its own table with a column per field typed
+                by the field's type_hint.  Records are rebuilt from the rows
+                as EtlRecord objects, so values must be types sqlite can
+                store.  Dates are stored as ISO text.  Values must already
+                be of the type named by their field's type_hint (see
+                COLUMN_VALUE_TYPES), since sqlite would otherwise convert
+                them to the column's type and change what's read back.
+                Convert them first with EtlSchema.coerce_record().
     '''
     
-    def __init__(self):
-        self.__path = NamedTemporaryFile(delete=False).name
-        self.__db = sqlite3.connect(self.__path)
+    PICKLED = 'pickled'
+    COLUMNAR = 'columnar'
+    
+    # Column types by EtlSchema type_hint for COLUMNAR storage
+    COLUMN_TYPES = {
+        'str':      'TEXT',
+        'int':      'INTEGER',
+        'float':    'REAL',
+        'date':     'TEXT',
+        'bool':     'INTEGER',
+        }
+    
+    # Types values may have by EtlSchema type_hint for COLUMNAR storage.
+    # None is always allowed, and fields with other hints aren't checked.
+    COLUMN_VALUE_TYPES = {
+        'str':      basestring,
+        'int':      (int, long),
+        'float':    float,
+        'date':     date,       # datetime is a subclass
+        'bool':     bool,
+        }
+    
+    COMMIT_INTERVAL = 1000
+    BULK_INSERT_CHUNK = 1000
+    ITER_BATCH_SIZE = 1000
+    QUERY_PARAM_CHUNK = 500
+    
+    SPILL_PRAGMAS = {
+        'journal_mode':     'MEMORY',   # OFF would break rollback
+        'synchronous':      'OFF',
+        'temp_store':       'MEMORY',
+        'cache_size':       -64 * 1024,         # Negative is in KiB
+        'mmap_size':        256 * 1024 * 1024,  # Bytes
+        }
+    
+    def __init__(self, commit_interval=None, pragmas=None, storage=None,
+                 check_same_thread=True, copy_from=None, directory=None,
+                 link_copy=False):
+        '''Init
+        
+        @param commit_interval: Number of changes to make between commits
+        @param pragmas: dict of sqlite PRAGMA settings to override those in
+            SPILL_PRAGMAS.  Use a value of None to keep the sqlite default.
+        @param storage: PICKLED (default) or COLUMNAR
+        @param check_same_thread: Passed to sqlite3.connect().  Set to False
+            to use the set from more than one thread.  Callers must then make
+            sure only one thread uses it at a time.
+        @param copy_from: Path to a database written by save_copy() to start
+            with a copy of.  storage is then taken from the copy.
+        @param directory: Directory to create the database file in.  Defaults
+            to the system temp directory.
+        @param link_copy: Hard link copy_from instead of copying it where
+            possible.  Changes made to the record set then change that file
+            too.
+        '''
+        self.__path = NamedTemporaryFile(dir=directory, delete=False).name
+        if copy_from is not None:
+            if link_copy:
+                link_or_copy(copy_from, self.__path)
+            else:
+                shutil.copyfile(copy_from, self.__path)
+        self.__db = sqlite3.connect(self.__path,
+                                    check_same_thread=check_same_thread,
+                                    isolation_level=None)
+        self.__db.text_factory = decode_text
+        self.__in_transaction = False
+        
+        self.storage = storage
+        if copy_from is not None:
+            self.storage = self._read_meta('storage')
+        if self.storage is None:
+            self.storage = self.PICKLED
+        if self.storage not in (self.PICKLED, self.COLUMNAR):
+            raise ValueError("Invalid storage mode: %s" % (self.storage))
+        
         self.__schema_ids_by_key = dict()
         self.__schemas_by_id = list()
+        self.__value_types = dict()     # schema id -> [(name, hint, types)]
+        
+        self.commit_interval = commit_interval
+        if self.commit_interval is None:
+            self.commit_interval = self.COMMIT_INTERVAL
+        self.__uncommitted = 0
         
-        self._init_db()
+        settings = self.SPILL_PRAGMAS.copy()
+        if pragmas is not None:
+            settings.update(pragmas)
+        self._set_pragmas(settings)
         
         self.__size = 0
+        if copy_from is None:
+            self._init_db()
+        else:
+            self._load_db()
         
         
     def __del__(self):
+        self.close()
+        
+        
+    def close(self):
+        '''Close the database and delete its file
+        
+        The record set can't be used after this.
+        '''
+        if self.__path is None:
+            return
         self.__db.close()
-        os.unlink(self.__path)
+        if os.path.exists(self.__path):
+            os.unlink(self.__path)
         self.__path = None
         
     
+    def _set_pragmas(self, pragmas):
+        '''Apply sqlite PRAGMA settings to the connection
+        
+        @param pragmas: dict of [pragma name] = value
+        '''
+        curs = self.__db.cursor()
+        for name, value in sorted(pragmas.items()):
+            if value is None:
+                continue
+            if re.match(r'^\w+$', name) is None:
+                raise ValueError("Invalid sqlite pragma name: %s" % (name))
+            if re.match(r'^-?\w+$', str(value)) is None:
+                msg = "Invalid value for sqlite pragma %s: %s"
+                raise ValueError(msg % (name, value))
+            curs.execute("PRAGMA %s = %s" % (name, value))
+            
+            
+    def get_pragma(self, name):
+        '''Get the current value of an sqlite PRAGMA setting'''
+        if re.match(r'^\w+$', name) is None:
+            raise ValueError("Invalid sqlite pragma name: %s" % (name))
+        curs = self.__db.cursor()
+        return curs.execute("PRAGMA %s" % (name)).fetchone()[0]
+    
+    
     def _init_db(self):
         '''Create database tables to hold records'''
+        self._begin()
         curs = self.__db.cursor()
         
         curs.execute('''
             CREATE TABLE records (
-                serial     text     primary key,
+                serial     integer  primary key,
                 record     blob,
-                schema_id  int)
+                schema_id  int,
+                size       int)
             ''')
         
         curs.execute('''
             CREATE TABLE tags (
                 tag        text,
-                serial     text)
+                serial     integer)
             ''')
     
         curs.execute('''
-            CREATE INDEX tag_index ON tags (tag)
+            CREATE INDEX tag_index ON tags (tag, serial)
+            ''')
+        
+        curs.execute('''
+            CREATE INDEX tag_serial_index ON tags (serial)
+            ''')
+        
+        curs.execute('''
+            CREATE TABLE schemas (
+                schema_id  integer  primary key,
+                schema     blob)
+            ''')
+        
+        curs.execute('''
+            CREATE TABLE meta (
+                name       text     primary key,
+                value      text)
+            ''')
+        curs.execute("INSERT INTO meta (name, value) VALUES ('storage', ?)",
+                     (self.storage, ))
+        
+        self.commit()
+        
+        
+    def _load_db(self):
+        '''Load schemas and size from a database copied by __init__()'''
+        curs = self.__db.cursor()
+        
+        rows = curs.execute('''
+            SELECT schema_id, schema
+            FROM schemas
+            ORDER BY schema_id
             ''')
+        for schema_id, pickled in rows.fetchall():
+            schema = cPickle.loads(str(pickled))
+            schema_key = schema.__class__.__name__
+            if not self.__schema_ids_by_key.has_key(schema_key):
+                self.__schema_ids_by_key[schema_key] = list()
+            self.__schema_ids_by_key[schema_key].append(schema_id)
+            self.__schemas_by_id.append(schema)
+            
+        results = curs.execute("SELECT total(size) FROM records")
+        self.__size = int(results.fetchone()[0])
+        
         
-        self.__db.commit()
+    def _read_meta(self, name):
+        '''Read a setting saved in the meta table'''
+        curs = self.__db.cursor()
+        results = curs.execute("SELECT value FROM meta WHERE name = ?",
+                               (name, ))
+        row = results.fetchone()
+        if row is None:
+            return None
+        return row[0]
         
         
     def add_record(self, etl_rec, tags=None):
@@ -59,35 +288,207 @@ class Sqlite3RecordSet(object):
         @param tags: List of optional additional tags to be used for retrieving
             this record.  Record must be convertable to a string with str()
         '''
-        if not etl_rec.is_frozen:
-            raise Exception("Cannot add non-frozen record")
+        self._begin()
+        rows = self._build_rows(etl_rec, tags)
         
-        # Extract schema to save pickled object size
-        schema_id = self._save_schema(etl_rec.schema)
-        etl_rec.set_schema(None) 
-        
-        # Pickle the object and save
-        record_data = cPickle.dumps(etl_rec, cPickle.HIGHEST_PROTOCOL)
         curs = self.__db.cursor()
-        curs.execute("""\
-            insert into records (serial, record, schema_id)
-            values (?, ?, ?)
+        self._insert_rows(curs, [rows, ])
+            
+        # Update Size
+        self.__size += etl_rec.size
+        
+        self._note_change()
+        
+        
+    def add_records(self, records):
+        '''Add many records to the collection in a single transaction
+        
+        If any record fails to be added, none of them are.
+        
+        @param records: Iterable of EtlRecord or (EtlRecord, tags) tuples
+        '''
+        # Start with a clean transaction so a failure only rolls back these
+        self.commit()
+        self._begin()
+        
+        added_size = 0
+        schema_count = len(self.__schemas_by_id)
+        try:
+            curs = self.__db.cursor()
+            rows = list()
+            for item in records:
+                
+                if isinstance(item, tuple):
+                    etl_rec, tags = item
+                else:
+                    etl_rec, tags = item, None
+                    
+                rows.append(self._build_rows(etl_rec, tags))
+                added_size += etl_rec.size
+                
+                if len(rows) >= self.BULK_INSERT_CHUNK:
+                    self._insert_rows(curs, rows)
+                    rows = list()
+                    
+            self._insert_rows(curs, rows)
+            self.commit()
+        except:
+            self._rollback()
+            self._forget_schemas(schema_count)
+            raise
+        
+        # Update Size
+        self.__size += added_size
+        
+        
+    def _insert_rows(self, curs, rows):
+        '''Insert rows built by _build_rows()'''
+        if len(rows) == 0:
+            return
+        
+        curs.executemany("""\
+            insert into records (serial, record, schema_id, size)
+            values (?, ?, ?, ?)
             """,
-            (str(etl_rec.serial), sqlite3.Binary(record_data), schema_id))
+            [r[0] for r in rows])
+        
+        # Save field values
+        if self.storage == self.COLUMNAR:
+            by_schema = dict()
+            for record_row, data_row, tag_rows in rows:
+                schema_id = record_row[2]
+                if not by_schema.has_key(schema_id):
+                    by_schema[schema_id] = list()
+                by_schema[schema_id].append(data_row)
+            for schema_id, data_rows in by_schema.items():
+                sql = "insert into %s values (%s)" % (
+                    self._schema_table_name(schema_id),
+                    ", ".join(["?"] * len(data_rows[0])))
+                curs.executemany(sql, data_rows)
         
         # Save Tag Values
-        if tags is not None:
-            for tag in tags:
-                curs.execute("""\
+        tag_rows = list()
+        for r in rows:
+            tag_rows.extend(r[2])
+        if len(tag_rows) > 0:
+            curs.executemany("""\
                 insert into tags (tag, serial)
                 values (?, ?)
                 """,
-                (str(tag), str(etl_rec.serial)))
+                tag_rows)
+        
+        
+    def _build_rows(self, etl_rec, tags):
+        '''Build the rows to insert to store a record
+        
+        @return: (records row, schema table row, list of tags rows).  The
+            schema table row is None unless using COLUMNAR storage.
+        '''
+        if not etl_rec.is_frozen:
+            raise Exception("Cannot add non-frozen record")
+        
+        serial = etl_rec.serial
+        schema = etl_rec.schema
+        
+        if self.storage == self.COLUMNAR:
+            schema_id = self._save_schema(schema)
+            record_row = (serial, None, schema_id, etl_rec.size)
+            data_row = self._build_columnar_row(etl_rec, schema_id)
+            
+        else:
+            # Extract schema to save pickled object size
+            schema_id = self._save_schema(schema)
+            etl_rec.set_schema(None) 
+            
+            # Pickle the object
+            try:
+                record_data = cPickle.dumps(etl_rec, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                etl_rec.set_schema(schema)
+            
+            record_row = (serial, sqlite3.Binary(record_data), schema_id,
+                          etl_rec.size)
+            data_row = None
+        
+        # Tag Values
+        tag_rows = list()
+        if tags is not None:
+            for tag in tags:
+                tag_rows.append((str(tag), serial))
                 
-        self.__db.commit()
+        return record_row, data_row, tag_rows
+    
+    
+    def _build_columnar_row(self, etl_rec, schema_id):
+        '''Build the row to store a record in its schema's table'''
+        values = etl_rec.values
+        fields = self._list_value_types(schema_id)
+        
+        if len(values) > len(fields):
+            extra = set(values.keys()) - set([f[0] for f in fields])
+            if len(extra) > 0:
+                msg = "Fields not in schema: " + ", ".join(sorted(extra))
+                raise Exception(etl_rec.create_msg(msg))
+        
+        from_records = etl_rec.get_src_record_serials()
+        from_records = ",".join([str(s) for s in from_records])
+        
+        row = [etl_rec.serial,
+               etl_rec.source_processor_name,
+               etl_rec.source_processor_output_name,
+               from_records]
+        for name, type_hint, value_types in fields:
+            value = values.get(name)
+            if value is not None and value_types is not None:
+                if not isinstance(value, value_types) or (
+                        type(value) is bool and type_hint != 'bool'):
+                    msg = "Field %s holds %s %r, not %s, for COLUMNAR storage"
+                    msg = msg % (name, type(value).__name__, value, type_hint)
+                    raise Exception(etl_rec.create_msg(msg))
+            row.append(value)
+        return row
+    
+    
+    def _list_value_types(self, schema_id):
+        '''List (name, type_hint, allowed types) for a schema's fields'''
+        fields = self.__value_types.get(schema_id)
+        if fields is None:
+            fields = list()
+            for field in self._get_stored_schema(schema_id).list_fields():
+                value_types = self.COLUMN_VALUE_TYPES.get(field['type'])
+                fields.append((field['name'], field['type'], value_types))
+            self.__value_types[schema_id] = fields
+        return fields
+    
+    
+    def _note_change(self):
+        '''Commit if enough changes have been made since the last commit'''
+        self.__uncommitted += 1
+        if self.__uncommitted >= self.commit_interval:
+            self.commit()
             
-        # Update Size
-        self.__size += etl_rec.size
+            
+    def _begin(self):
+        '''Start a transaction for changes if one isn't open'''
+        if not self.__in_transaction:
+            self.__db.execute("BEGIN")
+            self.__in_transaction = True
+            
+            
+    def commit(self):
+        '''Commit all changes to the database file'''
+        if self.__in_transaction:
+            self.__db.execute("COMMIT")
+            self.__in_transaction = False
+        self.__uncommitted = 0
+        
+        
+    def _rollback(self):
+        '''Discard all changes since the last commit'''
+        if self.__in_transaction:
+            self.__db.execute("ROLLBACK")
+            self.__in_transaction = False
+        self.__uncommitted = 0
         
         
     def get_record(self, serial):
@@ -96,20 +497,89 @@ class Sqlite3RecordSet(object):
         @param serial: Record identifier
         @return EtlRecord
         '''
-        # Retrieve record
-        curs = self.__db.cursor()
-        results = curs.execute("""\
-            SELECT record, schema_id
-            FROM records
-            WHERE serial = ?
-            """, (str(serial), ))
-        for row in results:
-            return self._rebuild_record(str(row[0]), int(row[1]))
+        for record in self._select_records("", "r.serial = ?", (serial, )):
+            return record
         
         # Not Found
         raise IndexError("Record does not exist: " + str(serial))
     
     
+    def all_records(self):
+        '''Iterate over every record in the set, in serial order
+        
+        Records are read from the database ITER_BATCH_SIZE at a time.
+        
+        @return: Generator of records
+        '''
+        for batch in self.iter_records():
+            for record in batch:
+                yield record
+    
+    
+    def iter_records(self, batch_size=None):
+        '''Iterate over every record in the set in batches
+        
+        @param batch_size: Number of records to read from the database at a
+            time.  Defaults to ITER_BATCH_SIZE
+        @return: Generator of lists of records
+        '''
+        return self._select_record_batches("", "1", (), batch_size)
+    
+    
+    def _select_records(self, joins, where, params):
+        '''Retrieve records from the database
+        
+        The table holding the records is aliased as r in the query.
+        
+        @param joins: SQL joining other tables to the record table
+        @param where: SQL WHERE condition
+        @param params: Parameters for the query
+        @return: Generator of records
+        '''
+        for batch in self._select_record_batches(joins, where, params):
+            for record in batch:
+                yield record
+    
+    
+    def _select_record_batches(self, joins, where, params, batch_size=None):
+        '''Retrieve records from the database a batch at a time
+        
+        Rows are fetched from the cursor batch_size at a time, so the full
+        result is never held in memory.  Records are returned in serial
+        order (within each schema for COLUMNAR storage).
+        
+        @return: Generator of lists of records
+        '''
+        if batch_size is None:
+            batch_size = self.ITER_BATCH_SIZE
+        
+        if self.storage == self.COLUMNAR:
+            for schema_id in range(len(self.__schemas_by_id)):
+                sql = "SELECT r.* FROM %s r %s WHERE %s ORDER BY r.serial" % (
+                    self._schema_table_name(schema_id), joins, where)
+                for rows in self._fetch_batches(sql, params, batch_size):
+                    yield [self._rebuild_columnar_record(schema_id, row)
+                           for row in rows]
+                    
+        else:
+            sql = "SELECT r.record, r.schema_id FROM records r %s WHERE %s"
+            sql = sql % (joins, where) + " ORDER BY r.serial"
+            for rows in self._fetch_batches(sql, params, batch_size):
+                yield [self._rebuild_record(str(row[0]), int(row[1]))
+                       for row in rows]
+                
+                
+    def _fetch_batches(self, sql, params, batch_size):
+        '''Run a query and yield rows from it batch_size at a time'''
+        curs = self.__db.cursor()
+        curs.execute(sql, params)
+        while True:
+            rows = curs.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            yield rows
+    
+    
     def _rebuild_record(self, record_data, schema_id):
         # Unpickle record
         record = cPickle.loads(record_data)
@@ -121,13 +591,61 @@ class Sqlite3RecordSet(object):
         return record
     
     
+    def _rebuild_columnar_record(self, schema_id, row):
+        '''Rebuild a record from a row in a schema table'''
+        schema = self._get_stored_schema(schema_id)
+        
+        values = dict()
+        for i, field in enumerate(schema.list_fields()):
+            value = row[4+i]
+            if value is not None:
+                if field['type'] == 'bool':
+                    # Only bools are stored (as 0 and 1) in bool fields
+                    if type(value) in (int, long) and value in (0, 1):
+                        value = bool(value)
+                elif field['type'] == 'date':
+                    value = self._parse_iso_date(value)
+            values[field['name']] = value
+            
+        record = EtlRecord(schema, values, serial=row[0])
+        if row[1] is not None:
+            record.set_source(row[1], row[2])
+        if row[3]:
+            for serial in row[3].split(','):
+                record.note_src_serial(int(serial))
+        record.freeze()
+        
+        return record
+    
+    
+    def _parse_iso_date(self, value):
+        '''Convert dates stored as ISO text back to date objects'''
+        if isinstance(value, basestring):
+            for fmt in ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f'):
+                try:
+                    parsed = datetime.strptime(value, fmt)
+                except ValueError:
+                    continue
+                if fmt == '%Y-%m-%d':
+                    return parsed.date()
+                return parsed
+        return value
+    
+    
+    def list_serials(self):
+        '''List the serials of all records in serial order'''
+        curs = self.__db.cursor()
+        return [row[0] for row in curs.execute(
+            "SELECT serial FROM records ORDER BY serial")]
+    
+    
     def has_record(self, serial):
         curs = self.__db.cursor()
         results = curs.execute("""\
             SELECT count(*)
             FROM records
             WHERE serial = ?
-            """, (str(serial), ))
+            """, (serial, ))
         if int(results.fetchone()[0]) > 0:
             return True
         return False
@@ -135,19 +653,88 @@ class Sqlite3RecordSet(object):
     
     def find_records_with_tag(self, tag):
         '''Find records that have a given tag'''
-        curs = self.__db.cursor()
+        where = "r.serial IN (SELECT serial FROM tags WHERE tag = ?)"
+        for record in self._select_records("", where, (str(tag), )):
+            yield record
+            
+            
+    def find_records_with_tags(self, tags, match_all=True):
+        '''Find records that have several tags
         
-        # Collect serial numbers for tag
-        results = curs.execute("""\
-            SELECT records.record, records.schema_id
-            FROM tags
-            LEFT JOIN records on tags.serial = records.serial
-            WHERE tags.tag = ?
-            """, (tag, ))
+        @param tags: List of tags to search for
+        @param match_all: If True, find records that have all of the tags.
+            Otherwise, find records that have any of them.
+        @return: Generator of records in serial order
+        '''
+        tags = sorted(set([str(tag) for tag in tags]))
+        if len(tags) == 0:
+            return
+        
+        in_tags = ", ".join(["?"] * len(tags))
+        if match_all:
+            where = """r.serial IN (
+                SELECT serial FROM tags
+                WHERE tag IN (%s)
+                GROUP BY serial
+                HAVING count(DISTINCT tag) = %d)""" % (in_tags, len(tags))
+        else:
+            where = "r.serial IN (SELECT serial FROM tags WHERE tag IN (%s))"
+            where = where % (in_tags)
+            
+        for record in self._select_records("", where, tags):
+            yield record
+            
+            
+    def find_records_with_tag_prefix(self, prefix):
+        '''Find records with a tag that starts with prefix
+        
+        @return: Generator of records in serial order
+        '''
+        prefix = str(prefix)
+        return self.find_records_with_tag_range(prefix,
+                                                prefix_upper_bound(prefix))
+    
+    
+    def find_records_with_tag_range(self, low=None, high=None):
+        '''Find records with a tag where low <= tag < high
+        
+        Tags are compared as strings, using the index on tags.
+        
+        @param low: Lowest tag to include, or None for no lower limit
+        @param high: Tag to stop before, or None for no upper limit
+        @return: Generator of records in serial order
+        '''
+        conditions = list()
+        params = list()
+        if low is not None:
+            conditions.append("tag >= ?")
+            params.append(str(low))
+        if high is not None:
+            conditions.append("tag < ?")
+            params.append(str(high))
+        if len(conditions) == 0:
+            conditions.append("1")
+            
+        where = "r.serial IN (SELECT serial FROM tags WHERE %s)"
+        where = where % (" AND ".join(conditions))
+        for record in self._select_records("", where, params):
+            yield record
+            
+            
+    def get_records(self, serials):
+        '''Retrieve several records
+        
+        Serials not in the set are skipped.
         
-        # Return back records
-        for row in results:
-            yield self._rebuild_record(str(row[0]), int(row[1]))
+        @param serials: Record identifiers
+        @return: Generator of records in serial order
+        '''
+        serials = sorted(set(serials))
+        for i in range(0, len(serials), self.QUERY_PARAM_CHUNK):
+            chunk = serials[i:i+self.QUERY_PARAM_CHUNK]
+            where = "r.serial IN (%s)" % (", ".join(["?"] * len(chunk)))
+            for record in self._select_records("", where, chunk):
+                yield record
         
                 
     def has_record_with_tag(self, tag):
@@ -155,9 +742,8 @@ class Sqlite3RecordSet(object):
         results = curs.execute("""\
             SELECT count(*)
             FROM tags
-            LEFT JOIN records on tags.serial = records.serial
             WHERE tags.tag = ?
-            """, (tag, ) )
+            """, (str(tag), ) )
         if int(results.fetchone()[0]) > 0:
             return True
         return False
@@ -165,20 +751,32 @@ class Sqlite3RecordSet(object):
                 
     def remove_record(self, serial):
         '''Drop a record from the collection'''
+        self._begin()
+        curs = self.__db.cursor()
+        row = curs.execute("""\
+            SELECT schema_id, size
+            FROM records
+            WHERE serial = ?
+            """, (serial, )).fetchone()
+        if row is None:
+            raise IndexError("Record does not exist: " + str(serial))
+        schema_id, size = row
+        
         # Deduct size
-        record = self.get_record(serial)
-        self.__size -= record.size
+        self.__size -= size
         
         # Remove records
-        curs = self.__db.cursor()
-        curs.execute("DELETE FROM records WHERE serial = ?", (str(serial), ))
-        curs.execute("DELETE FROM tags WHERE serial = ?", (str(serial), ))
-        self.__db.commit()
+        curs.execute("DELETE FROM records WHERE serial = ?", (serial, ))
+        curs.execute("DELETE FROM tags WHERE serial = ?", (serial, ))
+        if self.storage == self.COLUMNAR:
+            sql = "DELETE FROM %s WHERE serial = ?"
+            curs.execute(sql % (self._schema_table_name(schema_id)), (serial, ))
+        self._note_change()
         
         
     @property
     def size(self):
-        '''Estimated size of the record set'''
+        '''Estimated bytes of memory the records would use if loaded'''
         return self.__size
     
     
@@ -209,16 +807,102 @@ class Sqlite3RecordSet(object):
         self.__schemas_by_id.append(schema)
         self.__schema_ids_by_key[schema_key].append(schema_id)
         
+        if self.storage == self.COLUMNAR:
+            self._create_schema_table(schema_id, schema)
+        
         return schema_id
         
         
+    def _forget_schemas(self, count):
+        '''Drop schemas saved after the first count
+        
+        Used once the transaction that created their tables is rolled back.
+        '''
+        for schema_id in range(count, len(self.__schemas_by_id)):
+            schema_key = self.__schemas_by_id[schema_id].__class__.__name__
+            self.__schema_ids_by_key[schema_key].remove(schema_id)
+            self.__value_types.pop(schema_id, None)
+        del self.__schemas_by_id[count:]
+        
+        
     def _get_stored_schema(self, schema_id):
         return self.__schemas_by_id[schema_id]
     
     
+    def _schema_table_name(self, schema_id):
+        return "schema_%d" % (int(schema_id))
+    
+    
+    def _create_schema_table(self, schema_id, schema):
+        '''Create the table to hold records for a schema (COLUMNAR storage)'''
+        columns = [
+            "serial integer primary key",
+            "_src_prc text",
+            "_src_port text",
+            "_from_records text",
+            ]
+        for field in schema.list_fields():
+            name = '"f_%s"' % (field['name'].replace('"', '""'))
+            col_type = self.COLUMN_TYPES.get(field['type'], '')
+            columns.append(("%s %s" % (name, col_type)).strip())
+            
+        sql = "CREATE TABLE %s (%s)" % (self._schema_table_name(schema_id),
+                                        ", ".join(columns))
+        self.__db.cursor().execute(sql)
+    
+    
     @property
     def db_path(self):
         return self.__path
+    
+    
+    def save_copy(self, path, link=False):
+        '''Commit and copy the database to a file
+        
+        The copy can be opened again with open_file().
+        
+        @param path: Path of the file to write
+        @param link: Hard link the database file to path instead of copying it
+            where possible.  Only do this once no more changes will be made,
+            since they would change the file at path too.
+        '''
+        self._write_schemas()
+        self.commit()
+        if link:
+            link_or_copy(self.__path, path)
+        else:
+            shutil.copyfile(self.__path, path)
+        
+        
+    def _write_schemas(self):
+        '''Copy the schemas held in memory to the schemas table
+        
+        Schemas are only needed in the table once the database is copied, so
+        they are not written as records are added.
+        '''
+        self._begin()
+        curs = self.__db.cursor()
+        curs.execute("DELETE FROM schemas")
+        for schema_id, schema in enumerate(self.__schemas_by_id):
+            pickled = cPickle.dumps(schema, cPickle.HIGHEST_PROTOCOL)
+            curs.execute(
+                "INSERT INTO schemas (schema_id, schema) VALUES (?, ?)",
+                (schema_id, sqlite3.Binary(pickled)))
+        
+        
+    @classmethod
+    def open_file(cls, path, commit_interval=None, pragmas=None,
+                  check_same_thread=True, directory=None, link=False):
+        '''Create a record set holding a copy of a file from save_copy()
+        
+        The file itself is not changed, unless link is set and records are
+        then changed.  See __init__() for the other parameters.
+        '''
+        return cls(commit_interval, pragmas,
+                   check_same_thread=check_same_thread,
+                   copy_from=path,
+                   directory=directory,
+                   link_copy=link)
         
     
 
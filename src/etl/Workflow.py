@@ -4,12 +4,24 @@ Created on Dec 27, 2012
 @author: nshearer
 '''
 import os
+import sys
+import json
+import shutil
+import hashlib
+from itertools import count
+from threading import Thread, Lock
+from Queue import Queue
 
 from EtlRecordSet import EtlRecordSet
+from WorkflowOutputCache import WorkflowOutputCache
 from EtlBuildError import EtlBuildError
 from InvalidProcessorName import InvalidProcessorName
 from InvalidDataPortName import InvalidDataPortName
 from WorkflowDataPath import WorkflowDataPath
+from EtlProcessorEventManager import EtlProcessorEventManager
+from EtlReplicatedEventManager import EtlReplicatedEventManager
+from RecordSetCollector import RecordSetCollector
+from FusedProcessorChain import FusedProcessorChain
 
 
 class Workflow(object):
@@ -21,8 +33,31 @@ class Workflow(object):
                          record sets
     2) connect_record_set() - Connect the outputs and inputs of processors
     3) exectue() - Run the workflow to generate the desired output. 
+    
+    Set max_workers above 1 to have execute() generate the outputs of
+    independent branches of the graph concurrently.
+    
+    Call enable_output_cache() to save outputs to disk and reuse them in
+    later runs when nothing they depend on has changed.
+    
+    execute() frees each output it generates along the way as soon as every
+    processor consuming it has run.  Use pin_output() to keep one, or set
+    release_outputs to False to keep them all.
+    
+    execute_streaming() runs the processors at the same time instead,
+    streaming records between them.  A slow stateless processor can be given
+    several replicas with set_replicas().  Chains of processors where each
+    one's only output feeds the next one's only input are run together in
+    one thread unless fuse_chains is False.
+    
+    Call enable_checkpoints() before a long run to save each output as it's
+    finished.  If the run dies, resume() picks up where it left off.
     '''
     
+    MANIFEST_FILENAME = 'manifest.json'
+    MANIFEST_VERSION = 3
+    CHECKPOINT_SPILL_DIRNAME = 'spill'
+    
     def __init__(self):
         
         self.default_data_directory = os.curdir # was data_dir_path
@@ -30,9 +65,24 @@ class Workflow(object):
         self.temp_directory = os.path.join(self.default_data_directory, 'tmp')
         # was tmp_dir_path
         
+        self.max_workers = 1
+        
+        self.output_cache = None    # WorkflowOutputCache
+        self.release_outputs = True
+        self.fuse_chains = True
+        self.validate_fused_records = False
+        self.checkpoint_directory = None
+        
         self.__processors = dict()
         self.__record_sets = dict()
         self.__connections = dict()
+        self.__prc_locks = dict()
+        self.__pinned = set()       # (prc_name, output_name)
+        self.__replicas = dict()    # [prc_name] = replication options
+        self.__checkpoints = dict() # [(prc_name, output_name)] = entry
+        self.__checkpoint_lock = Lock()
+        self.__output_keys = None   # [(prc_name, output_name)] = cache key
+        self.__checkpoint_keys = None   # Same, for checkpoint keys
         
         
     # -- Public Methods -------------------------------------------------------
@@ -48,6 +98,7 @@ class Workflow(object):
         self.__processors[name] = prc
         self.__record_sets[name] = dict()
         self.__connections[name] = dict()
+        self.__prc_locks[name] = Lock()
         
         inputs = prc.list_inputs()
         if inputs is not None:
@@ -121,12 +172,248 @@ class Workflow(object):
         self.__connections[to_prc_name][input_name].append(conn)
         
         
-    def execute(self, prc_name):
-        '''Execute the processor (and any dependency processors) and return'''
-        for p_output in self.__processors[prc_name].list_outputs():
-            self.get_output(prc_name, p_output.name)
+    def execute(self, prc_name, workers=None):
+        '''Execute the processor (and any dependency processors) and return
+        
+        @param prc_name: Name of the processor to execute
+        @param workers: Number of outputs to generate at the same time.
+            Defaults to max_workers.
+        '''
+        if workers is None:
+            workers = self.max_workers
+            
+        # Processors and connections don't change during a run, so cache keys
+        # are built once for each output
+        self.__output_keys = dict()
+        self.__checkpoint_keys = dict()
+        try:
+            targets = list()
+            for p_output in self.__processors[prc_name].list_outputs():
+                targets.append((prc_name, p_output.name))
+            plan = self._plan_outputs(targets)
+            
+            on_generated = None
+            if self.release_outputs:
+                on_generated = self._plan_releases(plan, targets)
+            
+            if workers > 1:
+                self._execute_parallel(plan, workers, on_generated)
+            else:
+                for node in plan:
+                    self._generate_output(node[0], node[1])
+                    if on_generated is not None:
+                        on_generated(node)
+        finally:
+            self.__output_keys = None
+            self.__checkpoint_keys = None
     
     
+    def execute_streaming(self, prc_name):
+        '''Run the processor and all processors feeding it at the same time
+        
+        Unlike execute(), records are streamed between processors as they
+        are dispatched (see EtlProcessor.extract_records(),
+        process_input_record() and handle_input_disconnected()) rather than
+        each output being generated in full by gen_output().  The outputs of
+        prc_name are collected and can then be read with get_output().
+        
+        @param prc_name: Name of the processor to execute
+        '''
+        if not self.__processors.has_key(prc_name):
+            raise self._invalid_prc_name(prc_name, "execute_streaming()")
+        
+        # Create managers for all processors feeding prc_name first, since
+        # some start worker processes.  Processors in a fused chain share
+        # one manager.  If building fails, stop the workers already started.
+        names = self._list_upstream_prcs(prc_name)
+        managers = dict()
+        outputs = dict()
+        collectors = list()
+        try:
+            for chain in self._find_fusable_chains(names, prc_name):
+                if len(chain) == 1:
+                    manager = self._create_event_manager(chain[0])
+                else:
+                    manager = self._create_fused_event_manager(chain)
+                for name in chain:
+                    managers[name] = manager
+                    
+            conn_ids = count(1)
+            for name in names:
+                for input_name, conns in self.__connections[name].items():
+                    for conn in conns:
+                        src = managers[conn.src_prc_name]
+                        if src is managers[name]:
+                            continue    # Fused
+                        conn_id = conn_ids.next()
+                        managers[name].register_input(input_name, src, conn_id)
+                        src.register_output(conn.output_name, managers[name],
+                                            input_name, conn_id)
+                        
+            # Collect the outputs of prc_name
+            for port in self.__processors[prc_name].list_outputs():
+                outputs[port.name] = EtlRecordSet()
+                collector = EtlProcessorEventManager(
+                    "%s.%s" % (prc_name, port.name),
+                    RecordSetCollector(port.schema, outputs[port.name]))
+                conn_id = conn_ids.next()
+                collector.register_input('records', managers[prc_name],
+                                         conn_id)
+                managers[prc_name].register_output(port.name, collector,
+                                                   'records', conn_id)
+                collectors.append(collector)
+        except Exception:
+            for manager in set(managers.values()):
+                manager.stop_workers()
+            raise
+            
+        # Run
+        print "Streaming records through %d processors to '%s'" % (
+            len(names), prc_name)
+        all_managers = list(set(managers.values())) + collectors
+        for manager in all_managers:
+            manager.daemon = True
+            manager.start()
+        for manager in all_managers:
+            manager.join()
+        for manager in all_managers:
+            if manager.error is not None:
+                raise manager.error[0], manager.error[1], manager.error[2]
+            
+        for output_name, record_set in outputs.items():
+            self.__record_sets[prc_name][output_name] = record_set
+            
+            
+    def set_replicas(self, prc_name, replicas, partition=None,
+                     partition_key=None, preserve_order=False):
+        '''Run copies of a stateless processor in execute_streaming()
+        
+        See EtlReplicatedEventManager for the options.
+        
+        @param prc_name: Name of a processor with stateless set
+        @param replicas: Number of copies to run.  1 to stop replicating.
+        '''
+        if not self.__processors.has_key(prc_name):
+            raise self._invalid_prc_name(prc_name, "set_replicas()")
+        prc = self.__processors[prc_name]
+        if not prc.stateless:
+            raise EtlBuildError(
+                prc_name = prc_name,
+                prc_class_name = prc.__class__.__name__,
+                error_msg = "Only stateless processors can be replicated",
+                possible_values = None)
+        
+        if replicas <= 1:
+            self.__replicas.pop(prc_name, None)
+            return
+        
+        if partition is None:
+            partition = EtlReplicatedEventManager.ROUND_ROBIN
+        EtlReplicatedEventManager.check_options(replicas, partition,
+                                                partition_key, preserve_order)
+        self.__replicas[prc_name] = {
+            'replicas':         replicas,
+            'partition':        partition,
+            'partition_key':    partition_key,
+            'preserve_order':   preserve_order,
+            }
+        
+        
+    def pin_output(self, prc_name, output_name):
+        '''Keep an output after execute() has finished using it
+        
+        The outputs of the processor given to execute() are always kept.
+        '''
+        self.__pinned.add((prc_name, output_name))
+        
+        
+    def unpin_output(self, prc_name, output_name):
+        self.__pinned.discard((prc_name, output_name))
+        
+        
+    def release_output(self, prc_name, output_name):
+        '''Free an output's records and delete its disk file
+        
+        The output will be generated again if it's needed later.
+        '''
+        record_set = self.__record_sets[prc_name].pop(output_name, None)
+        if record_set is not None:
+            record_set.close()
+    
+    
+    def enable_output_cache(self, max_bytes=None, directory=None):
+        '''Save generated outputs to reuse in later runs
+        
+        Only outputs of processors that return a fingerprint from
+        get_cache_fingerprint() are saved, and only when every processor
+        feeding them does too.
+        
+        @param max_bytes: Max total bytes of saved outputs.  See
+            WorkflowOutputCache.MAX_BYTES
+        @param directory: Where to save outputs.  Defaults to 'output_cache'
+            in default_data_directory.
+        '''
+        if directory is None:
+            directory = os.path.join(self.default_data_directory,
+                                     'output_cache')
+        self.output_cache = WorkflowOutputCache(directory, max_bytes)
+        
+        
+    def enable_checkpoints(self, directory=None):
+        '''Save each output as it's generated so the run can be resumed
+        
+        Outputs are written to disk in the checkpoint directory and listed in
+        a manifest file there.  Any checkpoints from an earlier run are
+        deleted.  Record sets being generated spill into a subdirectory of it,
+        which is emptied of files left by a run that died.
+        
+        @param directory: Where to save outputs.  Defaults to 'checkpoint' in
+            default_data_directory.
+        '''
+        self._set_checkpoint_directory(directory)
+        with self.__checkpoint_lock:
+            for entry in self._read_manifest().values():
+                path = os.path.join(self.checkpoint_directory, entry['file'])
+                if os.path.exists(path):
+                    os.unlink(path)
+            self.__checkpoints = dict()
+            self._write_manifest()
+            
+            
+    def resume(self, prc_name, workers=None, directory=None):
+        '''Execute a processor, reusing outputs checkpointed by an earlier run
+        
+        Checkpointed outputs are loaded instead of generated, so only the
+        processors that hadn't finished are run.  An output is only reused if
+        its key (see _checkpoint_key()) is the same as when it was saved, so
+        outputs are generated again if the name, class or fingerprint of the
+        processor or of anything upstream, or how they're connected, has
+        changed.  Changes to the settings of processors that don't return a
+        fingerprint from get_cache_fingerprint() can't be seen, so make sure
+        they're the same as in the run being resumed.  Outputs generated now
+        are checkpointed too.
+        
+        @param prc_name: Name of the processor to execute
+        @param workers: See execute()
+        @param directory: Directory given to enable_checkpoints()
+        '''
+        self._set_checkpoint_directory(directory)
+        keys = dict()
+        with self.__checkpoint_lock:
+            self.__checkpoints = dict()
+            for node, entry in self._read_manifest().items():
+                if not self.__processors.has_key(node[0]):
+                    continue
+                key = self._checkpoint_key(node[0], node[1], keys)
+                if entry.get('key') == key:
+                    self.__checkpoints[node] = entry
+                else:
+                    msg = "Not reusing checkpointed '%s' output of processor"
+                    msg += " '%s' since it may have changed"
+                    print msg % (node[1], node[0])
+        self.execute(prc_name, workers)
+        
+        
     def save_records(self, prc_name, output_name, filename):
         '''Output a record set to file for user review'''
         
@@ -149,20 +436,66 @@ class Workflow(object):
         # Generate record set if not cached
         if not self.__record_sets[prc_name].has_key(output_name):
             
-            prc = self.__processors[prc_name]
+            # Generate required inputs
+            if not self._has_saved_output(prc_name, output_name):
+                deps = self._list_output_dependencies(prc_name, output_name)
+                for dep in deps:
+                    self.get_output(dep[0], dep[1])
+                
+            self._generate_output(prc_name, output_name)
             
-            # Get required inputs
-            inputs = dict()
-            for p_input in prc.list_inputs():
-                inputs[p_input.name] = list()
-                for conn in self.__connections[prc_name][p_input.name]:
-                    input_records = self.get_output(conn.src_prc_name,
-                                                    conn.output_name)
-                    inputs[p_input.name].append(input_records)
-                    
-            # Init RecordSet to contain output
-            output_schema = self._get_output_schema(prc_name, output_name)
-            out_records = EtlRecordSet(prc_name, output_name, output_schema)
+        # Returned cached output
+        return self.__record_sets[prc_name][output_name]
+        
+        
+    # -- Execution Methods ----------------------------------------------------
+    
+    def _generate_output(self, prc_name, output_name):
+        '''Run a processor to generate one output
+        
+        All of the outputs that this output depends on must already be
+        cached in __record_sets, unless the output was saved to output_cache.
+        '''
+        if self.__record_sets[prc_name].has_key(output_name):
+            return
+        
+        prc = self.__processors[prc_name]
+        
+        # Reload output finished before an earlier run stopped
+        out_records = self._load_checkpoint(prc_name, output_name)
+        if out_records is not None:
+            msg = "Loaded checkpointed '%s' output of processor '%s'"
+            print msg % (output_name, prc_name)
+            self.__record_sets[prc_name][output_name] = out_records
+            return
+        
+        # Reuse output saved by an earlier run
+        cache_key = self._output_cache_key(prc_name, output_name)
+        if cache_key is not None:
+            out_records = self.output_cache.load(cache_key)
+            if out_records is not None:
+                msg = "Loaded saved '%s' output of processor '%s'"
+                print msg % (output_name, prc_name)
+                self.__record_sets[prc_name][output_name] = out_records
+                return
+        
+        # Get required inputs
+        inputs = dict()
+        for input_name, conns in self.__connections[prc_name].items():
+            inputs[input_name] = list()
+            for conn in conns:
+                # (Generated here if the saved output was removed since the
+                # plan was made)
+                inputs[input_name].append(
+                    self.get_output(conn.src_prc_name, conn.output_name))
+                
+        # Init RecordSet to contain output.  When checkpointing, it spills
+        # beside the checkpoints so the file can be linked, not copied
+        out_records = EtlRecordSet(disk_directory=self._spill_directory())
+        
+        # Processors are not expected to be thread safe, so only generate
+        # one output at a time from each processor
+        with self.__prc_locks[prc_name]:
             
             # Prepare processor
             prc.default_data_directory = self.default_data_directory
@@ -175,13 +508,511 @@ class Workflow(object):
             # Generate output
             prc.gen_output(output_name, inputs, out_records)
             
-            # Cache output
-            self.__record_sets[prc_name][output_name] = out_records
+        if cache_key is not None:
+            self.output_cache.save(cache_key, out_records)
             
-        # Returned cached output
-        return self.__record_sets[prc_name][output_name]
+        if self.checkpoint_directory is not None:
+            self._checkpoint_output(prc_name, output_name, out_records)
+            
+        # Cache output
+        self.__record_sets[prc_name][output_name] = out_records
+        
+        
+    def _output_cache_key(self, prc_name, output_name):
+        '''Build the key to save an output under in output_cache
+        
+        The key covers the processor's class and fingerprint, the output name,
+        and the keys of every output connected to the processor's inputs, so
+        a change anywhere upstream changes the key.
+        
+        @return: Key string, or None if the output should not be saved
+        '''
+        if self.output_cache is None:
+            return None
+        return self._output_key(prc_name, output_name)
+    
+    
+    def _output_key(self, prc_name, output_name, memo=None):
+        '''Build the key identifying an output (see _output_cache_key())
+        
+        Keys are remembered in memo, so outputs shared by several branches
+        of the graph are only keyed once.
+        
+        @param memo: dict of keys already built.  Defaults to the one kept
+            for the current execute().
+        @return: Key string, or None if a processor has no fingerprint
+        '''
+        if memo is None:
+            memo = self.__output_keys
+            if memo is None:
+                memo = dict()
+        node = (prc_name, output_name)
+        if memo.has_key(node):
+            return memo[node]
         
+        key = None
+        parts = self._output_key_parts(prc_name, output_name, memo)
+        if parts is not None:
+            key = WorkflowOutputCache.make_key(parts)
+        memo[node] = key
+        return key
+    
+    
+    def _checkpoint_key(self, prc_name, output_name, memo=None):
+        '''Build the key a checkpointed output is reused under
+        
+        Like _output_key(), but processors without a fingerprint are keyed
+        by their name, class and connections, so that any workflow can be
+        resumed.  Processor names are included since checkpoints are saved
+        for processors by name.
+        
+        @param memo: dict of keys already built.  Defaults to the one kept
+            for the current execute().
+        @return: Key string
+        '''
+        if memo is None:
+            memo = self.__checkpoint_keys
+            if memo is None:
+                memo = dict()
+        node = (prc_name, output_name)
+        if not memo.has_key(node):
+            parts = self._output_key_parts(prc_name, output_name, memo,
+                                           checkpoint=True)
+            memo[node] = WorkflowOutputCache.make_key(parts)
+        return memo[node]
+    
+    
+    def _output_key_parts(self, prc_name, output_name, memo,
+                          checkpoint=False):
+        '''List the values an output's key is built from
+        
+        @param checkpoint: Build the parts of a checkpoint key rather than
+            an output cache key
+        @return: List, or None if a processor has no fingerprint (for output
+            cache keys)
+        '''
+        prc = self.__processors[prc_name]
+        fingerprint = prc.get_cache_fingerprint()
+        if fingerprint is None and not checkpoint:
+            return None
+        
+        parts = [prc.__class__.__module__,
+                 prc.__class__.__name__,
+                 fingerprint,
+                 output_name]
+        if checkpoint:
+            parts.insert(0, prc_name)
+        for input_name in sorted(self.__connections[prc_name].keys()):
+            for conn in self.__connections[prc_name][input_name]:
+                if checkpoint:
+                    src_key = self._checkpoint_key(conn.src_prc_name,
+                                                   conn.output_name, memo)
+                else:
+                    src_key = self._output_key(conn.src_prc_name,
+                                               conn.output_name, memo)
+                if src_key is None:
+                    return None
+                parts.append((input_name, src_key))
+        return parts
+    
+    
+    def _create_event_manager(self, prc_name):
+        '''Create the event manager to run a processor in execute_streaming()
+        '''
+        prc = self.__processors[prc_name]
+        prc.default_data_directory = self.default_data_directory
+        prc.temp_directory = self.temp_directory
+        
+        if self.__replicas.has_key(prc_name):
+            return EtlReplicatedEventManager(prc_name, prc,
+                                             **self.__replicas[prc_name])
+        return EtlProcessorEventManager.for_processor(prc_name, prc)
+    
+    
+    def _create_fused_event_manager(self, chain):
+        '''Create one event manager to run a chain of processors'''
+        processors = list()
+        for name in chain:
+            prc = self.__processors[name]
+            prc.default_data_directory = self.default_data_directory
+            prc.temp_directory = self.temp_directory
+            processors.append(prc)
+        fused = FusedProcessorChain(chain, processors,
+                                    self.validate_fused_records)
+        
+        # Named for the last processor, which sets the source of the records
+        # dispatched from the chain
+        return EtlProcessorEventManager(chain[-1], fused)
+    
+    
+    def _find_fusable_chains(self, names, target_prc_name):
+        '''Group processors into chains that can run in one event manager
+        
+        B is fused after A if A's only output is connected only to B, and
+        that is the only connection to B's only input.  A must have exactly
+        one input too: the chain passes its input's disconnect on to B, so an
+        extractor (no inputs to disconnect) or a processor with several
+        inputs would finish B too early or too often.  Processors that run
+        in worker processes or set allow_fusion to False aren't fused.  A
+        processor with coerce_output_types set is only fused as the last in
+        a chain, since its records are converted by the event manager.
         
+        @param names: Names of the processors to be run, dependencies first
+        @param target_prc_name: Processor whose outputs are being collected
+        @return: List of chains, each a list of processor names
+        '''
+        # List the connections from each processor
+        conns_from = dict([(name, list()) for name in names])
+        for name in names:
+            for conns in self.__connections[name].values():
+                for conn in conns:
+                    conns_from[conn.src_prc_name].append(conn)
+                    
+        def can_fuse(name):
+            prc = self.__processors[name]
+            return (self.fuse_chains and prc.allow_fusion
+                    and not prc.cpu_bound
+                    and not self.__replicas.has_key(name))
+        
+        # Find the processor fused after each one
+        fused_next = dict()
+        fused_prev = dict()
+        for name in names:
+            if name == target_prc_name or not can_fuse(name):
+                continue
+            if self.__processors[name].coerce_output_types:
+                continue
+            if len(self.__processors[name].list_inputs()) != 1:
+                continue
+            if len(self.__processors[name].list_outputs()) != 1:
+                continue
+            if len(conns_from[name]) != 1:
+                continue
+            next_name = conns_from[name][0].dst_prc_name
+            if not can_fuse(next_name):
+                continue
+            next_inputs = self.__connections[next_name]
+            if len(next_inputs) != 1 or len(next_inputs.values()[0]) != 1:
+                continue
+            fused_next[name] = next_name
+            fused_prev[next_name] = name
+            
+        chains = list()
+        for name in names:
+            if fused_prev.has_key(name):
+                continue
+            chain = [name, ]
+            while fused_next.has_key(chain[-1]):
+                chain.append(fused_next[chain[-1]])
+            chains.append(chain)
+        return chains
+    
+    
+    def _list_upstream_prcs(self, prc_name):
+        '''List a processor and all of the processors feeding it
+        
+        @return: List of processor names
+        '''
+        found = list()
+        visiting = list()
+        
+        def visit(name):
+            if name in found:
+                return
+            if name in visiting:
+                cycle = visiting[visiting.index(name):] + [name, ]
+                msg = "Workflow contains a cycle: " + " -> ".join(cycle)
+                prc = self.__processors[name]
+                raise EtlBuildError(
+                    prc_name = name,
+                    prc_class_name = prc.__class__.__name__,
+                    error_msg = msg,
+                    possible_values = None)
+            visiting.append(name)
+            for conns in self.__connections[name].values():
+                for conn in conns:
+                    visit(conn.src_prc_name)
+            visiting.pop()
+            found.append(name)
+            
+        visit(prc_name)
+        return found
+    
+    
+    def _has_saved_output(self, prc_name, output_name):
+        '''Check if an output can be loaded instead of generated'''
+        if self.__checkpoints.has_key((prc_name, output_name)):
+            return True
+        key = self._output_cache_key(prc_name, output_name)
+        if key is None:
+            return False
+        return self.output_cache.has_output(key)
+    
+    
+    def _list_output_dependencies(self, prc_name, output_name):
+        '''List the outputs that must be generated before this output
+        
+        @return: List of (prc_name, output_name)
+        '''
+        deps = list()
+        for conns in self.__connections[prc_name].values():
+            for conn in conns:
+                dep = (conn.src_prc_name, conn.output_name)
+                if dep not in deps:
+                    deps.append(dep)
+        return deps
+    
+    
+    def _plan_outputs(self, targets):
+        '''Topologically sort the outputs that need to be generated
+        
+        Outputs that are already cached are left out of the plan, as are the
+        dependencies of outputs saved to output_cache.
+        
+        @param targets: List of (prc_name, output_name) to be generated
+        @return: List of (prc_name, output_name) with dependencies first
+        '''
+        plan = list()
+        planned = set()
+        visiting = list()
+        
+        def visit(node):
+            if node in planned:
+                return
+            if node in visiting:
+                cycle = visiting[visiting.index(node):] + [node, ]
+                msg = "Workflow contains a cycle: "
+                msg += " -> ".join(["%s.%s" % (n) for n in cycle])
+                raise EtlBuildError(
+                    prc_name = node[0],
+                    prc_class_name = self.__processors[node[0]].__class__.__name__,
+                    error_msg = msg,
+                    possible_values = None)
+            if self.__record_sets[node[0]].has_key(node[1]):
+                return
+            
+            visiting.append(node)
+            if not self._has_saved_output(node[0], node[1]):
+                for dep in self._list_output_dependencies(node[0], node[1]):
+                    visit(dep)
+            visiting.pop()
+            
+            plan.append(node)
+            planned.add(node)
+            
+        for node in targets:
+            visit(node)
+        return plan
+    
+    
+    def _plan_releases(self, plan, targets):
+        '''Count the consumers of each planned output to free them when done
+        
+        @param plan: List of (prc_name, output_name) from _plan_outputs()
+        @param targets: Outputs to keep regardless
+        @return: Function to call with each output once it's generated
+        '''
+        planned = set(plan)
+        consumers = dict()      # [node] = planned outputs still to use node
+        for node in plan:
+            for dep in self._list_output_dependencies(node[0], node[1]):
+                if dep in planned:
+                    consumers[dep] = consumers.get(dep, 0) + 1
+        keep = set(targets)
+        
+        def on_generated(node):
+            for dep in self._list_output_dependencies(node[0], node[1]):
+                if not consumers.has_key(dep):
+                    continue
+                consumers[dep] -= 1
+                if consumers[dep] > 0:
+                    continue
+                if dep not in keep and dep not in self.__pinned:
+                    self.release_output(dep[0], dep[1])
+                    
+        return on_generated
+    
+    
+    def _execute_parallel(self, plan, workers, on_generated=None):
+        '''Generate the planned outputs on a pool of worker threads
+        
+        Each output is started as soon as all of the outputs it depends on
+        have been generated, so independent branches run concurrently.
+        
+        @param plan: List of (prc_name, output_name) from _plan_outputs()
+        @param workers: Number of worker threads to start
+        @param on_generated: Function to call (from this thread) with each
+            output once it has been generated
+        '''
+        # Determine what each output is waiting on
+        waiting_on = dict()     # [node] = set of nodes not yet generated
+        dependents = dict()     # [node] = list of nodes waiting on node
+        for node in plan:
+            waiting_on[node] = set()
+            dependents[node] = list()
+        for node in plan:
+            for dep in self._list_output_dependencies(node[0], node[1]):
+                if waiting_on.has_key(dep):
+                    waiting_on[node].add(dep)
+                    dependents[dep].append(node)
+                    
+        # Start workers
+        task_queue = Queue()
+        done_queue = Queue()
+        threads = list()
+        for i in range(min(workers, len(plan))):
+            thread = Thread(target=self._output_worker,
+                            name="EtlWorkflowWorker-%d" % (i),
+                            args=(task_queue, done_queue))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+            
+        try:
+            # Queue outputs that have no dependencies
+            running = 0
+            for node in plan:
+                if len(waiting_on[node]) == 0:
+                    task_queue.put(node)
+                    running += 1
+                    
+            # Queue dependent outputs as their dependencies finish
+            while running > 0:
+                node, error = done_queue.get()
+                running -= 1
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                if on_generated is not None:
+                    on_generated(node)
+                for dependent in dependents[node]:
+                    waiting_on[dependent].discard(node)
+                    if len(waiting_on[dependent]) == 0:
+                        task_queue.put(dependent)
+                        running += 1
+                        
+        finally:
+            for thread in threads:
+                task_queue.put(None)
+            for thread in threads:
+                thread.join()
+                
+                
+    def _output_worker(self, task_queue, done_queue):
+        '''Worker thread body for _execute_parallel()'''
+        while True:
+            node = task_queue.get()
+            if node is None:
+                return
+            try:
+                self._generate_output(node[0], node[1])
+                done_queue.put((node, None))
+            except Exception:
+                done_queue.put((node, sys.exc_info()))
+        
+        
+    # -- Checkpoint Methods ---------------------------------------------------
+    
+    def _set_checkpoint_directory(self, directory):
+        if directory is None:
+            directory = os.path.join(self.default_data_directory,
+                                     'checkpoint')
+        self.checkpoint_directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            
+        # Remove spill files left by a run that died
+        spill_directory = self._spill_directory()
+        if os.path.isdir(spill_directory):
+            shutil.rmtree(spill_directory, ignore_errors=True)
+        if not os.path.isdir(spill_directory):
+            os.makedirs(spill_directory)
+            
+            
+    def _spill_directory(self):
+        '''Directory for record sets to spill into while checkpointing'''
+        if self.checkpoint_directory is None:
+            return None
+        return os.path.join(self.checkpoint_directory,
+                            self.CHECKPOINT_SPILL_DIRNAME)
+    
+    
+    def _prc_class(self, prc):
+        return "%s.%s" % (prc.__class__.__module__, prc.__class__.__name__)
+    
+    
+    def _read_manifest(self):
+        '''Read the checkpoint manifest
+        
+        @return: dict of [(prc_name, output_name)] = entry
+        '''
+        path = os.path.join(self.checkpoint_directory, self.MANIFEST_FILENAME)
+        if not os.path.exists(path):
+            return dict()
+        with open(path, 'r') as fh:
+            manifest = json.load(fh)
+        # json gives unicode names, which would key differently (by repr) to
+        # the str names the processors were added with
+        entries = dict()
+        for entry in manifest['outputs']:
+            entry['prc_name'] = entry['prc_name'].encode('utf-8')
+            entry['output_name'] = entry['output_name'].encode('utf-8')
+            entries[(entry['prc_name'], entry['output_name'])] = entry
+        return entries
+    
+    
+    def _write_manifest(self):
+        '''Replace the checkpoint manifest (call with checkpoint lock held)'''
+        outputs = sorted(self.__checkpoints.values(),
+                         key=lambda e: (e['prc_name'], e['output_name']))
+        path = os.path.join(self.checkpoint_directory, self.MANIFEST_FILENAME)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump({'version': self.MANIFEST_VERSION, 'outputs': outputs},
+                      fh, indent=2)
+        if os.path.exists(path):
+            os.unlink(path)
+        os.rename(tmp_path, path)
+        
+        
+    def _checkpoint_output(self, prc_name, output_name, record_set):
+        '''Save a generated output and add it to the manifest'''
+        filename = hashlib.sha1(repr((prc_name, output_name))).hexdigest()
+        filename += '.db'
+        
+        # The record set spills into the spill directory, on the same file
+        # system, so the file written is linked rather than copied
+        path = os.path.join(self.checkpoint_directory, filename)
+        record_set.save_copy(path, link=True)
+        key = self._checkpoint_key(prc_name, output_name)
+        
+        with self.__checkpoint_lock:
+            self.__checkpoints[(prc_name, output_name)] = {
+                'prc_name':     prc_name,
+                'output_name':  output_name,
+                'class':        self._prc_class(self.__processors[prc_name]),
+                'key':          key,
+                'file':         filename,
+                'count':        record_set.count,
+                }
+            self._write_manifest()
+            
+            
+    def _load_checkpoint(self, prc_name, output_name):
+        '''Load a checkpointed output
+        
+        @return: EtlRecordSet, or None if not checkpointed
+        '''
+        with self.__checkpoint_lock:
+            entry = self.__checkpoints.get((prc_name, output_name))
+        if entry is None:
+            return None
+        path = os.path.join(self.checkpoint_directory, entry['file'])
+        if not os.path.exists(path):
+            return None
+        return EtlRecordSet.open_file(
+            path, link=True, disk_directory=self._spill_directory())
+    
+    
     # -- Utility Methods ------------------------------------------------------
         
     def _get_prc_output_info(self, prc_name, output_name):
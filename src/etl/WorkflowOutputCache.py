@@ -0,0 +1,138 @@
+import os
+import hashlib
+from tempfile import NamedTemporaryFile
+from threading import Lock
+
+from EtlRecordSet import EtlRecordSet
+
+class WorkflowOutputCache(object):
+    '''Directory of processor outputs saved to be reused by later runs
+    
+    Each output is saved as a copy of its sqlite file, named by a key built
+    with make_key() from everything that determines the output: the processor
+    class and configuration, the output name, and the keys of the outputs
+    connected to its inputs.  If any of these change, the key changes and the
+    old file is simply never read again.
+    
+    When the files total more than max_bytes, the least recently used are
+    deleted.
+    '''
+    
+    FILE_EXT = '.etlout'
+    MAX_BYTES = 1024 * 1024 * 1024
+    KEY_VERSION = 1
+    
+    def __init__(self, directory, max_bytes=None):
+        '''Init
+        
+        @param directory: Directory to keep saved outputs in.  Created if
+            needed.
+        @param max_bytes: Max total bytes of saved outputs.  Defaults to
+            MAX_BYTES.  Set the attribute to None for no limit.
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if self.max_bytes is None:
+            self.max_bytes = self.MAX_BYTES
+        self.hits = 0
+        self.misses = 0
+        
+        self.__lock = Lock()
+        
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+    
+    
+    @classmethod
+    def make_key(cls, parts):
+        '''Build a cache key
+        
+        @param parts: List of values describing the output.  They must have
+            a repr() that doesn't change between runs (strings, numbers, and
+            tuples or lists of them).
+        @return: Hex digest string
+        '''
+        digest = hashlib.sha1(repr((cls.KEY_VERSION, list(parts))))
+        return digest.hexdigest()
+    
+    
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.FILE_EXT)
+    
+    
+    def has_output(self, key):
+        return os.path.exists(self._path(key))
+    
+    
+    def load(self, key):
+        '''Load a saved output
+        
+        @param key: Key from make_key()
+        @return: EtlRecordSet with a copy of the records, or None if not saved
+        '''
+        path = self._path(key)
+        with self.__lock:
+            if not os.path.exists(path):
+                self.misses += 1
+                return None
+            os.utime(path, None)    # Mark as recently used
+            self.hits += 1
+        return EtlRecordSet.open_file(path)
+    
+    
+    def save(self, key, record_set):
+        '''Save an output to be loaded again later
+        
+        Writes all of the record set's records to disk if not already.
+        
+        @param key: Key from make_key()
+        @param record_set: EtlRecordSet to save
+        '''
+        tmp = NamedTemporaryFile(dir=self.directory, suffix='.tmp',
+                                 delete=False)
+        tmp.close()
+        try:
+            record_set.save_copy(tmp.name)
+            with self.__lock:
+                path = self._path(key)
+                if os.path.exists(path):
+                    os.unlink(path)
+                os.rename(tmp.name, path)
+        finally:
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+        self.evict()
+    
+    
+    def evict(self):
+        '''Delete least recently used outputs until under max_bytes'''
+        if self.max_bytes is None:
+            return
+        with self.__lock:
+            entries = list()
+            total = 0
+            for filename in os.listdir(self.directory):
+                if not filename.endswith(self.FILE_EXT):
+                    continue
+                path = os.path.join(self.directory, filename)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, path, stat.st_size))
+                total += stat.st_size
+            
+            entries.sort()
+            for mtime, path, size in entries:
+                if total <= self.max_bytes:
+                    break
+                os.unlink(path)
+                total -= size
+    
+    
+    @property
+    def size(self):
+        '''Total bytes of saved outputs'''
+        total = 0
+        for filename in os.listdir(self.directory):
+            if filename.endswith(self.FILE_EXT):
+                total += os.path.getsize(os.path.join(self.directory,
+                                                      filename))
+        return total
@@ -1,6 +1,7 @@
 import re
 
 from etl.EtlProcessor import EtlProcessor, EtlProcessorDataPort
+from etl.EtlRecord import EtlRecord
 
 class FieldFindReplace(EtlProcessor):
     '''Find and replace values in one or more fields
@@ -10,9 +11,12 @@ class FieldFindReplace(EtlProcessor):
     replacement rules.
     
     This component uses the sames schema for output as is specified for the
-    input.
+    input.  Input records are processed in batches, applying each rule to the
+    whole batch before moving on to the next rule.
     '''
     
+    stateless = True
+    
     def __init__(self, schema, input_name='records', output_name='records'):
         '''Init
         
@@ -48,7 +52,60 @@ class FieldFindReplace(EtlProcessor):
     
     
     def regexp_replace(self, field_name, search_pat, replace, case_sensitive=True):
+        flags = 0
+        if not case_sensitive:
+            flags = re.IGNORECASE
         self.__re_replace_rules.append( (field_name,
-                                         re.compile(search_pat),
+                                         re.compile(search_pat, flags),
                                          replace,
                                          case_sensitive) )
+        
+        
+    def _list_rule_functions(self):
+        '''List the replacement rules as (field_name, function) pairs
+        
+        The function takes a field value and returns the replaced value.
+        '''
+        rules = list()
+        for field_name, search, replace, case_sensitive in self.__replace_rules:
+            if case_sensitive:
+                func = lambda v, s=search, r=replace: v.replace(s, r)
+            else:
+                pat = re.compile(re.escape(search), re.IGNORECASE)
+                func = lambda v, p=pat, r=replace: p.sub(lambda m: r, v)
+            rules.append((field_name, func))
+        for field_name, pat, replace, case_sensitive in self.__re_replace_rules:
+            func = lambda v, p=pat, r=replace: p.sub(r, v)
+            rules.append((field_name, func))
+        return rules
+        
+        
+    def process_input_record(self, record, dispatcher):
+        for new_record in self._replace_values([record, ]):
+            dispatcher(self.__output_name, new_record)
+        
+        
+    def process_input_batch(self, records, dispatcher):
+        dispatcher(self.__output_name, self._replace_values(records))
+        
+        
+    def _replace_values(self, records):
+        '''Apply the replacement rules to a list of records
+        
+        @return: List of new records with replaced values
+        '''
+        # Apply each rule to the values of every record
+        all_values = [record.values for record in records]
+        for field_name, func in self._list_rule_functions():
+            for values in all_values:
+                value = values.get(field_name)
+                if isinstance(value, basestring):
+                    values[field_name] = func(value)
+                    
+        # Build new records
+        new_records = list()
+        for record, values in zip(records, all_values):
+            new_record = EtlRecord(self.__schema, values)
+            new_record.note_src_record(record)
+            new_records.append(new_record)
+        return new_records
@@ -0,0 +1,12 @@
+'''Helpers for querying tags as ranges of strings'''
+
+
+def prefix_upper_bound(prefix):
+    '''Get the first string after all of the strings starting with prefix
+    
+    @return: The bound, or None if there is none
+    '''
+    prefix = prefix.rstrip('\xff')
+    if len(prefix) == 0:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
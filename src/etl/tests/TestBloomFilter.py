@@ -0,0 +1,43 @@
+import unittest
+
+from etl.BloomFilter import BloomFilter
+
+
+class TestBloomFilter(unittest.TestCase):
+    
+    def testNoFalseNegatives(self):
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add("key%d" % (i))
+        for i in range(1000):
+            self.assertTrue("key%d" % (i) in bloom)
+        self.assertEqual(bloom.count, 1000)
+        
+        
+    def testFalsePositiveRate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add("key%d" % (i))
+        false_positives = 0
+        for i in range(10000):
+            if "other%d" % (i) in bloom:
+                false_positives += 1
+        self.assertLess(false_positives, 10000 * 0.03)
+        
+        
+    def testIntKeys(self):
+        bloom = BloomFilter(100)
+        for i in range(0, 200, 2):
+            bloom.add(i)
+        self.assertTrue(all([i in bloom for i in range(0, 200, 2)]))
+        self.assertLess(len([i for i in range(1, 200, 2) if i in bloom]), 10)
+        
+        
+    def testInvalidRate(self):
+        with self.assertRaises(ValueError):
+            BloomFilter(100, 1.5)
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+
+from test_data import test_person, test_animal, PersonTestScehma
+# Test Data:
+#   (person,    "John",     "Doe",      22),
+#   (person,    "Jane",     "Doe",      20),
+#   (person,    "Mark",     "Smith",    41),
+#   (animal,    "dog",      "Animalia", "Canidae",  True),
+#   (animal,    "cat",      "Animalia", "Felidae",  False),
+
+from etl.CompactEtlRecord import CompactEtlRecord
+from etl.EtlRecord import EtlRecordFrozen
+from etl.MemoryRecordSet import MemoryRecordSet
+from etl.Sqlite3RecordSet import Sqlite3RecordSet
+
+
+def compact_person(i):
+    return CompactEtlRecord.from_record(test_person(i))
+
+
+class TestCompactEtlRecord(unittest.TestCase):
+
+
+    def testNoInstanceDict(self):
+        self.assertFalse(hasattr(compact_person(0), '__dict__'))
+
+
+    def testSerialIsInt(self):
+        self.assertIsInstance(compact_person(0).serial, (int, long))
+        self.assertNotEqual(compact_person(0).serial, compact_person(0).serial)
+
+
+    def testEquals(self):
+        self.assertEqual(compact_person(0), compact_person(0))
+        self.assertEqual(compact_person(0), test_person(0))
+        self.assertEqual(test_person(0), compact_person(0))
+
+
+    def testIfValuesNotEquals(self):
+        self.assertNotEqual(compact_person(0), compact_person(1))
+
+
+    def testIfSchemasNotEquals(self):
+        animal = CompactEtlRecord.from_record(test_animal(0))
+        self.assertNotEqual(compact_person(0), animal)
+
+
+    def testMissingFieldsAreNone(self):
+        rec = CompactEtlRecord(PersonTestScehma(), {'first': "John"})
+        self.assertIsNone(rec['last'])
+
+
+    def testUnknownField(self):
+        with self.assertRaises(KeyError):
+            CompactEtlRecord(PersonTestScehma(), {'middle': "Q"})
+
+
+    def testMappingInterface(self):
+        rec = compact_person(0)
+        self.assertEqual(rec.keys(), ['first', 'last', 'age'])
+        self.assertEqual(rec['age'], 22)
+        self.assertEqual(rec.values,
+                         {'first': "John", 'last': "Doe", 'age': 22})
+        self.assertEqual(list(rec), ['first', 'last', 'age'])
+        self.assertIn('first', rec)
+        self.assertEqual(rec.get('middle', 'x'), 'x')
+
+
+    def testSetFieldValue(self):
+        rec = compact_person(0)
+        rec['first'] = "Jane"
+        rec['age'] = 20
+        self.assertEqual(rec, test_person(1))
+
+
+    def testCantUpdateFrozen(self):
+        rec = compact_person(1)
+        rec.freeze()
+        self.assertTrue(rec.is_frozen)
+        with self.assertRaises(EtlRecordFrozen):
+            rec['first'] = "new"
+
+
+    def testSize(self):
+        self.assertGreater(compact_person(0).size, 0)
+        self.assertLess(compact_person(0).size, test_person(0).size)
+
+
+    def testRecordSource(self):
+        dst = compact_person(1)
+        src = test_person(0)
+        dst.note_src_record(src)
+        dst.set_source('processor1', 'output1')
+        self.assertIn(src.serial, dst.get_src_record_serials())
+        self.assertEqual(dst.source_processor_name, 'processor1')
+        self.assertEqual(dst.source_processor_output_name, 'output1')
+
+
+    def testStoreInMemory(self):
+        rs = MemoryRecordSet()
+        rec = compact_person(0)
+        rec.freeze()
+        rs.add_record(rec, ['tagA', ])
+        self.assertEqual(rs.get_record(rec.serial), rec)
+
+
+    def testStoreOnDisk(self):
+        rs = Sqlite3RecordSet()
+        rec = compact_person(0)
+        rec.freeze()
+        rs.add_record(rec, ['tagA', ])
+        self.assertEqual(rs.get_record(rec.serial), rec)
+        self.assertEqual(list(rs.find_records_with_tag('tagA')), [rec, ])
+        self.assertIsNotNone(rec.schema)
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
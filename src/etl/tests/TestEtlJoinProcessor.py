@@ -0,0 +1,201 @@
+import unittest
+
+from test_data import test_person, PersonTestScehma
+# Test Data:
+#   (person,    "John",     "Doe",      22),
+#   (person,    "Jane",     "Doe",      20),
+#   (person,    "Mark",     "Smith",    41),
+#   (animal,    "dog",      "Animalia", "Canidae",  True),
+#   (animal,    "cat",      "Animalia", "Felidae",  False),
+
+from etl.EtlJoinProcessor import EtlJoinProcessor
+from etl.EtlProcessor import EtlProcessorDataPort
+from etl.EtlRecord import EtlRecord
+from etl.EtlRecordSet import EtlRecordSet
+from etl.EtlSchema import EtlSchema
+
+
+class PetTestSchema(EtlSchema):
+    def __init__(self):
+        super(PetTestSchema, self).__init__()
+        self.add_field('owner', header="Owner First Name")
+        self.add_field('pet', header="Pet Name")
+        
+        
+class OwnedPetTestSchema(PetTestSchema):
+    def __init__(self):
+        super(OwnedPetTestSchema, self).__init__()
+        self.add_field('owner_last', header="Owner Last Name")
+
+
+class PetOwnerJoin(EtlJoinProcessor):
+    '''Joins pets to their owners by first name'''
+    def list_lookup_inputs(self):
+        return [EtlProcessorDataPort('people', PersonTestScehma()), ]
+    def list_subject_inputs(self):
+        return [EtlProcessorDataPort('pets', PetTestSchema()), ]
+    def list_outputs(self):
+        return [EtlProcessorDataPort('pets', OwnedPetTestSchema()), ]
+    def build_lookup_record_key(self, lookup_record):
+        return lookup_record['first']
+    def build_lookup_key(self, record):
+        return record['owner']
+    def join_record(self, output_name, subject, match, record_set):
+        self._add_pet(subject, match, record_set)
+    def gen_pets_output(self, inputs, record_set):
+        for pets in inputs['pets']:
+            for pet in pets.all_records():
+                self._add_pet(pet, self.lookup(pet), record_set)
+    def _add_pet(self, pet, owner, record_set):
+        values = pet.values
+        values['owner_last'] = None
+        if owner is not None:
+            values['owner_last'] = owner['last']
+        record = EtlRecord(OwnedPetTestSchema(), values)
+        record.freeze()
+        record_set.add_record(record)
+
+
+def pet(owner, name):
+    record = EtlRecord(PetTestSchema(), {'owner': owner, 'pet': name})
+    record.freeze()
+    return record
+
+
+class TestEtlJoinProcessor(unittest.TestCase):
+    
+    PETS = [('John', 'Rex'), ('Mark', 'Tom'), ('Sue', 'Bo'),
+            ('John', 'Fido')]
+    
+    def _join(self, prc, people=(0, 1, 2), pets=PETS):
+        people_set = EtlRecordSet()
+        for i in people:
+            person = test_person(i)
+            person.freeze()
+            people_set.add_record(person)
+            
+        pet_set = EtlRecordSet()
+        for owner, name in pets:
+            pet_set.add_record(pet(owner, name))
+            
+        output = EtlRecordSet()
+        prc.gen_output('pets', {'people': [people_set, ],
+                                'pets': [pet_set, ]}, output)
+        
+        return sorted([(r['pet'], r['owner_last'])
+                       for r in output.all_records()])
+    
+    
+    def _expected(self):
+        return [('Bo', None), ('Fido', 'Doe'), ('Rex', 'Doe'), ('Tom', 'Smith')]
+    
+    
+    def testLookupJoin(self):
+        self.assertEqual(self._join(PetOwnerJoin()), self._expected())
+        
+        
+    def testLookupInputsReplaced(self):
+        prc = PetOwnerJoin()
+        self._join(prc)
+        self.assertEqual(self._join(prc, people=(2, )),
+                         [('Bo', None), ('Fido', None), ('Rex', None),
+                          ('Tom', 'Smith')])
+        
+        
+    def testHashJoin(self):
+        prc = PetOwnerJoin()
+        prc.join_strategy = EtlJoinProcessor.HASH_JOIN
+        self.assertEqual(self._join(prc), self._expected())
+        
+        
+    def testGraceHashJoin(self):
+        prc = PetOwnerJoin()
+        prc.join_strategy = EtlJoinProcessor.HASH_JOIN
+        prc.build_memory_limit = 0
+        prc.join_partitions = 4
+        self.assertEqual(self._join(prc), self._expected())
+        
+        
+    def testLookupStats(self):
+        prc = PetOwnerJoin()
+        self._join(prc)
+        self.assertEqual(prc.lookup_stats['hits'], 3)
+        self.assertEqual(prc.lookup_stats['misses'], 1)
+        
+        
+    def testGraceHashJoinFilter(self):
+        prc = PetOwnerJoin()
+        prc.join_strategy = EtlJoinProcessor.HASH_JOIN
+        prc.build_memory_limit = 0
+        pets = [('Nobody%d' % (i), 'Pet%d' % (i)) for i in range(100)]
+        
+        self.assertEqual(len(self._join(prc, pets=pets)), 100)
+        self.assertEqual(prc.lookup_stats['hits'], 0)
+        self.assertEqual(prc.lookup_stats['misses'], 100)
+        self.assertGreater(prc.lookup_stats['filtered'], 90)
+        
+        
+    def testFilterOff(self):
+        prc = PetOwnerJoin()
+        prc.join_strategy = EtlJoinProcessor.HASH_JOIN
+        prc.build_memory_limit = 0
+        prc.bloom_false_positive_rate = None
+        self.assertEqual(self._join(prc), self._expected())
+        self.assertEqual(prc.lookup_stats['filtered'], 0)
+        
+        
+    def testLookupJoinNotFiltered(self):
+        prc = PetOwnerJoin()
+        pets = [('Nobody%d' % (i), 'Pet%d' % (i)) for i in range(100)]
+        self._join(prc, pets=pets)
+        self.assertEqual(prc.lookup_stats['misses'], 100)
+        self.assertEqual(prc.lookup_stats['filtered'], 0)
+        
+        
+    def testSortMergeJoin(self):
+        prc = PetOwnerJoin()
+        prc.join_strategy = EtlJoinProcessor.SORT_MERGE_JOIN
+        self.assertEqual(self._join(prc), self._expected())
+        
+        
+    def testSortMergeLookupStats(self):
+        prc = PetOwnerJoin()
+        prc.join_strategy = EtlJoinProcessor.SORT_MERGE_JOIN
+        self._join(prc)
+        self.assertEqual(prc.lookup_stats['hits'], 3)
+        self.assertEqual(prc.lookup_stats['misses'], 1)
+        
+        
+    def testSortMergeJoinSortedInputs(self):
+        prc = PetOwnerJoin()
+        prc.join_strategy = EtlJoinProcessor.SORT_MERGE_JOIN
+        pets = sorted(self.PETS)
+        self.assertEqual(self._join(prc, (1, 0, 2), pets), self._expected())
+        
+        
+    def testSortMergeDuplicateLookupKey(self):
+        prc = PetOwnerJoin()
+        prc.join_strategy = EtlJoinProcessor.SORT_MERGE_JOIN
+        with self.assertRaisesRegexp(Exception, "Duplicated match key"):
+            self._join(prc, (0, 1, 0))
+            
+            
+    def testDuplicateLookupKey(self):
+        prc = PetOwnerJoin()
+        prc.join_strategy = EtlJoinProcessor.HASH_JOIN
+        prc.build_memory_limit = 0
+        
+        people_set = EtlRecordSet()
+        for i in range(2):
+            person = test_person(0)
+            person.freeze()
+            people_set.add_record(person)
+            
+        with self.assertRaisesRegexp(Exception, "Duplicated match key"):
+            prc.gen_output('pets', {'people': [people_set, ], 'pets': []},
+                           EtlRecordSet())
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
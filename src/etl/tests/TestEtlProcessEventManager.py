@@ -0,0 +1,108 @@
+import os
+import unittest
+
+from test_data import test_person, PersonTestScehma
+# Test Data:
+#   (person,    "John",     "Doe",      22),
+#   (person,    "Jane",     "Doe",      20),
+#   (person,    "Mark",     "Smith",    41),
+#   (animal,    "dog",      "Animalia", "Canidae",  True),
+#   (animal,    "cat",      "Animalia", "Felidae",  False),
+
+from etl.EtlProcessor import EtlProcessor, EtlProcessorDataPort
+from etl.EtlProcessorEventManager import EtlProcessorEventManager
+from etl.EtlProcessEventManager import EtlProcessEventManager
+
+from TestEtlProcessorEventManager import PersonSource, PersonSink
+
+
+class PidStamper(EtlProcessor):
+    '''Copies people, setting the last name to the pid of the process'''
+    cpu_bound = True
+    def __init__(self, fail=False):
+        super(PidStamper, self).__init__()
+        self.fail = fail
+    def list_inputs(self):
+        return [EtlProcessorDataPort('people', PersonTestScehma()), ]
+    def list_outputs(self):
+        return [EtlProcessorDataPort('people', PersonTestScehma()), ]
+    def process_input_record(self, record, dispatcher):
+        if self.fail:
+            raise ValueError("Failed on purpose")
+        stamped = record.clone()
+        stamped['last'] = str(os.getpid())
+        stamped.note_src_record(record)
+        dispatcher('people', stamped)
+    def handle_input_disconnected(self, input_name, dispatcher):
+        dispatcher('people', test_person(2))
+
+
+class TestEtlProcessEventManager(unittest.TestCase):
+    
+    def _run(self, count, stamper):
+        src = EtlProcessorEventManager.for_processor('src', PersonSource(count),
+                                                     batch_size=7)
+        mid = EtlProcessorEventManager.for_processor('mid', stamper,
+                                                     batch_size=7)
+        dst = EtlProcessorEventManager('dst', PersonSink())
+        mid.register_input('people', src, 1)
+        src.register_output('people', mid, 'people', 1)
+        dst.register_input('people', mid, 2)
+        mid.register_output('people', dst, 'people', 2)
+        for manager in (src, mid, dst):
+            manager.start()
+        for manager in (src, mid, dst):
+            manager.join(10)
+        return mid, dst
+    
+    
+    def testForProcessor(self):
+        manager = EtlProcessorEventManager.for_processor('src',
+                                                         PersonSource(1))
+        self.assertEqual(type(manager), EtlProcessorEventManager)
+        
+        manager = EtlProcessorEventManager.for_processor('mid', PidStamper())
+        self.assertTrue(isinstance(manager, EtlProcessEventManager))
+        manager.stop_workers()
+        
+        
+    def testRunsInWorker(self):
+        mid, dst = self._run(20, PidStamper())
+        self.assertFalse(dst.is_alive())
+        
+        received = dst.prc.received
+        self.assertEqual(len(received), 21)
+        pids = set([r['last'] for r in received[:20]])
+        self.assertEqual(len(pids), 1)
+        self.assertNotEqual(pids.pop(), str(os.getpid()))
+        self.assertEqual(received[20]['first'], 'Mark')
+        self.assertIsNone(mid.worker_pid)
+        
+        
+    def testSerialsUnique(self):
+        src_people = [test_person(i % 3) for i in range(20)]
+        mid, dst = self._run(20, PidStamper())
+        serials = set([p.serial for p in src_people])
+        serials.update([r.serial for r in dst.prc.received])
+        self.assertEqual(len(serials), 41)
+        self.assertEqual(len(dst.prc.received[0].get_src_record_serials()), 1)
+        
+        
+    def testRecordsFrozenWithSource(self):
+        mid, dst = self._run(1, PidStamper())
+        record = dst.prc.received[0]
+        self.assertTrue(record.is_frozen)
+        self.assertEqual(record.source_processor_name, 'mid')
+        
+        
+    def testWorkerError(self):
+        mid, dst = self._run(3, PidStamper(fail=True))
+        self.assertFalse(dst.is_alive())
+        self.assertEqual(dst.prc.received, [])
+        self.assertEqual(mid.error[0], Exception)
+        self.assertIsNone(mid.worker_pid)
+        
+        
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
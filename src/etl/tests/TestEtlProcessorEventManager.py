@@ -0,0 +1,132 @@
+import unittest
+
+from test_data import test_person, PersonTestScehma
+# Test Data:
+#   (person,    "John",     "Doe",      22),
+#   (person,    "Jane",     "Doe",      20),
+#   (person,    "Mark",     "Smith",    41),
+#   (animal,    "dog",      "Animalia", "Canidae",  True),
+#   (animal,    "cat",      "Animalia", "Felidae",  False),
+
+from etl.EtlProcessor import EtlProcessor, EtlProcessorDataPort
+from etl.EtlProcessorEventManager import EtlProcessorEventManager
+
+
+class PersonSource(EtlProcessor):
+    '''Dispatches a number of test people'''
+    def __init__(self, count):
+        super(PersonSource, self).__init__()
+        self.count = count
+    def list_inputs(self):
+        return []
+    def list_outputs(self):
+        return [EtlProcessorDataPort('people', PersonTestScehma()), ]
+    def extract_records(self, dispatcher):
+        for i in range(self.count):
+            dispatcher('people', test_person(i % 3))
+
+
+class PersonSink(EtlProcessor):
+    '''Collects received people'''
+    def __init__(self):
+        super(PersonSink, self).__init__()
+        self.received = list()
+        self.disconnected = list()
+    def list_inputs(self):
+        return [EtlProcessorDataPort('people', PersonTestScehma()), ]
+    def list_outputs(self):
+        return []
+    def extract_records(self, dispatcher):
+        pass
+    def process_input_record(self, record, dispatcher):
+        self.received.append(record)
+    def handle_input_disconnected(self, input_name, dispatcher):
+        self.disconnected.append(input_name)
+
+
+class BatchPersonSink(PersonSink):
+    '''Collects received people a batch at a time'''
+    def __init__(self):
+        super(BatchPersonSink, self).__init__()
+        self.batches = list()
+    def process_input_batch(self, records, dispatcher):
+        self.batches.append(len(records))
+        self.received.extend(records)
+
+
+class BatchCountingManager(EtlProcessorEventManager):
+    '''Counts the input batch events handled'''
+    batch_events = 0
+    def _handle_input_batch_event(self, event):
+        self.batch_events += 1
+        super(BatchCountingManager, self)._handle_input_batch_event(event)
+
+
+class TextPersonSource(PersonSource):
+    '''Dispatches test people with the ages as text, to be converted'''
+    coerce_output_types = True
+    def extract_records(self, dispatcher):
+        for age in ('22', ' 20 ', 'unknown'):
+            person = test_person(0)
+            person['age'] = age
+            dispatcher('people', person)
+
+
+class TestEtlProcessorEventManager(unittest.TestCase):
+
+    def _run(self, count, batch_size, sink=None, source=None):
+        if sink is None:
+            sink = PersonSink()
+        if source is None:
+            source = PersonSource(count)
+        src = EtlProcessorEventManager('src', source, batch_size=batch_size)
+        dst = BatchCountingManager('dst', sink)
+        dst.register_input('people', src, 1)
+        src.register_output('people', dst, 'people', 1)
+        src.start()
+        dst.start()
+        src.join(5)
+        dst.join(5)
+        self.assertFalse(dst.is_alive())
+        return dst
+
+
+    def testAllRecordsDelivered(self):
+        dst = self._run(20, 7)
+        self.assertEqual(len(dst.prc.received), 20)
+        self.assertEqual([r['first'] for r in dst.prc.received[:3]],
+                         ['John', 'Jane', 'Mark'])
+
+
+    def testOneEventPerBatch(self):
+        dst = self._run(20, 7)
+        self.assertEqual(dst.batch_events, 3)
+
+
+    def testRecordsFrozenWithSource(self):
+        dst = self._run(1, 7)
+        record = dst.prc.received[0]
+        self.assertTrue(record.is_frozen)
+        self.assertEqual(record.source_processor_name, 'src')
+        self.assertEqual(record.source_processor_output_name, 'people')
+
+
+    def testBatchHook(self):
+        dst = self._run(20, 7, BatchPersonSink())
+        self.assertEqual(dst.prc.batches, [7, 7, 6])
+        self.assertEqual(len(dst.prc.received), 20)
+
+
+    def testOutputTypesCoerced(self):
+        dst = self._run(0, 7, source=TextPersonSource(0))
+        self.assertEqual([r['age'] for r in dst.prc.received], [22, 20])
+
+
+    def testDisconnectDelivered(self):
+        dst = self._run(0, 7)
+        self.assertEqual(dst.prc.disconnected, ['people', ])
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -3,7 +3,10 @@ Created on Apr 18, 2014
 
 @author: nshearer
 '''
+import sys
 import unittest
+from threading import Thread
+from multiprocessing import Process, Queue
 
 from test_data import test_person, test_animal
 # Test Data:
@@ -13,7 +16,14 @@ from test_data import test_person, test_animal
 #   (animal,    "dog",      "Animalia", "Canidae",  True),
 #   (animal,    "cat",      "Animalia", "Felidae",  False),
 
-from etl.EtlRecord import EtlRecordFrozen
+from etl.EtlRecord import EtlRecordFrozen, SERIAL_SEQUENCE_BITS, estimate_value_size
+from etl.EtlRecord import process_producer_id, serial_array
+from etl.EtlRecord import SERIAL_PRODUCER_MASK
+import etl.EtlRecord
+
+
+def collect_serials(count, results):
+    results.put([test_person(0).serial for i in range(count)])
 
 class TestEtlRecord(unittest.TestCase):
     
@@ -23,6 +33,69 @@ class TestEtlRecord(unittest.TestCase):
                              "Serial should not be None")
         
         
+    def testSerialIsInt(self):
+        self.assertIsInstance(test_person(0).serial, (int, long))
+        
+        
+    def testSerialsUniqueAcrossThreads(self):
+        results = list()
+        def collect():
+            results.extend([test_person(0).serial for i in range(1000)])
+        threads = [Thread(target=collect) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(results)), 4000)
+        
+        
+    def testSerialsUniqueAcrossProcesses(self):
+        results = Queue()
+        procs = [Process(target=collect_serials, args=(100, results))
+                 for i in range(2)]
+        for proc in procs:
+            proc.start()
+        serials = results.get(timeout=10) + results.get(timeout=10)
+        for proc in procs:
+            proc.join()
+        serials += [test_person(0).serial for i in range(100)]
+        self.assertEqual(len(set(serials)), 300)
+        producers = set([s >> SERIAL_SEQUENCE_BITS for s in serials])
+        self.assertEqual(len(producers), 3)
+        
+        
+    def testProducerIdIsProcessNumber(self):
+        # Processes started one after another never share an id, even if
+        # the OS gives the second the pid the first had
+        producers = list()
+        for i in range(2):
+            results = Queue()
+            proc = Process(target=collect_serials, args=(1, results))
+            proc.start()
+            serial = results.get(timeout=10)[0]
+            proc.join()
+            self.assertEqual(serial >> SERIAL_SEQUENCE_BITS,
+                             process_producer_id(proc._identity))
+            producers.append(serial >> SERIAL_SEQUENCE_BITS)
+        self.assertEqual(producers[1], producers[0] + 1)
+        
+        
+    def testNestedProcessProducerIds(self):
+        ids = [process_producer_id(identity)
+               for identity in [(1, ), (2, ), (1, 1), (1, 2), (2, 1)]]
+        self.assertEqual(len(set(ids)), 5)
+        
+        
+    def testSerialArray(self):
+        serial = (SERIAL_PRODUCER_MASK << SERIAL_SEQUENCE_BITS) | 5
+        self.assertEqual(list(serial_array([serial, ])), [serial, ])
+        
+        fits = etl.EtlRecord.SERIALS_FIT_ARRAY
+        self.addCleanup(setattr, etl.EtlRecord, 'SERIALS_FIT_ARRAY', fits)
+        etl.EtlRecord.SERIALS_FIT_ARRAY = False
+        self.assertEqual(serial_array([serial, ]), [serial, ])
+        
+        
     def testEquals(self):
         self.assertEqual(test_person(0), test_person(0))
         
@@ -91,7 +164,18 @@ class TestEtlRecord(unittest.TestCase):
         
     def testSize(self):
         rec = test_person(0)
-        self.assertLess(abs(rec.size - 20), 5) # w/in 5 of 20
+        self.assertGreater(rec.size, sys.getsizeof(rec.values))
+        
+        bigger = test_person(0)
+        bigger['first'] = "John" + "x" * 1000
+        self.assertEqual(bigger.size - rec.size, 1000)
+        
+        
+    def testEstimateValueSize(self):
+        tags = ["tag%04d" % (i) for i in range(1000)]
+        expected = sys.getsizeof(tags) + sum([sys.getsizeof(t) for t in tags])
+        self.assertEqual(estimate_value_size(tags), expected)
+        self.assertEqual(estimate_value_size(22), sys.getsizeof(22))
         
         
     def testRecordSource(self):
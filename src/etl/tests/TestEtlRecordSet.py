@@ -1,4 +1,7 @@
+import os
+import shutil
 import unittest
+from tempfile import mkdtemp
 
 from test_data import test_person, PersonTestScehma
 # Test Data:
@@ -8,7 +11,9 @@ from test_data import test_person, PersonTestScehma
 #   (animal,    "dog",      "Animalia", "Canidae",  True),
 #   (animal,    "cat",      "Animalia", "Felidae",  False),
 
-from etl.EtlRecordSet import EtlRecordSet
+from etl.EtlRecordSet import EtlRecordSet, wait_for_flushes
+from etl.Sqlite3RecordSet import Sqlite3RecordSet
+from etl.RecordSetMemoryBudget import RecordSetMemoryBudget
 
 
 class TestEtlRecordSetConverts(unittest.TestCase):
@@ -170,7 +175,35 @@ class TestEtlRecordSet(unittest.TestCase):
         
         self.assertEqual(list(sorted(rs.find_records_with_tag('tagA'))),
                          sorted([person, person1]))
+
+        
+        
+    def testAllRecords(self):
+        rs = self._createRecordSet()
+        initial = list(rs.all_records())
         
+        people = list()
+        for i in range(3):
+            person = test_person(i)
+            person.freeze()
+            rs.add_record(person)
+            people.append(person)
+            
+        self.assertEqual(sorted(rs.all_records()), sorted(initial + people))
+        
+        
+    def testIterRecords(self):
+        rs = self._createRecordSet()
+        initial = rs.count
+        
+        for i in range(3):
+            person = test_person(i)
+            person.freeze()
+            rs.add_record(person)
+            
+        batches = list(rs.iter_records(2))
+        self.assertEqual(sum([len(b) for b in batches]), initial + 3)
+        self.assertTrue(max([len(b) for b in batches]) <= 2)        
         
         
 class TestEtlRecordSetAfterConvert(TestEtlRecordSet):
@@ -183,6 +216,209 @@ class TestEtlRecordSetAfterConvert(TestEtlRecordSet):
             rs.add_record(person)
         assert(rs.on_disk)
         return rs
+
+        
+        
+class TestEtlRecordSetTiers(unittest.TestCase):
+    
+    def _addPeople(self, rs, count):
+        people = list()
+        for i in range(count):
+            person = test_person(i % 3)
+            person.freeze()
+            rs.add_record(person, [person['first'], ])
+            people.append(person)
+        return people
+    
+    
+    def testReadsSpanTiers(self):
+        rs = EtlRecordSet(size_until_disk=50)
+        rs.max_pending_segments = 100
+        people = self._addPeople(rs, 30)
+        
+        self.assertTrue(rs.on_disk)
+        self.assertEqual(rs.count, 30)
+        self.assertEqual(sorted(rs.all_records()), sorted(people))
+        self.assertEqual(len(list(rs.find_records_with_tag('John'))), 10)
+        for person in people:
+            self.assertEqual(rs.get_record(person.serial), person)
+            
+            
+    def testFlushedToDisk(self):
+        rs = EtlRecordSet(size_until_disk=50)
+        people = self._addPeople(rs, 30)
+        rs.convert_to_disk_storage()
+        
+        self.assertEqual(rs.count, 30)
+        self.assertEqual(sorted(rs.all_records()), sorted(people))
+        
+        rs.remove_record(people[0].serial)
+        self.assertFalse(rs.has_record(people[0].serial))
+        self.assertEqual(rs.count, 29)
+        self.assertEqual(rs.size, sum([p.size for p in people[1:]]))
+        
+        
+    def testTagQueries(self):
+        rs = EtlRecordSet(size_until_disk=50)
+        rs.max_pending_segments = 100
+        people = self._addPeople(rs, 9)
+        
+        johns = [p for p in people if p['first'] == 'John']
+        self.assertEqual(sorted(rs.find_records_with_tags(['John', 'Jane'],
+                                                          False)),
+                         sorted(people[0:9:3] + people[1:9:3]))
+        self.assertEqual(sorted(rs.find_records_with_tags(['John', 'Jane'])),
+                         [])
+        self.assertEqual(sorted(rs.find_records_with_tag_prefix('Jo')),
+                         sorted(johns))
+        self.assertEqual(sorted(rs.find_records_with_tag_range('Jo', 'Z')),
+                         sorted(johns + people[2:9:3]))
+        self.assertEqual(sorted(rs.get_records([p.serial for p in johns])),
+                         sorted(johns))
+        
+        
+    def testReadCache(self):
+        rs = EtlRecordSet(size_until_disk=50)
+        people = self._addPeople(rs, 3)
+        rs.convert_to_disk_storage()
+        
+        first = rs.get_record(people[0].serial)
+        self.assertIs(rs.get_record(people[0].serial), first)
+        self.assertEqual(rs.read_cache.hits, 1)
+        self.assertEqual(rs.read_cache.misses, 1)
+        
+        rs.remove_record(people[0].serial)
+        self.assertEqual(rs.read_cache.count, 0)
+        self.assertFalse(rs.has_record(people[0].serial))
+        
+        
+    def testNoReadCache(self):
+        rs = EtlRecordSet(size_until_disk=50, read_cache_records=0)
+        self.assertIsNone(rs.read_cache)
+        people = self._addPeople(rs, 3)
+        rs.convert_to_disk_storage()
+        self.assertEqual(rs.get_record(people[1].serial), people[1])
+        
+        
+    def testClose(self):
+        budget = RecordSetMemoryBudget()
+        rs = EtlRecordSet(size_until_disk=50, memory_budget=budget)
+        rs.max_pending_segments = 100
+        self._addPeople(rs, 30)
+        self.assertTrue(rs.on_disk)
+        
+        rs.close()
+        self.assertFalse(rs.on_disk)
+        self.assertEqual(rs.count, 0)
+        self.assertEqual(list(rs.all_records()), [])
+        self.assertEqual(budget.used, 0)
+        
+        
+    def testSealedSegmentsCounted(self):
+        budget = RecordSetMemoryBudget()
+        rs = EtlRecordSet(memory_budget=budget)
+        people = self._addPeople(rs, 3)
+        
+        # Hold up the flush thread so the segment stays sealed
+        flush_lock = rs._EtlRecordSet__flush_lock
+        with flush_lock:
+            rs.spill_to_disk()
+            self.assertEqual(rs.memory_size, sum([p.size for p in people]))
+            self.assertEqual(budget.used, rs.memory_size)
+            self.assertEqual(budget._RecordSetMemoryBudget__used,
+                             rs.memory_size)
+        rs.wait_for_flush()
+        self.assertEqual(rs.memory_size, 0)
+        self.assertEqual(budget._RecordSetMemoryBudget__used, 0)
+        
+        
+    def testDuplicateOnDisk(self):
+        rs = EtlRecordSet(size_until_disk=50)
+        people = self._addPeople(rs, 5)
+        rs.convert_to_disk_storage()
+        with self.assertRaisesRegexp(Exception, "already in record set"):
+            rs.add_record(people[3])
+        self.assertEqual(rs.count, 5)
+        
+        rs.remove_record(people[3].serial)
+        rs.add_record(people[3])
+        self.assertEqual(rs.count, 5)
+        
+        
+    def testDuplicateInOpenedFile(self):
+        rs = EtlRecordSet()
+        people = self._addPeople(rs, 3)
+        directory = mkdtemp()
+        try:
+            path = os.path.join(directory, 'copy.db')
+            rs.save_copy(path)
+            opened = EtlRecordSet.open_file(path)
+            with self.assertRaises(Exception):
+                opened.add_record(people[0])
+            opened.close()
+        finally:
+            shutil.rmtree(directory)
+        
+        
+    def testSaveCopyLeavesTiers(self):
+        rs = EtlRecordSet()
+        people = self._addPeople(rs, 5)
+        rs.convert_to_disk_storage()
+        people += self._addPeople(rs, 1)
+        memory_size = rs.memory_size
+        self.assertGreater(memory_size, 0)
+        
+        directory = mkdtemp()
+        try:
+            path = os.path.join(directory, 'copy.db')
+            rs.save_copy(path, link=True)
+            self.assertEqual(rs.memory_size, memory_size)
+            
+            opened = EtlRecordSet.open_file(path)
+            self.assertEqual(sorted(opened.all_records()), sorted(people))
+            self.assertEqual(sorted(opened.find_records_with_tag('Jane')),
+                             sorted([people[1], people[4]]))
+            opened.close()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(sorted(rs.all_records()), sorted(people))
+        
+        
+    def testSaveCopyLinksDiskFile(self):
+        rs = EtlRecordSet()
+        self._addPeople(rs, 3)
+        rs.convert_to_disk_storage()
+        
+        directory = mkdtemp()
+        try:
+            path = os.path.join(directory, 'copy.db')
+            rs.save_copy(path, link=True)
+            if hasattr(os, 'link'):
+                self.assertEqual(os.stat(path).st_nlink, 2)
+        finally:
+            shutil.rmtree(directory)
+        
+        
+    def testFlushesFinishedAtExit(self):
+        rs = EtlRecordSet(size_until_disk=50)
+        rs.max_pending_segments = 100
+        self._addPeople(rs, 30)
+        wait_for_flushes()
+        self.assertEqual(rs.memory_size, rs._EtlRecordSet__active.size)
+        
+        
+    def testFlushErrorRaised(self):
+        rs = EtlRecordSet(size_until_disk=50,
+                          disk_storage=Sqlite3RecordSet.COLUMNAR)
+        person = test_person(0)
+        person['height'] = 6
+        person.freeze()
+        rs.add_record(person)
+        
+        with self.assertRaises(Exception):
+            rs.convert_to_disk_storage()
+        with self.assertRaises(Exception):
+            list(rs.all_records())
         
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+import os
+import unittest
+
+from test_data import test_person, PersonTestScehma
+# Test Data:
+#   (person,    "John",     "Doe",      22),
+#   (person,    "Jane",     "Doe",      20),
+#   (person,    "Mark",     "Smith",    41),
+#   (animal,    "dog",      "Animalia", "Canidae",  True),
+#   (animal,    "cat",      "Animalia", "Felidae",  False),
+
+from etl.EtlProcessorEventManager import EtlProcessorEventManager
+from etl.EtlReplicatedEventManager import EtlReplicatedEventManager
+
+from TestEtlProcessorEventManager import PersonSource, PersonSink
+from TestEtlProcessEventManager import PidStamper
+
+
+class TestEtlReplicatedEventManager(unittest.TestCase):
+    
+    def _run(self, count, replicas, **kwargs):
+        src = EtlProcessorEventManager('src', PersonSource(count),
+                                       batch_size=7)
+        mid = EtlReplicatedEventManager('mid', PidStamper(), replicas,
+                                        batch_size=7, **kwargs)
+        dst = EtlProcessorEventManager('dst', PersonSink())
+        mid.register_input('people', src, 1)
+        src.register_output('people', mid, 'people', 1)
+        dst.register_input('people', mid, 2)
+        mid.register_output('people', dst, 'people', 2)
+        for manager in (src, mid, dst):
+            manager.start()
+        for manager in (src, mid, dst):
+            manager.join(10)
+        self.assertFalse(dst.is_alive())
+        return dst.prc.received
+    
+    
+    def testPreserveOrder(self):
+        received = self._run(20, 3, preserve_order=True)
+        
+        # One disconnect record per replica
+        self.assertEqual(len(received), 23)
+        self.assertEqual([r['first'] for r in received[:20]],
+                         [test_person(i % 3)['first'] for i in range(20)])
+        self.assertEqual(len(set([r['last'] for r in received[:20]])), 3)
+        
+        
+    def testRoundRobin(self):
+        received = self._run(20, 3)
+        self.assertEqual(len(received), 23)
+        self.assertEqual(sorted([r['first'] for r in received[:20]]),
+                         ['Jane'] * 7 + ['John'] * 7 + ['Mark'] * 6)
+        
+        
+    def testHashPartition(self):
+        received = self._run(20, 3, partition=EtlReplicatedEventManager.HASH,
+                             partition_key='first')
+        pids = dict()
+        for record in received[:20]:
+            pids.setdefault(record['first'], set()).add(record['last'])
+        for first, first_pids in pids.items():
+            self.assertEqual(len(first_pids), 1)
+            self.assertNotEqual(first_pids.pop(), str(os.getpid()))
+            
+            
+    def testInvalidOptions(self):
+        check = EtlReplicatedEventManager.check_options
+        with self.assertRaises(ValueError):
+            check(2, EtlReplicatedEventManager.HASH, None, False)
+        with self.assertRaises(ValueError):
+            check(2, EtlReplicatedEventManager.HASH, 'first', True)
+        with self.assertRaises(ValueError):
+            check(0, EtlReplicatedEventManager.ROUND_ROBIN, None, False)
+            
+            
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
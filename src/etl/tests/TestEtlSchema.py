@@ -1,4 +1,5 @@
 import unittest
+from datetime import date
 
 from test_data import test_person, PersonTestScehma
 # Test Data:
@@ -8,6 +9,9 @@ from test_data import test_person, PersonTestScehma
 #   (animal,    "dog",      "Animalia", "Canidae",  True),
 #   (animal,    "cat",      "Animalia", "Felidae",  False),
 
+from etl.EtlRecord import EtlRecord
+from etl.EtlSchema import EtlSchema
+from etl.CompactEtlRecord import CompactEtlRecord
 
 class TestEtlSchema(unittest.TestCase):
 
@@ -16,6 +20,38 @@ class TestEtlSchema(unittest.TestCase):
         person = test_person(0)
         self.assertIsNone(PersonTestScehma().check_record_struct(person))
 
+
+    def testCheckRecordStructMissingValues(self):
+        schema = PersonTestScehma()
+        person = EtlRecord(schema, {'first': 'John'})
+        self.assertIsNone(schema.check_record_struct(person))
+
+
+    def testCheckRecordStructOtherSchema(self):
+        schema = PersonTestScehma()
+        other = EtlSchema()
+        other.add_field('first')
+        other.add_field('nickname')
+        person = EtlRecord(other, {'first': 'John', 'nickname': 'JD'})
+        self.assertEqual(schema.check_record_struct(person),
+                         ["Missing required field 'last'",
+                          "Missing required field 'age'",
+                          "Unknown field 'nickname'"])
+
+
+    def testCheckCompactRecordStruct(self):
+        person = CompactEtlRecord.from_record(test_person(0))
+        self.assertIsNone(person.schema.check_record_struct(person))
+
+
+    def testCheckRecordStructAfterAddField(self):
+        schema = PersonTestScehma()
+        person = test_person(0)
+        self.assertIsNone(schema.check_record_struct(person))
+        schema.add_field('nickname')
+        self.assertEqual(schema.check_record_struct(person),
+                         ["Missing required field 'nickname'"])
+
     
     def testFieldNames(self):
         self.assertEqual(PersonTestScehma().list_field_names(),
@@ -35,6 +71,14 @@ class TestEtlSchema(unittest.TestCase):
         self.assertEqual(fields[2]['header'], 'Age')
                     
 
+    def testFieldPositions(self):
+        schema = PersonTestScehma()
+        self.assertEqual(schema.field_positions(),
+                         {'first': 0, 'last': 1, 'age': 2})
+        schema.remove_field('first')
+        self.assertEqual(schema.field_positions(), {'last': 0, 'age': 1})
+        
+        
     def testSchemaEqual(self):
         self.assertEqual(PersonTestScehma(), PersonTestScehma())
         
@@ -42,6 +86,72 @@ class TestEtlSchema(unittest.TestCase):
     def testClone(self):
         schema = PersonTestScehma()
         self.assertEqual(schema, schema.clone())
+        
+        
+    def _createTypedSchema(self):
+        schema = EtlSchema()
+        schema.add_field('name')
+        schema.add_field('count', type_hint=EtlSchema.INT)
+        schema.add_field('price', type_hint=EtlSchema.FLOAT)
+        schema.add_field('born', type_hint=EtlSchema.DATE)
+        schema.add_field('active', type_hint=EtlSchema.BOOL)
+        return schema
+    
+    
+    def testCoerceRecord(self):
+        schema = self._createTypedSchema()
+        record = EtlRecord(schema, {'name': '007', 'count': ' 12 ',
+                                    'price': '2.50', 'born': '1990-05-17',
+                                    'active': 'Yes'})
+        self.assertIsNone(schema.coerce_record(record))
+        self.assertEqual(record.values, {'name': '007', 'count': 12,
+                                         'price': 2.5,
+                                         'born': date(1990, 5, 17),
+                                         'active': True})
+        
+        
+    def testCoerceRecordErrors(self):
+        schema = self._createTypedSchema()
+        record = EtlRecord(schema, {'name': 'x', 'count': 'twelve',
+                                    'price': '', 'born': '17/05/1990',
+                                    'active': 'no'})
+        errors = schema.coerce_record(record)
+        self.assertEqual(sorted(errors.keys()), ['born', 'count'])
+        self.assertEqual(record['count'], 'twelve')
+        self.assertIsNone(record['price'])
+        self.assertFalse(record['active'])
+        
+        
+    def testCoerceColumns(self):
+        schema = self._createTypedSchema()
+        columns, errors = schema.coerce_columns({
+            'count':    ['1', '2.0', 'x', None],
+            'active':   ['t', 'F', '0', 'maybe'],
+            'other':    ['a', 'b', 'c', 'd'],
+            })
+        self.assertEqual(columns['count'], [1, 2, None, None])
+        self.assertEqual(columns['active'], [True, False, False, None])
+        self.assertEqual(columns['other'], ['a', 'b', 'c', 'd'])
+        self.assertEqual(sorted(errors.keys()), ['active', 'count'])
+        self.assertEqual([i for i, msg in errors['count']], [2, ])
+        self.assertEqual([i for i, msg in errors['active']], [3, ])
+        
+        
+    def testCoerceOverflow(self):
+        schema = self._createTypedSchema()
+        columns, errors = schema.coerce_columns({'count': ['1', 'inf', 'x']})
+        self.assertEqual(columns['count'], [1, None, None])
+        self.assertEqual([i for i, msg in errors['count']], [1, 2])
+        with self.assertRaises(ValueError):
+            schema.coerce_value('count', '1e400')
+        
+        
+    def testCoerceValue(self):
+        schema = self._createTypedSchema()
+        self.assertEqual(schema.coerce_value('price', 3), 3.0)
+        self.assertEqual(schema.coerce_value('name', 3), 3)
+        with self.assertRaises(ValueError):
+            schema.coerce_value('count', '2.5')
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
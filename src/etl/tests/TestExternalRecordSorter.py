@@ -0,0 +1,68 @@
+import unittest
+
+from test_data import test_person, test_animal, PersonTestScehma
+# Test Data:
+#   (person,    "John",     "Doe",      22),
+#   (person,    "Jane",     "Doe",      20),
+#   (person,    "Mark",     "Smith",    41),
+#   (animal,    "dog",      "Animalia", "Canidae",  True),
+#   (animal,    "cat",      "Animalia", "Felidae",  False),
+
+from etl.ExternalRecordSorter import ExternalRecordSorter
+
+
+class TestExternalRecordSorter(unittest.TestCase):
+    
+    def _people(self, count):
+        people = list()
+        for i in range(count):
+            person = test_person(i % 3)
+            person.freeze()
+            people.append(person)
+        return people
+    
+    
+    def _sort(self, records, run_size):
+        sorter = ExternalRecordSorter(lambda r: r['first'], run_size)
+        for record in records:
+            sorter.add(record)
+        return list(sorter.sorted_records())
+    
+    
+    def testSortInMemory(self):
+        people = self._people(9)
+        self.assertEqual([r['first'] for r in self._sort(people, 100)],
+                         ['Jane'] * 3 + ['John'] * 3 + ['Mark'] * 3)
+        
+        
+    def testSortRuns(self):
+        people = self._people(10)
+        sorted_people = self._sort(people, 3)
+        self.assertEqual([r['first'] for r in sorted_people],
+                         ['Jane'] * 3 + ['John'] * 4 + ['Mark'] * 3)
+        self.assertEqual(sorted_people[0].schema.__class__, PersonTestScehma)
+        
+        
+    def testStable(self):
+        people = self._people(10)
+        johns = [p.serial for p in people if p['first'] == 'John']
+        sorted_people = self._sort(people, 3)
+        self.assertEqual([p.serial for p in sorted_people
+                          if p['first'] == 'John'], johns)
+        
+        
+    def testMixedSchemas(self):
+        records = self._people(3)
+        for i in range(2):
+            animal = test_animal(i)
+            animal.freeze()
+            records.append(animal)
+        sorter = ExternalRecordSorter(lambda r: r.serial, 2)
+        for record in reversed(records):
+            sorter.add(record)
+        self.assertEqual(list(sorter.sorted_records()), records)
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
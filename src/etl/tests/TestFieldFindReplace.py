@@ -0,0 +1,66 @@
+import unittest
+
+from test_data import test_person, PersonTestScehma
+# Test Data:
+#   (person,    "John",     "Doe",      22),
+#   (person,    "Jane",     "Doe",      20),
+#   (person,    "Mark",     "Smith",    41),
+#   (animal,    "dog",      "Animalia", "Canidae",  True),
+#   (animal,    "cat",      "Animalia", "Felidae",  False),
+
+from etl.common_processors.FieldFindReplace import FieldFindReplace
+
+
+class TestFieldFindReplace(unittest.TestCase):
+
+    def _process(self, prc, records):
+        output = list()
+        def dispatcher(output_name, records):
+            self.assertEqual(output_name, 'records')
+            output.extend(records)
+        prc.process_input_batch(records, dispatcher)
+        return output
+
+
+    def testReplace(self):
+        prc = FieldFindReplace(PersonTestScehma())
+        prc.replace('last', 'Doe', 'Roe')
+        output = self._process(prc, [test_person(0), test_person(2)])
+        self.assertEqual([r['last'] for r in output], ['Roe', 'Smith'])
+
+
+    def testReplaceCaseInsensitive(self):
+        prc = FieldFindReplace(PersonTestScehma())
+        prc.replace('first', 'JOHN', 'Jon', case_sensitive=False)
+        output = self._process(prc, [test_person(0), ])
+        self.assertEqual(output[0]['first'], 'Jon')
+
+
+    def testRegexpReplace(self):
+        prc = FieldFindReplace(PersonTestScehma())
+        prc.regexp_replace('first', r'^j(\w)', r'G\1', case_sensitive=False)
+        output = self._process(prc, [test_person(0), test_person(1)])
+        self.assertEqual([r['first'] for r in output], ['Gohn', 'Gane'])
+
+
+    def testNonStringValuesUnchanged(self):
+        prc = FieldFindReplace(PersonTestScehma())
+        prc.replace('age', '2', '3')
+        output = self._process(prc, [test_person(0), ])
+        self.assertEqual(output[0]['age'], 22)
+
+
+    def testProcessInputRecord(self):
+        prc = FieldFindReplace(PersonTestScehma())
+        prc.replace('last', 'Doe', 'Roe')
+        output = list()
+        person = test_person(0)
+        prc.process_input_record(person,
+                                 lambda name, rec: output.append(rec))
+        self.assertEqual(output[0]['last'], 'Roe')
+        self.assertIn(person.serial, output[0].get_src_record_serials())
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
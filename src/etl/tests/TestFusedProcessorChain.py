@@ -0,0 +1,92 @@
+import unittest
+
+from test_data import test_person, PersonTestScehma
+# Test Data:
+#   (person,    "John",     "Doe",      22),
+#   (person,    "Jane",     "Doe",      20),
+#   (person,    "Mark",     "Smith",    41),
+#   (animal,    "dog",      "Animalia", "Canidae",  True),
+#   (animal,    "cat",      "Animalia", "Felidae",  False),
+
+from etl.EtlProcessor import EtlProcessor, EtlProcessorDataPort
+from etl.FusedProcessorChain import FusedProcessorChain
+from etl.PostRecordProcessingAction import HoldRecord
+from etl.common_processors.FieldFindReplace import FieldFindReplace
+
+from TestEtlProcessorEventManager import PersonSource, PersonSink
+
+
+class PersonHolder(EtlProcessor):
+    '''Holds every person it receives'''
+    def list_inputs(self):
+        return [EtlProcessorDataPort('people', PersonTestScehma()), ]
+    def list_outputs(self):
+        return [EtlProcessorDataPort('people', PersonTestScehma()), ]
+    def process_input_record(self, record, dispatcher):
+        return HoldRecord()
+
+
+class TestFusedProcessorChain(unittest.TestCase):
+    
+    def _replacer(self, search, replace):
+        prc = FieldFindReplace(PersonTestScehma(), 'people', 'people')
+        prc.replace('last', search, replace)
+        return prc
+    
+    
+    def _people(self):
+        return [test_person(i) for i in range(3)]
+    
+    
+    def testBatchPassedAlong(self):
+        chain = FusedProcessorChain(
+            ['a', 'b'], [self._replacer('Doe', 'Roe'),
+                         self._replacer('Roe', 'Poe')])
+        self.assertEqual(chain.list_inputs()[0].name, 'people')
+        
+        output = list()
+        def dispatcher(output_name, records):
+            output.extend(records)
+        self.assertIsNone(chain.process_input_batch(self._people(),
+                                                    dispatcher))
+        self.assertEqual([r['last'] for r in output], ['Poe', 'Poe', 'Smith'])
+        self.assertFalse(output[0].is_frozen)
+        
+        
+    def testExtractAndDisconnect(self):
+        sink = PersonSink()
+        chain = FusedProcessorChain(['src', 'sink'], [PersonSource(4), sink])
+        chain.extract_records(None)
+        self.assertEqual(len(sink.received), 4)
+        chain.handle_input_disconnected('people', None)
+        self.assertEqual(sink.disconnected, ['people', ])
+        
+        
+    def testValidateHops(self):
+        chain = FusedProcessorChain(['a', 'sink'],
+                                    [self._replacer('Doe', 'Roe'),
+                                     PersonSink()],
+                                    validate_hops=True)
+        chain.process_input_batch(self._people(), None)
+        received = chain.processors[1].received
+        self.assertTrue(received[0].is_frozen)
+        self.assertEqual(received[0].source_processor_name, 'a')
+        
+        
+    def testHoldInsideChain(self):
+        chain = FusedProcessorChain(['a', 'hold'],
+                                    [self._replacer('Doe', 'Roe'),
+                                     PersonHolder()])
+        with self.assertRaises(Exception):
+            chain.process_input_batch(self._people(), None)
+            
+        chain = FusedProcessorChain(['hold', 'a'],
+                                    [PersonHolder(),
+                                     self._replacer('Doe', 'Roe')])
+        people = self._people()
+        self.assertEqual(chain.process_input_batch(people, None), people)
+        
+        
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
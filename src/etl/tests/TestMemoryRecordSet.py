@@ -151,6 +151,124 @@ class TestMemoryRecordSet(unittest.TestCase):
                          sorted([person, person1]))
         
         
+    def testFindRecordsWithTags(self):
+        rs = MemoryRecordSet()
+        
+        people = list()
+        for i, tags in enumerate([['a', 'b'], ['b', 'c'], ['a', 'b', 'c']]):
+            person = test_person(i)
+            person.freeze()
+            rs.add_record(person, tags)
+            people.append(person)
+            
+        self.assertEqual(list(rs.find_records_with_tags(['a', 'b'])),
+                         [people[0], people[2]])
+        self.assertEqual(list(rs.find_records_with_tags(['a', 'c'])),
+                         [people[2], ])
+        self.assertEqual(list(rs.find_records_with_tags(['a', 'x'])), [])
+        self.assertEqual(list(rs.find_records_with_tags(['a', 'c'], False)),
+                         people)
+        
+        
+    def testTagsComparedAsStrings(self):
+        rs = MemoryRecordSet()
+        person = test_person(0)
+        person.freeze()
+        rs.add_record(person, [22, ])
+        self.assertEqual(list(rs.find_records_with_tag('22')), [person, ])
+        self.assertEqual(list(rs.dump_records()), [(person, ['22', ]), ])
+        
+        
+    def testTagsOutOfOrder(self):
+        rs = MemoryRecordSet()
+        
+        people = list()
+        for i in range(3):
+            person = test_person(i)
+            person.freeze()
+            people.append(person)
+        for person in reversed(people):
+            rs.add_record(person, ['tagA', ])
+            
+        self.assertEqual(list(rs.find_records_with_tag('tagA')), people)
+        
+        rs.remove_record(people[1].serial)
+        self.assertEqual(list(rs.find_records_with_tag('tagA')),
+                         [people[0], people[2]])
+        
+        
+    def testReaddedWithOtherTag(self):
+        rs = MemoryRecordSet()
+        person = test_person(0)
+        person.freeze()
+        rs.add_record(person, ['tagA', ])
+        rs.remove_record(person.serial)
+        rs.add_record(person, ['tagB', ])
+        
+        self.assertEqual(list(rs.find_records_with_tag('tagA')), [])
+        self.assertEqual(list(rs.find_records_with_tag('tagB')), [person, ])
+        self.assertEqual(list(rs.all_records()), [person, ])
+        
+        
+    def testTagRangeAfterNewTags(self):
+        rs = MemoryRecordSet()
+        
+        people = list()
+        for i, tags in enumerate([['c1', ], ['a1', ], ['b1', 'a2']]):
+            person = test_person(i)
+            person.freeze()
+            people.append(person)
+            if i == 2:
+                self.assertEqual(list(rs.find_records_with_tag_prefix('a')),
+                                 [people[1], ])
+            rs.add_record(person, tags)
+            
+        self.assertEqual(list(rs.find_records_with_tag_prefix('a')),
+                         [people[1], people[2]])
+        self.assertEqual(list(rs.find_records_with_tag_range('b', 'd')),
+                         [people[0], people[2]])
+        
+        
+    def testAllRecords(self):
+        rs = MemoryRecordSet()
+        
+        people = list()
+        for i in range(3):
+            person = test_person(i)
+            person.freeze()
+            rs.add_record(person)
+            people.append(person)
+            
+        self.assertEqual(sorted(rs.all_records()), sorted(people))
+        
+        
+    def testAllRecordsInSerialOrder(self):
+        rs = MemoryRecordSet()
+        
+        people = list()
+        for i in range(3):
+            person = test_person(i)
+            person.freeze()
+            people.append(person)
+        for person in reversed(people):
+            rs.add_record(person)
+        self.assertEqual(list(rs.all_records()), people)
+        
+        rs.remove_record(people[1].serial)
+        self.assertEqual(list(rs.all_records()), [people[0], people[2]])
+        
+        
+    def testIterRecords(self):
+        rs = MemoryRecordSet()
+        
+        for i in range(3):
+            person = test_person(i)
+            person.freeze()
+            rs.add_record(person)
+            
+        self.assertEqual([len(b) for b in rs.iter_records(2)], [2, 1])
+        
+        
         
         
 
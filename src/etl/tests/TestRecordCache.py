@@ -0,0 +1,70 @@
+import unittest
+
+from test_data import test_person, PersonTestScehma
+# Test Data:
+#   (person,    "John",     "Doe",      22),
+#   (person,    "Jane",     "Doe",      20),
+#   (person,    "Mark",     "Smith",    41),
+#   (animal,    "dog",      "Animalia", "Canidae",  True),
+#   (animal,    "cat",      "Animalia", "Felidae",  False),
+
+from etl.RecordCache import RecordCache
+
+
+class TestRecordCache(unittest.TestCase):
+    
+    def _people(self):
+        people = list()
+        for i in range(3):
+            person = test_person(i)
+            person.freeze()
+            people.append(person)
+        return people
+    
+    
+    def testGet(self):
+        cache = RecordCache(10)
+        person = self._people()[0]
+        self.assertIsNone(cache.get(person.serial))
+        cache.put(person)
+        self.assertIs(cache.get(person.serial), person)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hit_rate, 0.5)
+        
+        
+    def testRecordLimit(self):
+        cache = RecordCache(2)
+        people = self._people()
+        cache.put(people[0])
+        cache.put(people[1])
+        cache.get(people[0].serial)
+        cache.put(people[2])
+        
+        self.assertEqual(cache.count, 2)
+        self.assertIsNone(cache.get(people[1].serial))
+        self.assertIsNotNone(cache.get(people[0].serial))
+        self.assertIsNotNone(cache.get(people[2].serial))
+        
+        
+    def testByteLimit(self):
+        people = self._people()
+        cache = RecordCache(10, people[0].size + people[1].size)
+        for person in people:
+            cache.put(person)
+        self.assertIsNone(cache.get(people[0].serial))
+        self.assertLessEqual(cache.size, cache.max_bytes)
+        
+        
+    def testDiscard(self):
+        cache = RecordCache(10)
+        person = self._people()[0]
+        cache.put(person)
+        cache.discard(person.serial)
+        self.assertIsNone(cache.get(person.serial))
+        self.assertEqual(cache.size, 0)
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+from test_data import test_person, PersonTestScehma
+# Test Data:
+#   (person,    "John",     "Doe",      22),
+#   (person,    "Jane",     "Doe",      20),
+#   (person,    "Mark",     "Smith",    41),
+#   (animal,    "dog",      "Animalia", "Canidae",  True),
+#   (animal,    "cat",      "Animalia", "Felidae",  False),
+
+from etl.EtlRecordSet import EtlRecordSet
+from etl.RecordSetMemoryBudget import RecordSetMemoryBudget
+
+
+class TestRecordSetMemoryBudget(unittest.TestCase):
+    
+    def _addPeople(self, rs, count):
+        for i in range(count):
+            person = test_person(i % 3)
+            person.freeze()
+            rs.add_record(person)
+    
+    
+    def testUsed(self):
+        budget = RecordSetMemoryBudget()
+        rs_a = EtlRecordSet(memory_budget=budget)
+        rs_b = EtlRecordSet(memory_budget=budget)
+        self._addPeople(rs_a, 3)
+        self._addPeople(rs_b, 2)
+        
+        self.assertEqual(budget.used, rs_a.size + rs_b.size)
+        self.assertFalse(rs_a.on_disk)
+        self.assertFalse(rs_b.on_disk)
+        
+        
+    def testLargestSpilledFirst(self):
+        record_size = test_person(0).size
+        budget = RecordSetMemoryBudget(limit=record_size * 10)
+        small = EtlRecordSet(memory_budget=budget)
+        large = EtlRecordSet(memory_budget=budget)
+        
+        self._addPeople(small, 3)
+        self._addPeople(large, 8)
+        
+        self.assertTrue(large.on_disk)
+        self.assertFalse(small.on_disk)
+        self.assertLess(large.memory_size, large.size)
+        self.assertEqual(large.count, 8)
+        self.assertLessEqual(budget.used, budget.limit)
+        
+        
+    def testReleasedRecordSetsDropped(self):
+        budget = RecordSetMemoryBudget()
+        rs = EtlRecordSet(memory_budget=budget)
+        self._addPeople(rs, 3)
+        rs = None
+        self.assertEqual(budget.used, 0)
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -1,7 +1,11 @@
 import os
+import sqlite3
 import unittest
+from tempfile import NamedTemporaryFile
 
-from test_data import test_person, PersonTestScehma
+from datetime import date
+
+from test_data import test_person, test_animal, PersonTestScehma
 # Test Data:
 #   (person,    "John",     "Doe",      22),
 #   (person,    "Jane",     "Doe",      20),
@@ -9,6 +13,8 @@ from test_data import test_person, PersonTestScehma
 #   (animal,    "dog",      "Animalia", "Canidae",  True),
 #   (animal,    "cat",      "Animalia", "Felidae",  False),
 
+from etl.EtlRecord import EtlRecord
+from etl.EtlSchema import EtlSchema
 from etl.Sqlite3RecordSet import Sqlite3RecordSet
 
 class TestSqllit3RecordSet(unittest.TestCase):
@@ -151,6 +157,202 @@ class TestSqllit3RecordSet(unittest.TestCase):
                          sorted([person, person1]))
         
         
+    def testAddRecords(self):
+        rs = Sqlite3RecordSet()
+        
+        people = list()
+        for i in range(3):
+            person = test_person(i)
+            person.freeze()
+            people.append(person)
+        
+        rs.add_records([(people[0], ['tagA', ]), (people[1], ['tagA', ]),
+                        people[2]])
+        
+        self.assertEqual(rs.count, 3)
+        self.assertEqual(rs.size, sum([p.size for p in people]))
+        self.assertEqual(rs.get_record(people[2].serial), people[2])
+        self.assertEqual(sorted(rs.find_records_with_tag('tagA')),
+                         sorted(people[:2]))
+        
+        
+    def testAddRecordsRollsBack(self):
+        rs = Sqlite3RecordSet()
+        
+        person = test_person(0)
+        person.freeze()
+        rs.add_record(person)
+        
+        person1 = test_person(1)
+        person1.freeze()
+        with self.assertRaises(sqlite3.IntegrityError):
+            rs.add_records([person1, person])
+            
+        self.assertEqual(rs.count, 1)
+        self.assertFalse(rs.has_record(person1.serial))
+        self.assertEqual(rs.size, person.size)
+        
+        
+    def testCommitInterval(self):
+        rs = Sqlite3RecordSet(commit_interval=2)
+        other = sqlite3.connect(rs.db_path)
+        count_sql = "SELECT count(*) FROM records"
+        
+        person = test_person(0)
+        person.freeze()
+        rs.add_record(person)
+        self.assertEqual(other.execute(count_sql).fetchone()[0], 0)
+        self.assertTrue(rs.has_record(person.serial))
+        
+        person1 = test_person(1)
+        person1.freeze()
+        rs.add_record(person1)
+        self.assertEqual(other.execute(count_sql).fetchone()[0], 2)
+        other.close()
+        
+        
+    def testSpillPragmas(self):
+        rs = Sqlite3RecordSet()
+        self.assertEqual(rs.get_pragma('synchronous'), 0)
+        self.assertEqual(rs.get_pragma('journal_mode'), 'memory')
+        self.assertEqual(rs.get_pragma('temp_store'), 2)
+        self.assertEqual(rs.get_pragma('cache_size'),
+                         Sqlite3RecordSet.SPILL_PRAGMAS['cache_size'])
+        
+        
+    def testOverridePragmas(self):
+        rs = Sqlite3RecordSet(pragmas={'cache_size': 500, 'synchronous': None})
+        self.assertEqual(rs.get_pragma('cache_size'), 500)
+        self.assertEqual(rs.get_pragma('synchronous'), 2)
+        
+        
+    def testInvalidPragma(self):
+        with self.assertRaises(ValueError):
+            Sqlite3RecordSet(pragmas={'cache_size': '1; DROP TABLE records'})
+        
+        
+    def testAllRecords(self):
+        rs = Sqlite3RecordSet()
+        
+        people = list()
+        for i in range(3):
+            person = test_person(i)
+            person.freeze()
+            rs.add_record(person)
+            people.append(person)
+            
+        self.assertEqual(list(rs.all_records()), people)
+        
+        
+    def testIterRecords(self):
+        rs = Sqlite3RecordSet()
+        
+        people = list()
+        for i in range(5):
+            person = test_person(i % 3)
+            person.freeze()
+            people.append(person)
+        rs.add_records(people)
+        
+        batches = list(rs.iter_records(2))
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+        self.assertEqual(sum(batches, []), people)
+        
+        
+    def _addTagged(self, rs):
+        people = list()
+        tag_lists = [['a:1', 'b'], ['b', 'c'], ['a:2', 'b', 'c']]
+        for i, tags in enumerate(tag_lists):
+            person = test_person(i)
+            person.freeze()
+            rs.add_record(person, tags)
+            people.append(person)
+        return people
+        
+        
+    def testFindRecordsWithTags(self):
+        rs = Sqlite3RecordSet()
+        people = self._addTagged(rs)
+        
+        self.assertEqual(list(rs.find_records_with_tags(['b', 'c'])),
+                         people[1:])
+        self.assertEqual(list(rs.find_records_with_tags(['a:1', 'c'])), [])
+        self.assertEqual(list(rs.find_records_with_tags(['a:1', 'c'], False)),
+                         people)
+        
+        
+    def testFindRecordsWithTagPrefix(self):
+        rs = Sqlite3RecordSet()
+        people = self._addTagged(rs)
+        
+        self.assertEqual(list(rs.find_records_with_tag_prefix('a:')),
+                         [people[0], people[2]])
+        self.assertEqual(list(rs.find_records_with_tag_range('a:2', 'c')),
+                         people)
+        self.assertEqual(list(rs.find_records_with_tag_range(high='b')),
+                         [people[0], people[2]])
+        
+        
+    def testGetRecords(self):
+        rs = Sqlite3RecordSet()
+        people = self._addTagged(rs)
+        
+        serials = [people[2].serial, people[0].serial, 12345]
+        self.assertEqual(list(rs.get_records(serials)),
+                         [people[0], people[2]])
+        
+        
+    def testTagSerialIndex(self):
+        rs = Sqlite3RecordSet()
+        self._addTagged(rs)
+        rs.commit()
+        
+        db = sqlite3.connect(rs.db_path)
+        plan = db.execute("""\
+            EXPLAIN QUERY PLAN
+            DELETE FROM tags WHERE serial = 1""").fetchall()
+        db.close()
+        self.assertTrue('tag_serial_index' in str(plan))
+        
+        
+    def _savedCopy(self, rs):
+        tmp = NamedTemporaryFile(delete=False)
+        tmp.close()
+        self.addCleanup(os.unlink, tmp.name)
+        rs.save_copy(tmp.name)
+        return Sqlite3RecordSet.open_file(tmp.name)
+        
+        
+    def testSaveCopy(self):
+        rs = Sqlite3RecordSet()
+        people = self._addTagged(rs)
+        
+        copy = self._savedCopy(rs)
+        self.assertNotEqual(copy.db_path, rs.db_path)
+        self.assertEqual(copy.count, 3)
+        self.assertEqual(copy.size, rs.size)
+        self.assertEqual(list(copy.all_records()), people)
+        self.assertEqual(list(copy.find_records_with_tag('c')), people[1:])
+        self.assertEqual(copy.get_record(people[0].serial).schema,
+                         people[0].schema)
+        
+        
+    def testSaveCopyLinked(self):
+        rs = Sqlite3RecordSet()
+        people = self._addTagged(rs)
+        path = rs.db_path + '.saved'
+        self.addCleanup(os.unlink, path)
+        rs.save_copy(path, link=True)
+        self.assertEqual(os.stat(path).st_nlink, 2)
+        
+        copy = Sqlite3RecordSet.open_file(path, link=True)
+        self.assertEqual(os.stat(path).st_nlink, 3)
+        self.assertEqual(list(copy.all_records()), people)
+        
+        rs = copy = None
+        self.assertEqual(os.stat(path).st_nlink, 1)
+        
+        
     def testDbRemoved(self):
         rs = Sqlite3RecordSet()
         path = rs.db_path
@@ -160,8 +362,228 @@ class TestSqllit3RecordSet(unittest.TestCase):
         self.assertFalse(os.path.exists(path))
         
         
+    def testClose(self):
+        rs = Sqlite3RecordSet()
+        path = rs.db_path
+        rs.close()
+        self.assertFalse(os.path.exists(path))
+        rs.close()
+        
+        
+class TestColumnarSqlite3RecordSet(unittest.TestCase):
+    
+    
+    def testGetRecord(self):
+        rs = Sqlite3RecordSet(storage=Sqlite3RecordSet.COLUMNAR)
+        
+        person = test_person(0)
+        person.set_source('extract', 'people')
+        person.freeze()
+        rs.add_record(person)
+        
+        animal = test_animal(0)
+        animal.freeze()
+        rs.add_record(animal)
+        
+        stored = rs.get_record(person.serial)
+        self.assertEqual(stored, person)
+        self.assertEqual(stored.serial, person.serial)
+        self.assertEqual(type(stored['age']), int)
+        self.assertEqual(stored.source_processor_name, 'extract')
+        self.assertTrue(stored.is_frozen)
+        
+        stored = rs.get_record(animal.serial)
+        self.assertEqual(stored, animal)
+        self.assertTrue(stored['sane'] is True)
+        
+        
+    def testSchemaTables(self):
+        rs = Sqlite3RecordSet(storage=Sqlite3RecordSet.COLUMNAR)
+        
+        for i in range(3):
+            person = test_person(i)
+            person.freeze()
+            rs.add_record(person)
+        animal = test_animal(0)
+        animal.freeze()
+        rs.add_record(animal)
+        rs.commit()
+        
+        db = sqlite3.connect(rs.db_path)
+        rows = db.execute("SELECT f_first, f_age FROM schema_0").fetchall()
+        self.assertEqual(sorted(rows), [('Jane', 20), ('John', 22),
+                                        ('Mark', 41)])
+        rows = db.execute("SELECT count(*) FROM schema_1").fetchall()
+        self.assertEqual(rows, [(1, ), ])
+        db.close()
+        
+        
+    def testFindRecordsWithTag(self):
+        rs = Sqlite3RecordSet(storage=Sqlite3RecordSet.COLUMNAR)
+        
+        person = test_person(0)
+        person.freeze()
+        animal = test_animal(0)
+        animal.freeze()
+        person1 = test_person(1)
+        person1.freeze()
+        rs.add_records([(person, ['tagA', ]), (animal, ['tagA', ]),
+                        (person1, ['tagB', ])])
+        
+        self.assertEqual(sorted(rs.find_records_with_tag('tagA')),
+                         sorted([person, animal]))
+        
+        rs.remove_record(person.serial)
+        self.assertEqual(list(rs.find_records_with_tag('tagA')), [animal, ])
+        self.assertEqual(rs.count, 2)
+        
+        
+    def testSourceRecords(self):
+        rs = Sqlite3RecordSet(storage=Sqlite3RecordSet.COLUMNAR)
+        
+        person = test_person(0)
+        person1 = test_person(1)
+        person1.note_src_record(person)
+        person1.freeze()
+        rs.add_record(person1)
+        
+        self.assertEqual(rs.get_record(person1.serial).get_src_record_serials(),
+                         [person.serial, ])
+        
+        
+    def testNonAsciiText(self):
+        person = test_person(1)
+        person['first'] = u'Ren\xe9e'
+        person.freeze()
+        
+        for storage in (Sqlite3RecordSet.PICKLED, Sqlite3RecordSet.COLUMNAR):
+            rs = Sqlite3RecordSet(storage=storage)
+            rs.add_record(person)
+            record = rs.get_record(person.serial)
+            self.assertEqual(type(record['first']), unicode)
+            self.assertEqual(record['first'], u'Ren\xe9e')
+            self.assertEqual(type(record['last']), str)
+        
+        
+    def testDates(self):
+        schema = EtlSchema()
+        schema.add_field('born', type_hint=EtlSchema.DATE)
+        record = EtlRecord(schema, {'born': date(1990, 5, 17)})
+        record.freeze()
+        
+        rs = Sqlite3RecordSet(storage=Sqlite3RecordSet.COLUMNAR)
+        rs.add_record(record)
+        self.assertEqual(rs.get_record(record.serial)['born'], date(1990, 5, 17))
+        
+        
+    def testCoercedValues(self):
+        schema = EtlSchema()
+        schema.add_field('count', type_hint=EtlSchema.INT)
+        schema.add_field('price', type_hint=EtlSchema.FLOAT)
+        schema.add_field('active', type_hint=EtlSchema.BOOL)
+        record = EtlRecord(schema, {'count': '3', 'price': '2.5',
+                                    'active': 'yes'})
+        self.assertIsNone(schema.coerce_record(record))
+        record.freeze()
+        
+        for storage in (Sqlite3RecordSet.PICKLED, Sqlite3RecordSet.COLUMNAR):
+            rs = Sqlite3RecordSet(storage=storage)
+            rs.add_record(record)
+            self.assertEqual(rs.get_record(record.serial).values,
+                             {'count': 3, 'price': 2.5, 'active': True})
+        
+        
+    def testValuesMustMatchTypeHint(self):
+        schema = EtlSchema()
+        schema.add_field('age', type_hint=EtlSchema.INT)
+        schema.add_field('active', type_hint=EtlSchema.BOOL)
+        
+        rs = Sqlite3RecordSet(storage=Sqlite3RecordSet.COLUMNAR)
+        for values in ({'age': '0042'}, {'active': 'False'}, {'age': True}):
+            record = EtlRecord(schema, values)
+            record.freeze()
+            with self.assertRaisesRegexp(Exception, "COLUMNAR storage"):
+                rs.add_record(record)
+        self.assertEqual(rs.count, 0)
+        
+        record = EtlRecord(schema, {'age': None, 'active': False})
+        record.freeze()
+        rs.add_record(record)
+        self.assertEqual(rs.get_record(record.serial).values,
+                         {'age': None, 'active': False})
+        
+        
+    def testNewSchemaRolledBack(self):
+        rs = Sqlite3RecordSet(storage=Sqlite3RecordSet.COLUMNAR)
+        rs.BULK_INSERT_CHUNK = 1
+        person = test_person(0)
+        person.freeze()
+        animal = test_animal(0)
+        animal.freeze()
+        bad_person = test_person(1)
+        bad_person['age'] = 'twenty'
+        bad_person.freeze()
+        
+        # Creating the animal table mid-batch mustn't commit the first person
+        with self.assertRaises(Exception):
+            rs.add_records([person, animal, bad_person])
+        self.assertEqual(rs.count, 0)
+        self.assertEqual(list(rs.all_records()), [])
         
+        rs.add_records([animal, person])
+        self.assertEqual(sorted(rs.all_records()), sorted([person, animal]))
+        
+        
+    def testAllRecords(self):
+        rs = Sqlite3RecordSet(storage=Sqlite3RecordSet.COLUMNAR)
+        
+        records = list()
+        for i in range(3):
+            person = test_person(i)
+            person.freeze()
+            records.append(person)
+        animal = test_animal(0)
+        animal.freeze()
+        records.append(animal)
+        rs.add_records(records)
+        
+        self.assertEqual(sorted(rs.all_records()), sorted(records))
+        
+        
+    def testFieldNotInSchema(self):
+        person = test_person(0)
+        person['height'] = 6
+        person.freeze()
+        
+        rs = Sqlite3RecordSet(storage=Sqlite3RecordSet.COLUMNAR)
+        with self.assertRaises(Exception):
+            rs.add_record(person)
+        
+        
+    def testSaveCopy(self):
+        rs = Sqlite3RecordSet(storage=Sqlite3RecordSet.COLUMNAR)
+        people = list()
+        for i in range(3):
+            person = test_person(i)
+            person.freeze()
+            people.append(person)
+        rs.add_records(people)
+        
+        tmp = NamedTemporaryFile(delete=False)
+        tmp.close()
+        self.addCleanup(os.unlink, tmp.name)
+        rs.save_copy(tmp.name)
+        
+        copy = Sqlite3RecordSet.open_file(tmp.name)
+        self.assertEqual(copy.storage, Sqlite3RecordSet.COLUMNAR)
+        self.assertEqual(list(copy.all_records()), people)
+        
+        
+    def testInvalidStorage(self):
+        with self.assertRaises(ValueError):
+            Sqlite3RecordSet(storage='xml')
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,658 @@
+import os
+import json
+import time
+import shutil
+import unittest
+from tempfile import mkdtemp
+from threading import Lock
+
+from test_data import test_person, PersonTestScehma
+# Test Data:
+#   (person,    "John",     "Doe",      22),
+#   (person,    "Jane",     "Doe",      20),
+#   (person,    "Mark",     "Smith",    41),
+#   (animal,    "dog",      "Animalia", "Canidae",  True),
+#   (animal,    "cat",      "Animalia", "Felidae",  False),
+
+from etl.EtlProcessor import EtlProcessor, EtlProcessorDataPort
+from etl.EtlBuildError import EtlBuildError
+from etl.Workflow import Workflow
+from etl.common_processors.FieldFindReplace import FieldFindReplace
+
+from TestEtlProcessorEventManager import PersonSource
+from TestEtlProcessEventManager import PidStamper
+
+
+class ConcurrencyTracker(object):
+    '''Track how many processors are running at the same time'''
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+        self.lock = Lock()
+    def start(self):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+    def stop(self):
+        with self.lock:
+            self.running -= 1
+
+
+class PersonExtractor(EtlProcessor):
+    '''Generates the test people tagged by first name'''
+    def __init__(self, tracker=None, delay=0):
+        super(PersonExtractor, self).__init__()
+        self.tracker = tracker
+        self.delay = delay
+    def list_inputs(self):
+        return []
+    def list_outputs(self):
+        return [EtlProcessorDataPort('people', PersonTestScehma()), ]
+    def gen_people_output(self, inputs, output_set):
+        if self.tracker is not None:
+            self.tracker.start()
+        time.sleep(self.delay)
+        for i in range(3):
+            person = test_person(i)
+            person.freeze()
+            output_set.add_record(person, [person['first'], ])
+        if self.tracker is not None:
+            self.tracker.stop()
+
+
+class PersonCombiner(EtlProcessor):
+    '''Copies all people from its input to its output'''
+    def list_inputs(self):
+        return [EtlProcessorDataPort('people', PersonTestScehma()), ]
+    def list_outputs(self):
+        return [EtlProcessorDataPort('people', PersonTestScehma()), ]
+    def gen_people_output(self, inputs, output_set):
+        for input_set in inputs['people']:
+            for serial in self._list_serials(input_set):
+                record = input_set.get_record(serial).clone()
+                record.freeze()
+                output_set.add_record(record)
+    def _list_serials(self, input_set):
+        serials = list()
+        for tag in ('John', 'Jane', 'Mark'):
+            for record in input_set.find_records_with_tag(tag):
+                serials.append(record.serial)
+        return serials
+
+
+class InputKeepingCombiner(PersonCombiner):
+    '''PersonCombiner that keeps references to the input record sets'''
+    def __init__(self):
+        super(InputKeepingCombiner, self).__init__()
+        self.input_sets = list()
+    def gen_people_output(self, inputs, output_set):
+        self.input_sets.extend(inputs['people'])
+        super(InputKeepingCombiner, self).gen_people_output(inputs,
+                                                            output_set)
+
+
+class PersonCopier(PersonCombiner):
+    '''Copies all people from its input without using tags'''
+    def _list_serials(self, input_set):
+        return [record.serial for record in input_set.all_records()]
+
+
+class FrozenChecker(EtlProcessor):
+    '''Notes if the people it receives are frozen and sends out copies'''
+    def __init__(self):
+        super(FrozenChecker, self).__init__()
+        self.frozen = list()
+    def list_inputs(self):
+        return [EtlProcessorDataPort('people', PersonTestScehma()), ]
+    def list_outputs(self):
+        return [EtlProcessorDataPort('people', PersonTestScehma()), ]
+    def process_input_record(self, record, dispatcher):
+        self.frozen.append(record.is_frozen)
+        dispatcher('people', record.clone())
+
+
+class HoldingCopier(FrozenChecker):
+    '''Holds the people it receives, sending copies when an input finishes'''
+    def __init__(self):
+        super(HoldingCopier, self).__init__()
+        self.held = list()
+    def process_input_record(self, record, dispatcher):
+        self.held.append(record)
+    def handle_input_disconnected(self, input_name, dispatcher):
+        for record in self.held:
+            dispatcher('people', record.clone())
+
+
+class PairCopier(FrozenChecker):
+    '''Sends out copies of the people received on either of two inputs'''
+    def list_inputs(self):
+        return [EtlProcessorDataPort('left', PersonTestScehma()),
+                EtlProcessorDataPort('right', PersonTestScehma())]
+
+
+class CountingPersonExtractor(PersonExtractor):
+    '''PersonExtractor that counts runs, without a cache fingerprint'''
+    runs = 0
+    def gen_people_output(self, inputs, output_set):
+        self.runs += 1
+        super(CountingPersonExtractor, self).gen_people_output(inputs,
+                                                               output_set)
+
+
+class SavedPersonExtractor(PersonExtractor):
+    '''PersonExtractor that counts runs and can have outputs saved'''
+    def __init__(self, version=1):
+        super(SavedPersonExtractor, self).__init__()
+        self.version = version
+        self.runs = 0
+    def get_cache_fingerprint(self):
+        return self.version
+    def gen_people_output(self, inputs, output_set):
+        self.runs += 1
+        super(SavedPersonExtractor, self).gen_people_output(inputs,
+                                                            output_set)
+
+
+class SavedPersonCombiner(PersonCombiner):
+    '''PersonCombiner that counts runs and can have outputs saved'''
+    runs = 0
+    def get_cache_fingerprint(self):
+        return 'combine'
+    def gen_people_output(self, inputs, output_set):
+        self.runs += 1
+        super(SavedPersonCombiner, self).gen_people_output(inputs,
+                                                           output_set)
+
+
+class FingerprintCountingCombiner(PersonCopier):
+    '''PersonCopier that counts calls to get_cache_fingerprint()'''
+    fingerprints = 0
+    def get_cache_fingerprint(self):
+        self.fingerprints += 1
+        return 'copy'
+
+
+class TestWorkflow(unittest.TestCase):
+
+    def _createWorkflow(self, tracker=None, branches=3):
+        wf = Workflow()
+        wf.add_processor('combine', PersonCombiner())
+        for i in range(branches):
+            name = 'extract%d' % (i)
+            wf.add_processor(name, PersonExtractor(tracker, 0.05))
+            wf.connect(name, 'people', 'combine')
+        return wf
+
+
+    def testExecuteSequential(self):
+        tracker = ConcurrencyTracker()
+        wf = self._createWorkflow(tracker)
+        wf.execute('combine')
+        self.assertEqual(wf.get_output('combine', 'people').count, 9)
+        self.assertEqual(tracker.max_running, 1)
+
+
+    def testExecuteParallel(self):
+        tracker = ConcurrencyTracker()
+        wf = self._createWorkflow(tracker)
+        wf.execute('combine', workers=3)
+        self.assertEqual(wf.get_output('combine', 'people').count, 9)
+        self.assertEqual(tracker.max_running, 3)
+
+
+    def testMaxWorkers(self):
+        tracker = ConcurrencyTracker()
+        wf = self._createWorkflow(tracker)
+        wf.max_workers = 2
+        wf.execute('combine')
+        self.assertEqual(tracker.max_running, 2)
+
+
+    def testParallelErrorRaised(self):
+        wf = self._createWorkflow()
+        wf.add_processor('broken', PersonExtractor())
+        wf.connect('broken', 'people', 'combine')
+        wf.get_prc('broken').gen_people_output = None
+        with self.assertRaises(TypeError):
+            wf.execute('combine', workers=2)
+
+
+    def testCycleDetected(self):
+        wf = Workflow()
+        wf.add_processor('a', PersonCombiner())
+        wf.add_processor('b', PersonCombiner())
+        wf.connect('a', 'people', 'b')
+        wf.connect('b', 'people', 'a')
+        with self.assertRaises(EtlBuildError):
+            wf.execute('a', workers=2)
+
+
+class TestWorkflowOutputRelease(unittest.TestCase):
+    
+    def _createWorkflow(self):
+        wf = Workflow()
+        wf.add_processor('combine', InputKeepingCombiner())
+        wf.add_processor('copy', PersonCopier())
+        wf.connect('combine', 'people', 'copy')
+        for i in range(2):
+            name = 'extract%d' % (i)
+            wf.add_processor(name, PersonExtractor())
+            wf.connect(name, 'people', 'combine')
+        return wf
+    
+    
+    def testIntermediateReleased(self):
+        wf = self._createWorkflow()
+        wf.execute('copy', workers=2)
+        self.assertEqual(wf.get_output('copy', 'people').count, 6)
+        for input_set in wf.get_prc('combine').input_sets:
+            self.assertEqual(input_set.count, 0)
+            
+            
+    def testPinnedKept(self):
+        wf = self._createWorkflow()
+        wf.pin_output('extract0', 'people')
+        wf.execute('copy')
+        self.assertEqual(
+            [s.count for s in wf.get_prc('combine').input_sets], [3, 0])
+        
+        
+    def testReleaseDisabled(self):
+        wf = self._createWorkflow()
+        wf.release_outputs = False
+        wf.execute('copy')
+        self.assertEqual(
+            [s.count for s in wf.get_prc('combine').input_sets], [3, 3])
+        
+        
+    def testEarlierOutputKept(self):
+        wf = self._createWorkflow()
+        wf.add_processor('extract2', PersonExtractor())
+        wf.execute('extract2')
+        output = wf.get_output('extract2', 'people')
+        output.convert_to_disk_storage()
+        wf.connect('extract2', 'people', 'combine')
+        wf.execute('copy')
+        self.assertEqual(output.count, 3)   # Wasn't generated by execute()
+        
+        
+class TestWorkflowStreaming(unittest.TestCase):
+    
+    def _createWorkflow(self):
+        wf = Workflow()
+        wf.add_processor('src', PersonSource(30))
+        replace = FieldFindReplace(PersonTestScehma(), 'people', 'people')
+        replace.replace('last', 'Doe', 'Roe')
+        wf.add_processor('replace', replace)
+        wf.connect('src', 'people', 'replace')
+        return wf
+    
+    
+    def testExecuteStreaming(self):
+        wf = self._createWorkflow()
+        wf.execute_streaming('replace')
+        output = wf.get_output('replace', 'people')
+        self.assertEqual(output.count, 30)
+        last_names = set([r['last'] for r in output.all_records()])
+        self.assertEqual(sorted(last_names), ['Roe', 'Smith'])
+        
+        
+    def testReplicas(self):
+        wf = self._createWorkflow()
+        wf.set_replicas('replace', 4, preserve_order=True)
+        wf.execute_streaming('replace')
+        output = wf.get_output('replace', 'people')
+        self.assertEqual([r['first'] for r in output.all_records()],
+                         [test_person(i % 3)['first'] for i in range(30)])
+        
+        
+    def testReplicasNeedStateless(self):
+        wf = self._createWorkflow()
+        with self.assertRaises(EtlBuildError):
+            wf.set_replicas('src', 2)
+            
+            
+    def _createChain(self):
+        wf = Workflow()
+        wf.add_processor('src', PersonSource(30))
+        wf.add_processor('check1', FrozenChecker())
+        wf.add_processor('check2', FrozenChecker())
+        wf.connect('src', 'people', 'check1')
+        wf.connect('check1', 'people', 'check2')
+        return wf
+    
+    
+    def testChainFused(self):
+        wf = self._createChain()
+        wf.execute_streaming('check2')
+        self.assertEqual(wf.get_output('check2', 'people').count, 30)
+        self.assertEqual(set(wf.get_prc('check2').frozen), set([False]))
+        
+        record = wf.get_output('check2', 'people').all_records().next()
+        self.assertEqual(record.source_processor_name, 'check2')
+        
+        
+    def testChainNotFused(self):
+        wf = self._createChain()
+        wf.fuse_chains = False
+        wf.execute_streaming('check2')
+        self.assertEqual(wf.get_output('check2', 'people').count, 30)
+        self.assertEqual(set(wf.get_prc('check1').frozen), set([True]))
+        
+        
+    def testFusedRecordsValidated(self):
+        wf = self._createChain()
+        wf.validate_fused_records = True
+        wf.execute_streaming('check2')
+        self.assertEqual(set(wf.get_prc('check2').frozen), set([True]))
+        
+        
+    def testFindFusableChains(self):
+        wf = self._createChain()
+        wf.add_processor('check3', FrozenChecker())
+        wf.connect('check2', 'people', 'check3')
+        names = ['src', 'check1', 'check2', 'check3']
+        self.assertEqual(wf._find_fusable_chains(names, 'check3'),
+                         [['src'], ['check1', 'check2', 'check3']])
+        
+        wf.get_prc('check2').allow_fusion = False
+        self.assertEqual(len(wf._find_fusable_chains(names, 'check3')), 4)
+        
+        
+    def _runHoldingChain(self, wf, head, fuse_chains):
+        wf.add_processor('hold1', HoldingCopier())
+        wf.add_processor('hold2', HoldingCopier())
+        wf.connect(head, 'people', 'hold1')
+        wf.connect('hold1', 'people', 'hold2')
+        wf.fuse_chains = fuse_chains
+        wf.execute_streaming('hold2')
+        return wf.get_output('hold2', 'people').count
+        
+        
+    def testExtractorNotFused(self):
+        counts = list()
+        for fuse_chains in (True, False):
+            wf = Workflow()
+            wf.add_processor('src', PersonSource(5))
+            counts.append(self._runHoldingChain(wf, 'src', fuse_chains))
+        self.assertEqual(counts, [5, 5])
+        
+        
+    def testMultipleInputsNotFused(self):
+        counts = list()
+        for fuse_chains in (True, False):
+            wf = Workflow()
+            wf.add_processor('left', PersonSource(3))
+            wf.add_processor('right', PersonSource(4))
+            wf.add_processor('pair', PairCopier())
+            wf.connect('left', 'people', 'pair', 'left')
+            wf.connect('right', 'people', 'pair', 'right')
+            counts.append(self._runHoldingChain(wf, 'pair', fuse_chains))
+        self.assertEqual(counts, [7, 7])
+        
+        
+    def testWorkersStoppedOnBuildError(self):
+        wf = self._createWorkflow()
+        wf.add_processor('stamp', PidStamper())
+        wf.connect('replace', 'people', 'stamp')
+        wf.add_processor('check', FrozenChecker())
+        wf.connect('stamp', 'people', 'check')
+        
+        created = list()
+        create_manager = wf._create_event_manager
+        def create_or_fail(name):
+            if name == 'check':
+                raise ValueError("Failed on purpose")
+            created.append(create_manager(name))
+            return created[-1]
+        wf._create_event_manager = create_or_fail
+        
+        with self.assertRaises(ValueError):
+            wf.execute_streaming('check')
+        stamp = [m for m in created if m.prc_name == 'stamp'][0]
+        self.assertIsNone(stamp.worker_pid)
+        
+        
+    def testErrorRaised(self):
+        wf = self._createWorkflow()
+        wf.get_prc('replace').process_input_batch = None
+        with self.assertRaises(Exception):
+            wf.execute_streaming('replace')
+            
+            
+class TestWorkflowOutputCaching(unittest.TestCase):
+    
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+        
+        
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        
+        
+    def _run(self, versions=(1, 2), workers=1):
+        wf = Workflow()
+        wf.enable_output_cache(directory=self.cache_dir)
+        wf.add_processor('combine', SavedPersonCombiner())
+        for i, version in enumerate(versions):
+            name = 'extract%d' % (i)
+            wf.add_processor(name, SavedPersonExtractor(version))
+            wf.connect(name, 'people', 'combine')
+        wf.execute('combine', workers)
+        return wf
+    
+    
+    def _runs(self, wf):
+        return dict([(name, wf.get_prc(name).runs)
+                     for name in wf.list_prc_names()])
+    
+    
+    def testOutputReused(self):
+        wf = self._run()
+        self.assertEqual(self._runs(wf),
+                         {'combine': 1, 'extract0': 1, 'extract1': 1})
+        
+        wf = self._run()
+        self.assertEqual(self._runs(wf),
+                         {'combine': 0, 'extract0': 0, 'extract1': 0})
+        output = wf.get_output('combine', 'people')
+        self.assertEqual(output.count, 6)
+        self.assertEqual(sorted([r['first'] for r in output.all_records()]),
+                         ['Jane', 'Jane', 'John', 'John', 'Mark', 'Mark'])
+        
+        
+    def testUpstreamChange(self):
+        self._run()
+        wf = self._run(versions=(1, 3), workers=2)
+        self.assertEqual(self._runs(wf),
+                         {'combine': 1, 'extract0': 0, 'extract1': 1})
+        self.assertEqual(wf.get_output('combine', 'people').count, 6)
+        people = wf.get_output('extract0', 'people')
+        self.assertEqual(len(list(people.find_records_with_tag('John'))), 1)
+        
+        
+    def testSharedAncestorsKeyedOnce(self):
+        # Each layer of copiers reads from both copiers in the layer above
+        wf = Workflow()
+        wf.enable_output_cache(directory=self.cache_dir)
+        wf.add_processor('extract', SavedPersonExtractor())
+        above = ['extract', ]
+        for layer in range(8):
+            names = ['copy%d_%d' % (layer, i) for i in range(2)]
+            for name in names:
+                wf.add_processor(name, FingerprintCountingCombiner())
+                for src in above:
+                    wf.connect(src, 'people', name)
+            above = names
+        wf.add_processor('combine', FingerprintCountingCombiner())
+        for src in above:
+            wf.connect(src, 'people', 'combine')
+            
+        wf.execute('combine')
+        for name in wf.list_prc_names():
+            if name != 'extract':
+                self.assertEqual(wf.get_prc(name).fingerprints, 1)
+        
+        
+    def testNoFingerprint(self):
+        wf = Workflow()
+        wf.enable_output_cache(directory=self.cache_dir)
+        wf.add_processor('extract', PersonExtractor())
+        wf.add_processor('combine', SavedPersonCombiner())
+        wf.connect('extract', 'people', 'combine')
+        wf.execute('combine')
+        self.assertEqual(wf.output_cache.size, 0)
+        
+        
+class TestWorkflowCheckpoints(unittest.TestCase):
+    
+    def setUp(self):
+        self.checkpoint_dir = mkdtemp()
+        
+        
+    def tearDown(self):
+        shutil.rmtree(self.checkpoint_dir)
+        
+        
+    def _createWorkflow(self, broken=False):
+        wf = Workflow()
+        wf.add_processor('combine', SavedPersonCombiner())
+        for i in range(2):
+            name = 'extract%d' % (i)
+            wf.add_processor(name, SavedPersonExtractor(i))
+            wf.connect(name, 'people', 'combine')
+        if broken:
+            wf.get_prc('combine').gen_people_output = None
+        return wf
+    
+    
+    def _manifest(self):
+        path = os.path.join(self.checkpoint_dir, 'manifest.json')
+        with open(path, 'r') as fh:
+            return json.load(fh)
+        
+        
+    def testResume(self):
+        wf = self._createWorkflow(broken=True)
+        wf.enable_checkpoints(self.checkpoint_dir)
+        with self.assertRaises(TypeError):
+            wf.execute('combine')
+        outputs = self._manifest()['outputs']
+        self.assertEqual([e['prc_name'] for e in outputs],
+                         ['extract0', 'extract1'])
+        self.assertEqual([e['count'] for e in outputs], [3, 3])
+        
+        wf = self._createWorkflow()
+        wf.resume('combine', directory=self.checkpoint_dir)
+        self.assertEqual(self._runs(wf),
+                         {'combine': 1, 'extract0': 0, 'extract1': 0})
+        self.assertEqual(wf.get_output('combine', 'people').count, 6)
+        self.assertEqual(len(self._manifest()['outputs']), 3)
+        
+        
+    def testResumeWithoutFingerprints(self):
+        def create_workflow():
+            wf = Workflow()
+            wf.add_processor('extract', CountingPersonExtractor())
+            wf.add_processor('copy', PersonCopier())
+            wf.add_processor('combine', PersonCopier())
+            wf.connect('extract', 'people', 'copy')
+            wf.connect('copy', 'people', 'combine')
+            return wf
+        
+        wf = create_workflow()
+        wf.get_prc('combine').gen_people_output = None
+        wf.enable_checkpoints(self.checkpoint_dir)
+        with self.assertRaises(TypeError):
+            wf.execute('combine')
+            
+        wf = create_workflow()
+        wf.resume('combine', directory=self.checkpoint_dir)
+        self.assertEqual(wf.get_prc('extract').runs, 0)
+        self.assertEqual(wf.get_output('combine', 'people').count, 3)
+        
+        # Outputs with a changed connection upstream are generated again
+        wf = create_workflow()
+        wf.add_processor('extract2', CountingPersonExtractor())
+        wf.connect('extract2', 'people', 'copy')
+        wf.resume('combine', directory=self.checkpoint_dir)
+        self.assertEqual(wf.get_prc('extract').runs, 0)
+        self.assertEqual(wf.get_output('combine', 'people').count, 6)
+        
+        
+    def testClassChanged(self):
+        wf = self._createWorkflow(broken=True)
+        wf.enable_checkpoints(self.checkpoint_dir)
+        with self.assertRaises(TypeError):
+            wf.execute('combine')
+            
+        wf = self._createWorkflow()
+        wf.get_prc('extract1').__class__ = PersonExtractor
+        wf.get_prc('extract1').runs = 0
+        wf.resume('combine', directory=self.checkpoint_dir)
+        self.assertEqual(wf.get_prc('extract0').runs, 0)
+        self.assertEqual(wf.get_output('combine', 'people').count, 6)
+        
+        
+    def testConfigChanged(self):
+        wf = self._createWorkflow(broken=True)
+        wf.enable_checkpoints(self.checkpoint_dir)
+        with self.assertRaises(TypeError):
+            wf.execute('combine')
+            
+        wf = self._createWorkflow()
+        wf.get_prc('extract1').version = 5
+        wf.resume('combine', directory=self.checkpoint_dir)
+        self.assertEqual(self._runs(wf),
+                         {'combine': 1, 'extract0': 0, 'extract1': 1})
+        
+        
+    def testSpillFilesRemoved(self):
+        wf = self._createWorkflow(broken=True)
+        wf.enable_checkpoints(self.checkpoint_dir)
+        with self.assertRaises(TypeError):
+            wf.execute('combine')
+        spill_dir = os.path.join(self.checkpoint_dir, 'spill')
+        left = os.path.join(spill_dir, 'left_by_crash.db')
+        open(left, 'w').close()
+        
+        wf = self._createWorkflow()
+        wf.resume('combine', directory=self.checkpoint_dir)
+        self.assertFalse(os.path.exists(left))
+        self.assertEqual(self._runs(wf)['extract0'], 0)
+        
+        
+    def testCheckpointedOutputLeftInMemory(self):
+        wf = self._createWorkflow()
+        wf.release_outputs = False
+        wf.enable_checkpoints(self.checkpoint_dir)
+        wf.execute('combine')
+        
+        entry = self._manifest()['outputs'][0]
+        path = os.path.join(self.checkpoint_dir, entry['file'])
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(wf.get_output(entry['prc_name'], 'people').on_disk)
+        
+        
+    def testEnableClearsOldCheckpoints(self):
+        wf = self._createWorkflow()
+        wf.enable_checkpoints(self.checkpoint_dir)
+        wf.execute('combine')
+        outputs = self._manifest()['outputs']
+        
+        wf = self._createWorkflow()
+        wf.enable_checkpoints(self.checkpoint_dir)
+        self.assertEqual(self._manifest()['outputs'], [])
+        for entry in outputs:
+            path = os.path.join(self.checkpoint_dir, entry['file'])
+            self.assertFalse(os.path.exists(path))
+        
+        
+    def _runs(self, wf):
+        return dict([(name, wf.get_prc(name).runs)
+                     for name in wf.list_prc_names()])
+    
+    
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
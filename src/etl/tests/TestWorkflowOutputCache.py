@@ -0,0 +1,75 @@
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from test_data import test_person, PersonTestScehma
+# Test Data:
+#   (person,    "John",     "Doe",      22),
+#   (person,    "Jane",     "Doe",      20),
+#   (person,    "Mark",     "Smith",    41),
+#   (animal,    "dog",      "Animalia", "Canidae",  True),
+#   (animal,    "cat",      "Animalia", "Felidae",  False),
+
+from etl.EtlRecordSet import EtlRecordSet
+from etl.WorkflowOutputCache import WorkflowOutputCache
+
+
+class TestWorkflowOutputCache(unittest.TestCase):
+    
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+        
+        
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        
+        
+    def _recordSet(self):
+        rs = EtlRecordSet()
+        for i in range(3):
+            person = test_person(i)
+            person.freeze()
+            rs.add_record(person, [person['first'], ])
+        return rs
+    
+    
+    def testMakeKey(self):
+        key = WorkflowOutputCache.make_key(['a', 1, ('b', 'c')])
+        self.assertEqual(key,
+                         WorkflowOutputCache.make_key(['a', 1, ('b', 'c')]))
+        self.assertNotEqual(key, WorkflowOutputCache.make_key(['a', 2]))
+        
+        
+    def testSaveLoad(self):
+        cache = WorkflowOutputCache(self.cache_dir)
+        self.assertIsNone(cache.load('abc'))
+        
+        rs = self._recordSet()
+        cache.save('abc', rs)
+        self.assertTrue(cache.has_output('abc'))
+        
+        loaded = cache.load('abc')
+        self.assertEqual(loaded.count, 3)
+        self.assertEqual(loaded.size, rs.size)
+        self.assertEqual(len(list(loaded.find_records_with_tag('Jane'))), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        
+        
+    def testEvictLeastRecentlyUsed(self):
+        cache = WorkflowOutputCache(self.cache_dir)
+        for i, key in enumerate(['a', 'b', 'c']):
+            cache.save(key, self._recordSet())
+            os.utime(cache._path(key), (i, i))
+        cache.load('a')
+        
+        cache.max_bytes = cache.size - 1
+        cache.evict()
+        self.assertTrue(cache.has_output('a'))
+        self.assertFalse(cache.has_output('b'))
+        self.assertTrue(cache.has_output('c'))
+        
+        
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()